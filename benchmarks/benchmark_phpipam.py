@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+"""
+Time PHPIPAM public methods against a synthetic phpIPAM database.
+
+Each method runs --iterations times on randomly sampled arguments, and its
+latency percentiles are reported along with the peak memory allocated by
+one call, measured in a separate traced run. Writes are undone after each
+call, so the database is left as generated.
+
+Usage:
+    python benchmarks/generate_dataset.py bench.db --subnets 10000 \
+        --ips 2000000
+    python benchmarks/benchmark_phpipam.py bench.db --iterations 50
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import time
+import tracemalloc
+from ipaddress import ip_address, ip_interface, ip_network
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..'))
+
+from ipam.client.backends.phpipam import PHPIPAM  # noqa: E402
+
+PERCENTILES = (50, 90, 99)
+LEAF_PREFIXLEN = 24
+# Addresses allocated at once by add_next_ips
+NEXT_IPS_COUNT = 100
+# Outside of the generated /8 subnets, for new top-level subnets
+TOP_LEVEL_RANGE = ip_network('198.18.0.0/15')
+
+
+class Dataset(object):
+    """
+    Random arguments sampled from a generated database
+    """
+    def __init__(self, path, seed):
+        self.rand = random.Random(seed)
+        conn = sqlite3.connect(path)
+        self.ips = [ip_address(int(row[0])) for row in conn.execute(
+            'SELECT ip_addr FROM ipaddresses')]
+        self.descriptions = [row[0] for row in conn.execute(
+            'SELECT description FROM ipaddresses LIMIT 1000')]
+        # Subnets are looked up by address only: skip those sharing it
+        # with their containers
+        self.descriptions_and_subnets = [
+            (row[0], ip_address(int(row[1]))) for row in conn.execute(
+                'SELECT ip.description, s.subnet FROM ipaddresses ip '
+                'JOIN subnets s ON ip.subnetId = s.id '
+                'WHERE s.subnet IN (SELECT subnet FROM subnets '
+                'GROUP BY subnet HAVING COUNT(*) = 1) LIMIT 1000')]
+        subnets = [(ip_network('{}/{}'.format(ip_address(int(row[0])),
+                                              row[1])), row[2], row[3])
+                   for row in conn.execute(
+                       'SELECT subnet, mask, id, masterSubnetId '
+                       'FROM subnets')]
+        self.subnet_ids = [subnet_id for (_, subnet_id, _) in subnets]
+        leaf_ids = set(row[0] for row in conn.execute(
+            'SELECT DISTINCT subnetId FROM ipaddresses'))
+        self.top_levels = [subnet for (subnet, _, master_id) in subnets
+                           if master_id == 0]
+        self.leaves = [subnet for (subnet, subnet_id, _) in subnets
+                       if subnet_id in leaf_ids]
+        self.containers = [subnet for (subnet, subnet_id, master_id)
+                           in subnets
+                           if subnet_id not in leaf_ids and master_id != 0]
+        conn.close()
+
+    def ip(self):
+        return self.rand.choice(self.ips)
+
+    def interface(self):
+        return ip_interface('{}/{}'.format(self.ip(), LEAF_PREFIXLEN))
+
+    def leaf(self):
+        return self.rand.choice(self.leaves)
+
+    def container(self):
+        return self.rand.choice(self.containers or self.leaves)
+
+    def top_level(self):
+        return self.rand.choice(self.top_levels)
+
+    def description(self):
+        return self.rand.choice(self.descriptions)
+
+    def description_and_subnet(self):
+        return self.rand.choice(self.descriptions_and_subnets)
+
+    def subnet_id(self):
+        return self.rand.choice(self.subnet_ids)
+
+    def subnet_description(self):
+        return 'bench subnet {}'.format(self.leaf())
+
+    def top_level_subnet(self):
+        return ip_network('{}/{}'.format(TOP_LEVEL_RANGE.network_address +
+                                         self.rand.randrange(512) * 256,
+                                         LEAF_PREFIXLEN))
+
+
+def get_scenarios(ipam, dataset):
+    """
+    Return (name, setup) pairs, setup returning the call to time and an
+    optional cleanup to run after it. Setups and cleanups of writes put
+    the database back as generated, and are not timed.
+    """
+    def call(method, *args):
+        return lambda: (lambda: getattr(ipam, method)(*args), None)
+
+    def free_subnet():
+        # Containers are full, the top-level subnet has room left
+        parent = dataset.top_level()
+        subnet = ipam.add_next_subnet(parent, LEAF_PREFIXLEN, 'bench')
+        ipam.delete_subnet(subnet)
+        return parent, subnet
+
+    def add_ip():
+        subnet = dataset.leaf()
+        ip = ipam.get_next_free_ip(subnet)
+        return (lambda: ipam.add_ip(ip, 'bench', 'bench'),
+                lambda: ipam.delete_ip(ip))
+
+    def add_next_ip():
+        subnet = dataset.leaf()
+        ips = []
+        return (lambda: ips.append(ipam.add_next_ip(subnet, 'bench', 'bench')),
+                lambda: ips and ipam.delete_ip(ips[0]))
+
+    def add_next_ips():
+        # Leaves have a few free addresses only: fill an empty subnet
+        (parent, subnet) = free_subnet()
+        ipam.add_subnet(subnet, parent, 'bench')
+        names = ['bench'] * NEXT_IPS_COUNT
+        return (lambda: ipam.add_next_ips(subnet, NEXT_IPS_COUNT, names,
+                                          names),
+                lambda: ipam.delete_subnet(subnet, empty_subnet=True))
+
+    def add_next_subnet():
+        subnet = dataset.top_level()
+        subnets = []
+        return (lambda: subnets.append(ipam.add_next_subnet(
+                    subnet, LEAF_PREFIXLEN, 'bench')),
+                lambda: subnets and ipam.delete_subnet(subnets[0]))
+
+    def add_subnet():
+        (parent, subnet) = free_subnet()
+        return (lambda: ipam.add_subnet(subnet, parent, 'bench'),
+                lambda: ipam.delete_subnet(subnet))
+
+    def add_top_level_subnet():
+        subnet = dataset.top_level_subnet()
+        return (lambda: ipam.add_top_level_subnet(subnet, 'bench'),
+                lambda: ipam.delete_subnet(subnet))
+
+    def edit_ip(method, getter):
+        def setup():
+            ip = dataset.interface()
+            value = getattr(ipam, getter)(ip.ip)
+            return (lambda: getattr(ipam, method)(ip, 'bench'),
+                    lambda: getattr(ipam, method)(ip, value))
+        return setup
+
+    def delete_ip():
+        ip = ipam.add_next_ip(dataset.leaf(), 'bench', 'bench')
+        return (lambda: ipam.delete_ip(ip), None)
+
+    def delete_subnet():
+        subnet = ipam.add_next_subnet(dataset.top_level(), LEAF_PREFIXLEN,
+                                      'bench')
+        return (lambda: ipam.delete_subnet(subnet), None)
+
+    return [
+        ('find_subnet_id', lambda: call('find_subnet_id', dataset.leaf())()),
+        ('get_ip', lambda: call('get_ip', dataset.ip())()),
+        ('get_ips (1000)', lambda: call(
+            'get_ips', [dataset.ip() for _ in range(1000)])()),
+        ('get_hostname_by_ip', lambda: call('get_hostname_by_ip',
+                                            dataset.ip())()),
+        ('get_description_by_ip', lambda: call('get_description_by_ip',
+                                               dataset.ip())()),
+        ('get_mac_by_ip', lambda: call('get_mac_by_ip', dataset.ip())()),
+        ('get_subnet', lambda: call('get_subnet', dataset.leaf())()),
+        ('get_subnet_by_id', lambda: call('get_subnet_by_id',
+                                          dataset.subnet_id())()),
+        ('get_subnet_with_ips', lambda: call('get_subnet_with_ips',
+                                             dataset.leaf())()),
+        ('get_children_subnet_list', lambda: call('get_children_subnet_list',
+                                                  dataset.container())()),
+        ('get_next_free_ip', lambda: call('get_next_free_ip',
+                                          dataset.leaf())()),
+        ('get_subnet_tree', lambda: call('get_subnet_tree')()),
+        ('get_section_utilization',
+         lambda: call('get_section_utilization')()),
+        ('get_ip_list_by_desc', lambda: call('get_ip_list_by_desc',
+                                             dataset.description())()),
+        ('get_ip_interface_list_by_desc (LIKE prefix)', lambda: call(
+            'get_ip_interface_list_by_desc',
+            dataset.description()[:-1] + '%')()),
+        ('get_ip_list_by_mac (LIKE prefix)', lambda: call(
+            'get_ip_list_by_mac', '52:54:00:00:00:%')()),
+        ('get_num_ips_by_desc', lambda: call('get_num_ips_by_desc',
+                                             'bench host 1%')()),
+        ('get_ip_by_desc_and_subnet', lambda: call(
+            'get_ip_by_desc_and_subnet', *dataset.description_and_subnet())()),
+        ('get_ip_interface_list_by_subnet_name', lambda: call(
+            'get_ip_interface_list_by_subnet_name',
+            dataset.subnet_description())()),
+        ('get_subnet_list_by_desc (LIKE prefix)', lambda: call(
+            'get_subnet_list_by_desc', 'bench subnet 10.0.1%')()),
+        ('get_num_subnets_by_desc', lambda: call('get_num_subnets_by_desc',
+                                                 'bench subnet 10.0.1%')()),
+        ('add_ip', add_ip),
+        ('add_next_ip', add_next_ip),
+        ('add_next_ips ({})'.format(NEXT_IPS_COUNT), add_next_ips),
+        ('add_next_subnet', add_next_subnet),
+        ('add_subnet', add_subnet),
+        ('add_top_level_subnet', add_top_level_subnet),
+        ('edit_ip_description', edit_ip('edit_ip_description',
+                                        'get_description_by_ip')),
+        ('edit_ip_hostname', edit_ip('edit_ip_hostname',
+                                     'get_hostname_by_ip')),
+        ('edit_ip_mac', edit_ip('edit_ip_mac', 'get_mac_by_ip')),
+        ('delete_ip', delete_ip),
+        ('delete_subnet', delete_subnet),
+    ]
+
+
+def percentile(sorted_values, percent):
+    index = int(round(percent / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def run_scenario(setup, iterations):
+    durations = []
+    for _ in range(iterations):
+        (function, cleanup) = setup()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+        if cleanup:
+            cleanup()
+
+    (function, cleanup) = setup()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    if cleanup:
+        cleanup()
+
+    durations.sort()
+    result = dict(('p{}'.format(percent),
+                   percentile(durations, percent) * 1000)
+                  for percent in PERCENTILES)
+    result['max'] = durations[-1] * 1000
+    result['peak_memory_kb'] = peak / 1024.0
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('path', help='database written by generate_dataset')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--only', help='only run methods containing this')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    ipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                    'database_uri': args.path})
+    dataset = Dataset(args.path, args.seed)
+
+    results = {}
+    for (name, setup) in get_scenarios(ipam, dataset):
+        if args.only and args.only not in name:
+            continue
+        results[name] = run_scenario(setup, args.iterations)
+        if not args.json:
+            print('{:<45} '.format(name) + '  '.join(
+                '{}={:9.3f}ms'.format(key, results[name][key])
+                for key in ['p{}'.format(p) for p in PERCENTILES] + ['max']) +
+                '  peak={:9.1f}KB'.format(results[name]['peak_memory_kb']))
+            sys.stdout.flush()
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic phpIPAM SQLite database for benchmarks.
+
+The schema is the one of the test fixtures. Each section gets a top-level
+IPv4 /8 subnet, split into `depth` levels of container subnets, whose
+leaves are /24 subnets filled with addresses. A few addresses are left
+out of each leaf so that free address lookups have gaps to find.
+
+Usage:
+    python benchmarks/generate_dataset.py bench.db --subnets 10000 \
+        --ips 2000000 --depth 3
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import random
+import sqlite3
+import time
+from ipaddress import ip_network
+
+SCHEMA_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', 'ipam', 'client',
+    'tests', 'data', 'db-recent-version.sql')
+
+PERMISSIONS = '{"2":"1","3":"1"}'
+LEAF_PREFIXLEN = 24
+HOSTS_PER_LEAF = 254
+
+
+def create_schema(conn):
+    """
+    Create the phpIPAM tables with the settings, sections and VLAN of the
+    test fixtures, without any subnet or address
+    """
+    with open(SCHEMA_FILE) as f:
+        conn.executescript(f.read())
+    conn.execute('DELETE FROM ipaddresses')
+    conn.execute('DELETE FROM subnets')
+    conn.commit()
+
+
+def _get_fanout(leaves, depth):
+    """
+    Return the smallest power of two fanout giving at least `leaves`
+    subnets after `depth` levels of containers.
+    """
+    bits = 0
+    while 2 ** (bits * (depth + 1)) < leaves:
+        bits += 1
+    return bits
+
+
+def generate(path, sections=1, subnets=1000, ips=100000, depth=2,
+             hole_ratio=0.01, seed=42):
+    """
+    Write a database with `subnets` leaf subnets and about `ips` addresses
+    per section, in `sections` sections (the first one being Production).
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    rand = random.Random(seed)
+    conn = sqlite3.connect(path)
+    create_schema(conn)
+
+    section_ids = [row[0] for row in conn.execute(
+        'SELECT id FROM sections ORDER BY id')]
+    if sections > len(section_ids):
+        for i in range(len(section_ids), sections):
+            section_id = max(section_ids) + 1
+            conn.execute("INSERT INTO sections (id, name, description) "
+                         "VALUES (?, ?, '')",
+                         (section_id, 'Bench {}'.format(i)))
+            section_ids.append(section_id)
+    # Production first: the benchmarks run against it
+    section_ids = sorted(section_ids, key=lambda section_id: section_id != 2)
+
+    bits = _get_fanout(subnets, depth)
+    if LEAF_PREFIXLEN - bits * (depth + 1) < 8:
+        raise ValueError('Too many subnets to fit in a /8')
+    ips_per_leaf = min(HOSTS_PER_LEAF, max(1, ips // subnets))
+
+    subnet_id = 0
+    ip_id = 0
+    for (index, section_id) in enumerate(section_ids[:sections]):
+        top_level = ip_network('{}.0.0.0/8'.format(10 + index))
+        subnet_id += 1
+        conn.execute(
+            'INSERT INTO subnets (id, subnet, mask, sectionId, description, '
+            'masterSubnetId, vlanId, permissions) '
+            'VALUES (?, ?, ?, ?, ?, 0, 10, ?)',
+            (subnet_id, str(int(top_level.network_address)), '8', section_id,
+             'bench top level {}'.format(index), PERMISSIONS))
+
+        parents = [(subnet_id, top_level)]
+        for level in range(depth + 1):
+            prefixlen = LEAF_PREFIXLEN - bits * (depth - level)
+            # Only create the containers needed to hold `subnets` leaves
+            leaves_per_child = 2 ** (bits * (depth - level))
+            needed = (subnets + leaves_per_child - 1) // leaves_per_child
+            children = []
+            for (parent_id, parent) in parents:
+                for child in parent.subnets(new_prefix=prefixlen):
+                    if len(children) >= needed:
+                        break
+                    subnet_id += 1
+                    conn.execute(
+                        'INSERT INTO subnets (id, subnet, mask, sectionId, '
+                        'description, masterSubnetId, vlanId, permissions) '
+                        'VALUES (?, ?, ?, ?, ?, ?, 10, ?)',
+                        (subnet_id, str(int(child.network_address)),
+                         str(prefixlen), section_id,
+                         'bench subnet {}'.format(child), parent_id,
+                         PERMISSIONS))
+                    children.append((subnet_id, child))
+            parents = children
+        leaves = parents
+
+        rows = []
+        for (leaf_id, leaf) in leaves:
+            first = int(leaf.network_address) + 1
+            for offset in range(ips_per_leaf):
+                if rand.random() < hole_ratio:
+                    continue
+                ip_id += 1
+                rows.append((
+                    ip_id, leaf_id, str(first + offset),
+                    'bench host {}'.format(ip_id), 'host-{}'.format(ip_id),
+                    '52:54:{:02x}:{:02x}:{:02x}:{:02x}'.format(
+                        ip_id >> 24 & 255, ip_id >> 16 & 255,
+                        ip_id >> 8 & 255, ip_id & 255)))
+            if len(rows) > 100000:
+                _insert_ips(conn, rows)
+                rows = []
+        _insert_ips(conn, rows)
+
+    conn.commit()
+    conn.close()
+    return {'subnets': subnet_id, 'ips': ip_id}
+
+
+def _insert_ips(conn, rows):
+    conn.executemany(
+        'INSERT INTO ipaddresses (id, subnetId, ip_addr, description, '
+        "hostname, mac, state) VALUES (?, ?, ?, ?, ?, ?, '2')", rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('path', help='SQLite database file to write')
+    parser.add_argument('--sections', type=int, default=1)
+    parser.add_argument('--subnets', type=int, default=1000,
+                        help='leaf subnets per section')
+    parser.add_argument('--ips', type=int, default=100000,
+                        help='addresses per section')
+    parser.add_argument('--depth', type=int, default=2,
+                        help='levels of container subnets')
+    parser.add_argument('--hole-ratio', type=float, default=0.01,
+                        help='ratio of addresses left free in leaves')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    start = time.time()
+    counts = generate(args.path, args.sections, args.subnets, args.ips,
+                      args.depth, args.hole_ratio, args.seed)
+    print('Generated {subnets} subnets and {ips} addresses'.format(**counts),
+          'in {:.1f}s'.format(time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,6 +14,10 @@ class AbstractIPAM:
     def add_next_ip(self, subnet, dnsname, description, mac=None, allow_duplicates=True):
         raise NotImplementedError()
 
+    @abstractmethod
+    def add_next_ips(self, subnet, count, hostnames, descriptions, macs=None):
+        raise NotImplementedError()
+
     @abstractmethod
     def get_next_free_ip(self, subnet):
         raise NotImplementedError()
@@ -50,6 +54,22 @@ class AbstractIPAM:
     def get_mac_by_ip(self, ip):
         raise NotImplementedError()
 
+    @abstractmethod
+    def get_ips(self, ips):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_hostnames_by_ips(self, ips):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_descriptions_by_ips(self, ips):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def get_macs_by_ips(self, ips):
+        raise NotImplementedError()
+
     @abstractmethod
     def get_ip_interface_list_by_desc(self, description):
         raise NotImplementedError()
@@ -0,0 +1,365 @@
+"""
+Audit of the addresses and subnets of a phpIPAM section.
+
+audit_section finds:
+- addresses allocated several times, in the same subnet or not,
+- MAC addresses shared by several addresses,
+- addresses outside the range of their subnet, or in folders,
+- addresses whose subnet doesn't exist anymore,
+- sibling subnets overlapping each other.
+
+Subnets are loaded at once with get_subnet_tree, and overlapping siblings
+found by sweeping the sorted children of each subnet. Addresses are read
+with sort-merge passes: the database streams them sorted by integer
+address, or by normalized MAC address, and duplicates are neighbours in
+the stream. Top-level subnets are grouped into clusters of overlapping
+ones, which can't share any address, and the address passes of clusters
+are spread across a pool of processes, each with its own connection.
+Clusters of IPv4 and IPv6 subnets are never audited together, as their
+addresses can have the same integer values. Duplicates of addresses
+outside their subnet are not looked for: they are reported as outside.
+
+Usage:
+    IPAM_PASSWORD=secret python -m ipam.client.audit --dbtype mysql \
+        --host db --username ipam --database phpipam [--processes 8]
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+
+from ipam.client.backends.phpipam import IN_QUERY_CHUNK_SIZE, PHPIPAM
+from ipaddress import IPv6Address, ip_address
+
+# Subnets whose addresses are audited by a single task, at least
+AUDIT_TASK_SIZE = 1000
+
+# Characters removed from MAC addresses before comparing them
+MAC_SEPARATORS = (':', '-', '.')
+
+_MAC_SEPARATOR_RE = re.compile('[{}]'.format(
+    ''.join(re.escape(separator) for separator in MAC_SEPARATORS)))
+
+
+def _normalize_mac(mac):
+    return _MAC_SEPARATOR_RE.sub('', mac.lower())
+
+
+def _normalized_mac_sql(column):
+    for separator in MAC_SEPARATORS:
+        column = "REPLACE({}, '{}', '')".format(column, separator)
+    return 'LOWER({})'.format(column)
+
+
+def _groups(rows, key):
+    """
+    Yield the lists of more than one consecutive rows with the same key
+    """
+    group = []
+    for row in rows:
+        if group and key(group[0]) != key(row):
+            if len(group) > 1:
+                yield group
+            group = []
+        group.append(row)
+    if len(group) > 1:
+        yield group
+
+
+def _audit_addresses(ipam, section_id, ranges):
+    """
+    Return the (id, subnet id, address) rows allocated several times,
+    grouped by address, and those outside their subnet, among the
+    addresses of the subnets of ranges, a {subnet id: (IP version, first
+    address, last address)} dict holding None for folders. Subnets of
+    ranges must all be of the same IP version, or folders.
+    """
+    if len(ranges) <= IN_QUERY_CHUNK_SIZE:
+        condition = 'subnetId IN ({})'.format(
+            ', '.join('%d' % subnet_id for subnet_id in sorted(ranges)))
+    else:
+        # Too many subnets for a single IN list: the addresses of the
+        # section are read, and those of other subnets skipped
+        condition = ('subnetId IN (SELECT id FROM subnets '
+                     'WHERE sectionId = %d)' % section_id)
+    rows = ipam._iter_rows(
+        'SELECT id, subnetId, ip_addr FROM ipaddresses WHERE {} '
+        # Decimal strings without leading zeros sort as their integers
+        'ORDER BY LENGTH(ip_addr), ip_addr'.format(condition),
+        method='audit_section')
+    outside = []
+
+    def in_range():
+        for row in rows:
+            row = (int(row[0]), int(row[1]), int(row[2]))
+            if row[1] not in ranges:
+                continue
+            bounds = ranges[row[1]]
+            if bounds is None or not bounds[1] <= row[2] <= bounds[2]:
+                outside.append(row)
+            else:
+                yield row + (bounds[0],)
+
+    duplicates = [[row[:3] for row in group] for group in _groups(
+        in_range(), key=lambda row: (row[3], row[2]))]
+    return duplicates, outside
+
+
+def _audit_macs(ipam, section_id):
+    """
+    Return the (id, subnet id, address, MAC) rows of the section sharing
+    their MAC address, grouped by normalized MAC address
+    """
+    rows = ipam._iter_rows(
+        "SELECT id, subnetId, ip_addr, mac FROM ipaddresses "
+        "WHERE subnetId IN (SELECT id FROM subnets WHERE sectionId = %d) "
+        "AND mac IS NOT NULL AND mac <> '' ORDER BY %s"
+        % (section_id, _normalized_mac_sql('mac')),
+        method='audit_section')
+    rows = ((int(row[0]), int(row[1]), int(row[2]), row[3]) for row in rows)
+    return list(_groups(rows, key=lambda row: _normalize_mac(row[3])))
+
+
+def _audit_orphans(ipam):
+    """
+    Return the (id, subnet id, address) rows of the addresses whose subnet
+    doesn't exist, in any section
+    """
+    rows = ipam._iter_rows(
+        'SELECT ip.id, ip.subnetId, ip.ip_addr FROM ipaddresses ip '
+        'LEFT JOIN subnets s ON ip.subnetId = s.id WHERE s.id IS NULL '
+        'ORDER BY ip.id',
+        method='audit_section')
+    return [(int(row[0]), int(row[1]), int(row[2])) for row in rows]
+
+
+def _run_task(task):
+    (function, params, args) = task
+    # Lazy, as the task needs neither the section nor the schema version
+    ipam = PHPIPAM(dict(params, lazy=True))
+    try:
+        return function(ipam, *args)
+    finally:
+        ipam.close()
+
+
+def _top_level_subnets(tree):
+    """
+    Return the nodes of tree whose ancestors are all folders, and the
+    folders above them
+    """
+    subnets = []
+    folders = []
+    stack = list(tree.roots)
+    while stack:
+        node = stack.pop()
+        if node.network is None:
+            folders.append(node)
+            stack.extend(node.children)
+        else:
+            subnets.append(node)
+    return subnets, folders
+
+
+def _clusters(nodes):
+    """
+    Return the lists of overlapping nodes of nodes, sorted by network
+    """
+    clusters = []
+    last = None
+    for node in sorted(nodes, key=lambda node: (
+            node.network.version, node.network.network_address)):
+        network = node.network
+        if (last is None or last.version != network.version or
+                network.network_address > last.broadcast_address):
+            clusters.append([])
+        if (last is None or last.version != network.version or
+                network.broadcast_address > last.broadcast_address):
+            last = network
+        clusters[-1].append(node)
+    return clusters
+
+
+def _address_tasks(tree, task_size):
+    """
+    Return the ranges of the subnets audited by each task. Clusters of
+    top-level subnets of the same IP version are packed until task_size
+    subnets, without exceeding IN_QUERY_CHUNK_SIZE subnets unless a
+    single cluster does.
+    """
+    (subnets, folders) = _top_level_subnets(tree)
+    folder_ids = [folder.id for folder in folders]
+    # All the addresses of folders are outside: they can be split freely
+    tasks = [dict((folder_id, None) for folder_id in
+                  folder_ids[i:i + IN_QUERY_CHUNK_SIZE])
+             for i in range(0, len(folder_ids), IN_QUERY_CHUNK_SIZE)]
+    ranges = {}
+    version = None
+    for cluster in _clusters(subnets):
+        cluster_ranges = {}
+        for top_level in cluster:
+            for node in top_level.walk():
+                if node.network is None:
+                    cluster_ranges[node.id] = None
+                else:
+                    cluster_ranges[node.id] = (
+                        node.network.version,
+                        int(node.network.network_address),
+                        int(node.network.broadcast_address))
+        if ranges and (cluster[0].network.version != version or
+                       len(ranges) + len(cluster_ranges) >
+                       IN_QUERY_CHUNK_SIZE):
+            tasks.append(ranges)
+            ranges = {}
+        ranges.update(cluster_ranges)
+        version = cluster[0].network.version
+        if len(ranges) >= task_size:
+            tasks.append(ranges)
+            ranges = {}
+    if ranges:
+        tasks.append(ranges)
+    return tasks
+
+
+def _overlapping_siblings(tree):
+    """
+    Return (network, network) pairs of overlapping sibling subnets. Each
+    subnet overlapping previous siblings is paired with the one reaching
+    the furthest.
+    """
+    found = []
+    for siblings in [tree.roots] + [node.children for node in tree]:
+        last = None
+        for node in siblings:
+            network = node.network
+            if network is None:
+                continue
+            if (last is not None and last.version == network.version and
+                    network.network_address <= last.broadcast_address):
+                found.append((last, network))
+            if (last is None or last.version != network.version or
+                    network.broadcast_address > last.broadcast_address):
+                last = network
+    return found
+
+
+def _address_item(tree, row):
+    node = tree.get_by_id(row[1])
+    network = None if node is None else node.network
+    if network is not None and network.version == 6:
+        ip = IPv6Address(row[2])
+    else:
+        ip = ip_address(row[2])
+    return {
+        'id': row[0],
+        'ip': ip,
+        'subnet': network,
+    }
+
+
+def audit_section(ipam, processes=None, task_size=AUDIT_TASK_SIZE):
+    """
+    Audit the section of ipam, with processes worker processes, as many
+    as CPUs by default, or in the calling process when processes is 1.
+    Returns a dict of anomalies:
+    - duplicate_ips: lists of addresses allocated several times,
+    - duplicate_macs: lists of addresses sharing their MAC address,
+    - outside: addresses outside their subnet,
+    - orphans: addresses whose subnet doesn't exist, in any section, with
+      their subnet_id,
+    - overlaps: (network, network) pairs of overlapping sibling subnets.
+    Addresses are dicts of their id, ip and subnet network.
+    """
+    tree = ipam.get_subnet_tree()
+    tasks = [(_audit_macs, ipam.params, (ipam.section_id,)),
+             (_audit_orphans, ipam.params, ())]
+    tasks.extend((_audit_addresses, ipam.params, (ipam.section_id, ranges))
+                 for ranges in _address_tasks(tree, task_size))
+
+    if processes == 1:
+        results = [function(ipam, *args) for (function, _, args) in tasks]
+    else:
+        # Measures of the workers can't be reported to the sink
+        params = dict((key, value) for (key, value) in ipam.params.items()
+                      if key != 'metrics')
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_run_task, [
+                (function, params, args) for (function, _, args) in tasks],
+                chunksize=1)
+        except Exception:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+
+    report = {
+        'duplicate_ips': [],
+        'duplicate_macs': [],
+        'outside': [],
+        'orphans': [dict(_address_item(tree, row), subnet_id=row[1])
+                    for row in results[1]],
+        'overlaps': _overlapping_siblings(tree),
+    }
+    for group in results[0]:
+        items = []
+        for row in group:
+            item = _address_item(tree, row)
+            item['mac'] = row[3]
+            items.append(item)
+        report['duplicate_macs'].append(items)
+    for (duplicates, outside) in results[2:]:
+        report['duplicate_ips'].extend(
+            [_address_item(tree, row) for row in group]
+            for group in duplicates)
+        report['outside'].extend(_address_item(tree, row) for row in outside)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--dbtype', choices=('sqlite', 'mysql'),
+                        default='mysql')
+    parser.add_argument('--database-uri', help='SQLite database file')
+    parser.add_argument('--host')
+    parser.add_argument('--username')
+    parser.add_argument('--database', help='MySQL database name')
+    parser.add_argument('--section', default='Production')
+    parser.add_argument('--processes', type=int,
+                        help='worker processes, as many as CPUs by default')
+    args = parser.parse_args()
+
+    ipam = PHPIPAM({
+        'dbtype': args.dbtype,
+        'database_uri': args.database_uri,
+        'database_host': args.host,
+        'username': args.username,
+        'password': os.environ.get('IPAM_PASSWORD', ''),
+        'database_name': args.database,
+        'section_name': args.section,
+    })
+    report = audit_section(ipam, args.processes)
+    for group in report['duplicate_ips']:
+        print('DUPLICATE IP {}: {}'.format(group[0]['ip'], ', '.join(
+            '{} (id {})'.format(item['subnet'], item['id'])
+            for item in group)))
+    for group in report['duplicate_macs']:
+        print('DUPLICATE MAC {}: {}'.format(group[0]['mac'], ', '.join(
+            '{} (id {})'.format(item['ip'], item['id']) for item in group)))
+    for item in report['outside']:
+        print('OUTSIDE {} (id {}): {}'.format(
+            item['ip'], item['id'], item['subnet'] or 'folder'))
+    for item in report['orphans']:
+        print('ORPHAN {} (id {}): missing subnet id {}'.format(
+            item['ip'], item['id'], item['subnet_id']))
+    for (network, overlapping) in report['overlaps']:
+        print('OVERLAP {}: {}'.format(network, overlapping))
+    return 1 if any(report.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+asyncio client on top of pooled PHPIPAM. Unlike the rest of the package,
+this module requires Python 3.7 or later.
+"""
+from __future__ import unicode_literals
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from ipam.client.abstractipam import AbstractIPAM
+from ipam.client.backends.phpipam import PHPIPAM
+
+DEFAULT_ASYNC_POOL_SIZE = 8
+
+# PHPIPAM methods exposed on top of the AbstractIPAM ones
+EXTRA_METHODS = (
+    'delete_ip',
+    'delete_ips',
+    'edit_ip_description',
+    'edit_ip_hostname',
+    'edit_ip_mac',
+    'edit_ips',
+    'edit_subnet_description',
+    'find_subnet_id',
+    'get_allocated_ips_by_subnet_id',
+    'get_children_subnet_list',
+    'get_section_utilization',
+    'get_subnet_by_id',
+    'get_subnet_containing',
+    'get_subnet_tree',
+    'import_ips',
+    'import_subnets',
+    'refresh_subnet_trie',
+)
+
+
+def _async_method(name):
+    async def method(self, *args, **kwargs):
+        return await self._run(getattr(self.ipam, name), *args, **kwargs)
+    method.__name__ = str(name)
+    method.__doc__ = 'Coroutine version of PHPIPAM.{}'.format(name)
+    return method
+
+
+class AsyncPHPIPAM(object):
+    """
+    asyncio flavour of PHPIPAM. Each method of the AbstractIPAM surface is
+    a coroutine that runs the blocking PHPIPAM call in a thread
+    pool on its own pooled connection, so lookups can run concurrently.
+    Writes keep the MySQLLock semantics of PHPIPAM.
+    """
+
+    def __init__(self, params, executor=None):
+        params = dict(params)
+        params.setdefault('pool_size', DEFAULT_ASYNC_POOL_SIZE)
+        self.ipam = PHPIPAM(params)
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=int(params['pool_size']))
+        self.executor = executor
+
+    def _run(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return loop.run_in_executor(
+            self.executor, partial(function, *args, **kwargs))
+
+    def close(self):
+        if self._own_executor:
+            self.executor.shutdown(wait=True)
+        # Connections are idle once the executor is shut down
+        self.ipam.close()
+
+
+ABSTRACT_METHODS = tuple(sorted(
+    name for (name, value) in vars(AbstractIPAM).items()
+    if getattr(value, '__isabstractmethod__', False)))
+
+for _name in ABSTRACT_METHODS + EXTRA_METHODS:
+    setattr(AsyncPHPIPAM, _name, _async_method(_name))
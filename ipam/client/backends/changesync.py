@@ -0,0 +1,224 @@
+"""
+Incremental sync of phpIPAM tables into local stores.
+
+ChangeSync keeps a SyncStore, such as the SQLite mirror or an in-memory
+index, up to date with the section of a PHPIPAM instance without reloading
+it. Tables with an editDate column are synced from their high-water marks:
+rows with an id above the highest local one were inserted, rows with an
+edit date at or after the latest local one were edited. phpIPAM keeps no
+trace of deleted rows, so they are found by comparing the row counts and
+id sums of ranges of ids on both sides, only listing the ids of the ranges
+that differ. Tables without edit dates are small, and copied entirely.
+"""
+from __future__ import unicode_literals
+from abc import ABCMeta, abstractmethod
+from datetime import datetime, timedelta
+
+# Seconds of edits read again before the latest local edit date, for
+# transactions committed after later ones
+SYNC_OVERLAP = 60
+# Ids per checksum range
+CHECKSUM_RANGE_SIZE = 10000
+# Rows fetched at once from the source database
+SYNC_BATCH_SIZE = 10000
+# Ids per IN (...) query
+SYNC_IN_QUERY_SIZE = 1000
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def format_date(value):
+    """
+    Return a database date as a string, as stored by SQLite
+    """
+    if hasattr(value, 'strftime'):
+        return value.strftime(DATE_FORMAT)
+    return value
+
+
+def _date_before(value, seconds):
+    try:
+        date = datetime.strptime(format_date(value)[:19], DATE_FORMAT)
+    except ValueError:
+        # phpIPAM zero dates
+        return value
+    return (date - timedelta(seconds=seconds)).strftime(DATE_FORMAT)
+
+
+def _where(condition, clause):
+    if condition:
+        return '{} AND ({})'.format(condition, clause)
+    return 'WHERE {}'.format(clause)
+
+
+# Abstract base of both Python 2 and 3, where __metaclass__ is ignored
+class SyncStore(ABCMeta(str('SyncStoreBase'), (object,), {})):
+    """
+    Local copy of the tables synced by ChangeSync. Changes are applied
+    between begin and commit, or rollback on errors. Stores missing one of
+    the abstract methods can't be instantiated.
+    """
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    @abstractmethod
+    def high_water_marks(self, table):
+        """
+        Return the highest id and edit date of the rows of table
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def checksums(self, table, range_size):
+        """
+        Return the (row count, id sum) of each range of range_size ids of
+        table, by range index
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def ids(self, table, first_id, last_id):
+        """
+        Return the set of ids of table from first_id to last_id excluded
+        """
+        raise NotImplementedError()
+
+    @abstractmethod
+    def upsert(self, table, columns, rows):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def delete(self, table, ids):
+        raise NotImplementedError()
+
+    @abstractmethod
+    def replace(self, table, columns, rows):
+        """
+        Replace all the rows of table
+        """
+        raise NotImplementedError()
+
+
+class ChangeSync(object):
+    """
+    Sync of the tables of the section of ipam into store. tables holds
+    (table, columns, source condition) tuples, as MIRROR_TABLES.
+    """
+    def __init__(self, ipam, store, tables, overlap=SYNC_OVERLAP,
+                 range_size=CHECKSUM_RANGE_SIZE, batch_size=SYNC_BATCH_SIZE):
+        self.ipam = ipam
+        self.store = store
+        self.tables = tables
+        self.overlap = overlap
+        self.range_size = range_size
+        self.batch_size = batch_size
+
+    def sync(self, checksum=False):
+        """
+        Apply the rows changed since the last sync to the store, and when
+        checksum is set, the deletes and missed inserts found by comparing
+        checksums of id ranges.
+        Returns the number of upserted and deleted rows per table.
+        """
+        counts = {}
+        with self.ipam.read_connection():
+            self.store.begin()
+            try:
+                for (table, columns, condition) in self.tables:
+                    names = [name.format(hostname=self.ipam.hostname_db_field)
+                             for (name, _) in columns]
+                    condition = condition.format(section=self.ipam.section_id)
+                    if 'editDate' in names:
+                        counts[table] = self._sync_table(table, names,
+                                                         condition, checksum)
+                    else:
+                        rows = self._fetch(table, names, condition)
+                        self.store.replace(table, names, rows)
+                        counts[table] = {'upserted': len(rows), 'deleted': 0}
+                self.store.commit()
+            except Exception:
+                self.store.rollback()
+                raise
+        return counts
+
+    def _fetch(self, table, names, condition):
+        self.ipam.cur.execute('SELECT {} FROM {} {}'.format(
+            ', '.join(names), table, condition))
+        rows = []
+        while True:
+            batch = self.ipam.cur.fetchmany(self.batch_size)
+            if not batch:
+                return rows
+            rows.extend(tuple(format_date(value) for value in row)
+                        for row in batch)
+
+    def _fetch_ids(self, table, names, condition, ids):
+        ids = sorted(ids)
+        rows = []
+        for start in range(0, len(ids), SYNC_IN_QUERY_SIZE):
+            rows.extend(self._fetch(table, names, _where(
+                condition, 'id IN ({})'.format(', '.join(
+                    '%d' % row_id
+                    for row_id in ids[start:start + SYNC_IN_QUERY_SIZE])))))
+        return rows
+
+    def _sync_table(self, table, names, condition, checksum):
+        (max_id, max_edit_date) = self.store.high_water_marks(table)
+        clauses = ['id > %d' % (max_id or 0)]
+        if max_edit_date is not None:
+            clauses.append("editDate >= '{}'".format(
+                _date_before(max_edit_date, self.overlap)))
+        else:
+            # No row was edited yet
+            clauses.append('editDate IS NOT NULL')
+        rows = self._fetch(table, names,
+                           _where(condition, ' OR '.join(clauses)))
+        self.store.upsert(table, names, rows)
+        counts = {'upserted': len(rows), 'deleted': 0}
+        if checksum:
+            (upserted, deleted) = self._repair_table(table, names, condition)
+            counts['upserted'] += upserted
+            counts['deleted'] += deleted
+        return counts
+
+    def _checksums(self, table, condition):
+        if self.ipam.dbtype == 'mysql':
+            range_index = 'id DIV %d' % self.range_size
+        else:
+            range_index = 'id / %d' % self.range_size
+        self.ipam.cur.execute('SELECT {}, COUNT(*), SUM(id) FROM {} {} '
+                              'GROUP BY 1'.format(range_index, table,
+                                                  condition))
+        return dict((int(row[0]), (int(row[1]), int(row[2])))
+                    for row in self.ipam.cur.fetchall())
+
+    def _repair_table(self, table, names, condition):
+        remote = self._checksums(table, condition)
+        local = self.store.checksums(table, self.range_size)
+        upserted = 0
+        deleted = 0
+        for index in sorted(set(remote) | set(local)):
+            if remote.get(index) == local.get(index):
+                continue
+            first_id = index * self.range_size
+            last_id = first_id + self.range_size
+            self.ipam.cur.execute('SELECT id FROM {} {}'.format(
+                table, _where(condition, 'id >= %d AND id < %d'
+                              % (first_id, last_id))))
+            remote_ids = set(int(row[0]) for row in self.ipam.cur.fetchall())
+            local_ids = self.store.ids(table, first_id, last_id)
+            if local_ids - remote_ids:
+                self.store.delete(table, local_ids - remote_ids)
+                deleted += len(local_ids - remote_ids)
+            if remote_ids - local_ids:
+                rows = self._fetch_ids(table, names, condition,
+                                       remote_ids - local_ids)
+                self.store.upsert(table, names, rows)
+                upserted += len(rows)
+        return upserted, deleted
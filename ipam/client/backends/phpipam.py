@@ -1,9 +1,29 @@
 from __future__ import unicode_literals
-import mysql.connector
+import json
+import logging
+import os
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import partial, wraps
+from itertools import cycle, islice
+from ipam.client import records
 from ipam.client.abstractipam import AbstractIPAM
 from ipaddress import ip_address, ip_interface, ip_network
 
+try:
+    from queue import Empty, LifoQueue
+except ImportError:
+    from Queue import Empty, LifoQueue
+
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
 DEFAULT_IPAM_DB_TYPE = 'mysql'
 
 DEFAULT_SUBNET_OPTIONS = {
@@ -15,44 +35,629 @@ DEFAULT_SUBNET_OPTIONS = {
 
 LOCK_NAME = 'ipam_client_lock'
 LOCK_TIMEOUT = 5
+# Lowest MySQL and MariaDB versions holding several named locks at once
+MYSQL_MULTIPLE_LOCKS_VERSION = (5, 7, 5)
+MARIADB_MULTIPLE_LOCKS_VERSION = (10, 0, 2)
+
+POOL_TIMEOUT = 5
+
+SUBNET_ID_CACHE_TTL = 60
+
+SUBNET_TRIE_TTL = 60
+
+FETCH_SIZE = 1000
+
+# Maximum number of addresses per IN (...) clause of batch lookups
+IN_QUERY_CHUNK_SIZE = 1000
+
+# Number of rows inserted per transaction by bulk imports
+IMPORT_CHUNK_SIZE = 1000
+
+# Conflicts tolerated by optimistic allocations before locking
+OPTIMISTIC_RETRIES = 10
+
+# Seconds during which reads stay on the primary after a write
+READ_YOUR_WRITES_WINDOW = 5
+
+# Seconds during which probe cache entries are used
+PROBE_CACHE_TTL = 3600
+
+# time.monotonic is not available on Python 2
+monotonic = getattr(time, 'monotonic', time.time)
+
+logger = logging.getLogger(__name__)
+
+
+def _holds_multiple_named_locks(version):
+    """
+    Tell whether a MySQL server of the given VERSION() holds several named
+    locks at once. Older ones release the held lock on each GET_LOCK.
+    """
+    versions = re.findall(r'(\d+)\.(\d+)\.(\d+)', version)
+    if not versions:
+        return False
+    if 'mariadb' in version.lower():
+        # Some MariaDB servers report 5.5.5-<version>-MariaDB
+        numbers = tuple(int(number) for number in versions[-1])
+        return numbers >= MARIADB_MULTIPLE_LOCKS_VERSION
+    numbers = tuple(int(number) for number in versions[0])
+    return numbers >= MYSQL_MULTIPLE_LOCKS_VERSION
+
+
+def _mysql_connector():
+    """
+    Import the MySQL driver on first use, sparing SQLite clients its import
+    """
+    import mysql.connector
+    return mysql.connector
+
+
+def _bind_connection(method, read):
+    @wraps(method)
+    def wrapper(ipam, *args, **kwargs):
+        if read:
+            connection = ipam.read_connection
+        else:
+            connection = ipam.connection
+        if not ipam.instrumented or hasattr(ipam._local, 'call'):
+            with connection():
+                return method(ipam, *args, **kwargs)
+        with ipam._instrumented_call(method.__name__):
+            with connection():
+                try:
+                    return method(ipam, *args, **kwargs)
+                finally:
+                    # Report the last query before the call itself
+                    ipam.cur.flush()
+    return wrapper
+
+
+def with_connection(method):
+    """
+    Run a PHPIPAM method with a database connection bound to the calling
+    thread, checked out from the connection pool when there is one. When
+    the instance is instrumented, the outermost call is measured.
+    """
+    return _bind_connection(method, read=False)
+
+
+def with_read_connection(method):
+    """
+    Same as with_connection for read-only methods, which run on a replica
+    when they are not called from another method and read_connection
+    allows it.
+    """
+    return _bind_connection(method, read=True)
+
+
+class MetricsSink(object):
+    """
+    Receiver of PHPIPAM measures, passed as the metrics parameter. Methods
+    are called synchronously in the thread of the call, and must be cheap.
+
+    on_query is called for each query, with the name of the outermost
+    PHPIPAM method running it (None outside of any), the first SQL
+    keyword, the number of rows read or written and the duration of the
+    query and of its row fetches. on_call is called at the end of each
+    outermost method call, with its number of queries, its duration and
+    the time spent waiting for its write locks.
+    """
+    def on_query(self, method, kind, rows, duration):
+        pass
+
+    def on_call(self, method, queries, duration, lock_wait):
+        pass
+
+
+class CallStats(object):
+    __slots__ = ('method', 'queries', 'lock_wait')
+
+    def __init__(self, method):
+        self.method = method
+        self.queries = 0
+        self.lock_wait = 0.0
+
+
+class InstrumentedCursor(object):
+    """
+    Cursor timing each of its queries and their row fetches. A query is
+    reported to its PHPIPAM instance once the next one is run, or when the
+    cursor is flushed or closed.
+    """
+    def __init__(self, cursor, ipam, method=None):
+        self.cursor = cursor
+        self.ipam = ipam
+        self.method = method
+        self._query = None
+        self._query_method = None
+        self._rows = 0
+        self._duration = 0.0
+
+    def execute(self, query, *args):
+        self.flush()
+        call = getattr(self.ipam._local, 'call', None)
+        if call is not None:
+            call.queries += 1
+            self._query_method = call.method
+        else:
+            self._query_method = self.method
+        self._query = query
+        self._rows = 0
+        start = monotonic()
+        try:
+            return self.cursor.execute(query, *args)
+        finally:
+            self._duration = monotonic() - start
+
+    def fetchone(self):
+        start = monotonic()
+        row = self.cursor.fetchone()
+        self._duration += monotonic() - start
+        if row is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size):
+        start = monotonic()
+        rows = self.cursor.fetchmany(size)
+        self._duration += monotonic() - start
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        start = monotonic()
+        rows = self.cursor.fetchall()
+        self._duration += monotonic() - start
+        self._rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def flush(self):
+        if self._query is None:
+            return
+        query = self._query
+        self._query = None
+        kind = query.split(None, 1)[0].upper()
+        if kind == 'SELECT':
+            rows = self._rows
+        else:
+            rows = max(self.cursor.rowcount, 0)
+        self.ipam._report_query(self._query_method, kind, rows,
+                                self._duration, query)
+
+    def close(self):
+        self.flush()
+        self.cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of at most size database connections, opened on demand
+    with the connect callable.
+    """
+    def __init__(self, connect, size, timeout=POOL_TIMEOUT):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.opened = 0
+        self._idle = LifoQueue()
+        self._lock = threading.Lock()
+
+    def get(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self.opened -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except Empty:
+            e = 'Could not get a database connection within {} seconds.'
+            raise RuntimeError(e.format(self.timeout))
+
+    def put(self, db):
+        self._idle.put(db)
+
+    def replace(self, db):
+        """
+        Close a checked out connection, and put a new one in its place
+        """
+        db.close()
+        try:
+            self._idle.put(self.connect())
+        except Exception as e:
+            # Opened again on demand
+            with self._lock:
+                self.opened -= 1
+            logger.warning('Could not replace a pooled connection: %s', e)
+
+    def close(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except Empty:
+                break
+            with self._lock:
+                self.opened -= 1
+            db.close()
+
+
+class SubnetIdCache(object):
+    """
+    Thread-safe LRU cache of subnet ids keyed by (network address, prefix
+    length), holding at most size entries for at most ttl seconds.
+    """
+    def __init__(self, size, ttl=SUBNET_ID_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            (subnet_id, expiry) = entry
+            if expiry < monotonic():
+                del self._entries[key]
+                return None
+            # Keep recently used entries at the end of the LRU order
+            del self._entries[key]
+            self._entries[key] = entry
+            return subnet_id
+
+    def set(self, key, subnet_id):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (subnet_id, monotonic() + self.ttl)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def flush(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ProbeCache(object):
+    """
+    Section ids and schema versions probed by PHPIPAM instances, kept for
+    at most ttl seconds in the JSON file at path, so that short-lived
+    processes skip the startup queries. Entries are keyed by DSN and
+    section name.
+    """
+    def __init__(self, path, ttl=PROBE_CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        entry = self._load().get(key)
+        if entry is None or time.time() - entry['time'] >= self.ttl:
+            return None
+        return entry
+
+    def set(self, key, entry):
+        entries = self._load()
+        entries[key] = dict(entry, time=time.time())
+        # Replace the file at once, concurrent readers never see it partial
+        path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(path, 'w') as f:
+                json.dump(entries, f)
+            os.rename(path, self.path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write probe cache %s: %s',
+                           self.path, e)
+
+
+class _ProbedAttribute(object):
+    """
+    Attribute of PHPIPAM probed from the database on first access
+    """
+    def __init__(self, name):
+        self.name = '_' + name
+
+    def __get__(self, ipam, owner):
+        if ipam is None:
+            return self
+        if not ipam._probed:
+            ipam._probe()
+        return getattr(ipam, self.name)
+
+    def __set__(self, ipam, value):
+        setattr(ipam, self.name, value)
+
+
+class SubnetTrie(object):
+    """
+    Binary trie of subnets, with one root per IP version. Finding the
+    subnets containing an address walks at most one node per address bit.
+    """
+    def __init__(self, ttl=SUBNET_TRIE_TTL):
+        self.roots = {4: [None, None, None], 6: [None, None, None]}
+        self.expiry = monotonic() + ttl
+
+    def insert(self, network, value):
+        # Nodes are [zero bit child, one bit child, value] lists
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        shift = network.max_prefixlen - 1
+        for _ in range(network.prefixlen):
+            bit = (address >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+            shift -= 1
+        node[2] = value
+
+    def lookup(self, address):
+        """
+        Return the values of the subnets containing address, from the least
+        to the most specific.
+        """
+        found = []
+        node = self.roots[address.version]
+        value = int(address)
+        shift = address.max_prefixlen - 1
+        while node is not None:
+            if node[2] is not None:
+                found.append(node[2])
+            if shift < 0:
+                break
+            node = node[(value >> shift) & 1]
+            shift -= 1
+        return found
+
+
+def _network_key(node):
+    if node.network is None:
+        return (0, 0, 0)
+    return (node.network.version, int(node.network.network_address),
+            node.network.prefixlen)
+
+
+class SubnetTreeNode(object):
+    """
+    Subnet of a SubnetTree, with its parent node and its children nodes
+    sorted by network. Folders have no network nor subnet.
+    """
+    __slots__ = ('id', 'network', 'subnet', 'parent', 'children')
+
+    def __init__(self, subnet_id, network, subnet):
+        self.id = subnet_id
+        self.network = network
+        self.subnet = subnet
+        self.parent = None
+        self.children = []
+
+    def walk(self):
+        """
+        Yield this node and its descendants, depth first
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children))
+
+    def ancestors(self):
+        """
+        Return the parent nodes of this node, from the closest one
+        """
+        found = []
+        node = self.parent
+        while node is not None:
+            found.append(node)
+            node = node.parent
+        return found
+
+    def __repr__(self):
+        return 'SubnetTreeNode({}, {})'.format(self.id, self.network)
+
+
+class SubnetTree(object):
+    """
+    Subnets of a section linked through their masterSubnetId, indexed by
+    network and by id. Top-level subnets, and those whose parent is not in
+    the section, are the roots of the tree.
+    """
+    def __init__(self):
+        self.roots = []
+        self._by_id = {}
+        self._by_network = {}
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        for root in self.roots:
+            for node in root.walk():
+                yield node
+
+    def __contains__(self, network):
+        return network in self._by_network
+
+    def get(self, network):
+        return self._by_network.get(network)
+
+    def get_by_id(self, subnet_id):
+        return self._by_id.get(subnet_id)
+
+    def _add_node(self, node):
+        self._by_id[node.id] = node
+        if node.network is not None:
+            self._by_network[node.network] = node
+
+    def _link(self, node, parent_id):
+        parent = self._by_id.get(parent_id)
+        node.parent = parent
+        siblings = self.roots if parent is None else parent.children
+        siblings.append(node)
+        return siblings
+
+    @classmethod
+    def build(cls, rows):
+        """
+        Build a tree from (id, network, subnet, master subnet id) rows
+        """
+        tree = cls()
+        rows = list(rows)
+        for (subnet_id, network, subnet, _) in rows:
+            tree._add_node(SubnetTreeNode(subnet_id, network, subnet))
+        for (subnet_id, _, _, parent_id) in rows:
+            tree._link(tree._by_id[subnet_id], parent_id)
+        tree.roots.sort(key=_network_key)
+        for node in tree._by_id.values():
+            node.children.sort(key=_network_key)
+        return tree
+
+    def add(self, subnet_id, network, subnet, parent_id):
+        """
+        Add a subnet under the subnet of id parent_id, or as a root
+        """
+        node = SubnetTreeNode(subnet_id, network, subnet)
+        self._add_node(node)
+        self._link(node, parent_id).sort(key=_network_key)
+        return node
 
 
 class MySQLLock(object):
-    def __init__(self, ipam):
+    """
+    Run a write in a SERIALIZABLE transaction, holding MySQL named locks.
+
+    One lock is taken per written subnet id, 0 standing for the top level
+    of the section, so that writes to the same subnets exclude each other
+    whatever the lock_per_subnet mode of their clients. Without
+    lock_per_subnet, or without subnet_ids, the global LOCK_NAME lock is
+    taken first too. Subnet locks are always taken in ascending id order,
+    after the global one, so that writes can't wait for each other
+    forever.
+
+    Holding several named locks needs MySQL 5.7.5 or MariaDB 10.0.2: older
+    servers only get the global lock, and refuse lock_per_subnet.
+    """
+    def __init__(self, ipam, subnet_ids=()):
         self.ipam = ipam
+        self.connection = None
+        self.lock_names = [
+            '{}_{}'.format(LOCK_NAME, subnet_id)
+            for subnet_id in sorted(set(subnet_ids))
+        ]
+        if not ipam.lock_per_subnet or not self.lock_names:
+            self.lock_names.insert(0, LOCK_NAME)
+        self.locked_names = []
 
     def __enter__(self):
+        # Keep the whole transaction on a single pooled connection
+        self.connection = self.ipam.connection()
+        self.connection.__enter__()
+        start = monotonic()
+        try:
+            self._lock()
+        except Exception:
+            if self.ipam.dbtype == 'mysql':
+                self._release()
+                self.ipam.db.rollback()
+                self.ipam.db.autocommit = True
+            self.connection.__exit__(None, None, None)
+            raise
+        finally:
+            self.ipam._add_lock_wait(monotonic() - start)
+
+    def _lock(self):
         if self.ipam.dbtype == 'mysql':
             # Disable autocommit during writes for transactional behavior
             self.ipam.db.autocommit = False
             self.ipam.db.start_transaction(isolation_level='SERIALIZABLE')
-            self.ipam.cur.execute('SELECT GET_LOCK("{}", {})'.format(
-                LOCK_NAME, LOCK_TIMEOUT))
-            row = self.ipam.cur.fetchone()
-
-            if not row[0]:
-                e = 'Could not obtain lock within {} seconds.'.format(
-                    LOCK_TIMEOUT)
-                raise RuntimeError(e)
+            lock_names = self.lock_names
+            if not self.ipam._holds_multiple_named_locks():
+                if self.ipam.lock_per_subnet:
+                    raise RuntimeError('lock_per_subnet needs MySQL 5.7.5 '
+                                       'or MariaDB 10.0.2 or later')
+                lock_names = [LOCK_NAME]
+            for lock_name in lock_names:
+                self.ipam.cur.execute('SELECT GET_LOCK("{}", {})'.format(
+                    lock_name, LOCK_TIMEOUT))
+                row = self.ipam.cur.fetchone()
+
+                if not row[0]:
+                    e = 'Could not obtain lock within {} seconds.'.format(
+                        LOCK_TIMEOUT)
+                    raise RuntimeError(e)
+                self.locked_names.append(lock_name)
+        elif self.ipam.pool is not None:
+            # Pooled SQLite connections run in autocommit mode: take the
+            # database write lock for the whole transaction
+            self.ipam.cur.execute('BEGIN IMMEDIATE')
+
+    def _release(self):
+        while self.locked_names:
+            self.ipam.cur.execute('SELECT RELEASE_LOCK("{}")'.format(
+                self.locked_names.pop()))
 
     def __exit__(self, exception_type, exception_value, exception_traceback):
+        # Start the read-your-writes window of replicas
+        self.ipam.last_write = monotonic()
         if self.ipam.dbtype == 'mysql':
             if exception_type:
                 self.ipam.db.rollback()
             else:
                 self.ipam.db.commit()
-            self.ipam.cur.execute('SELECT RELEASE_LOCK("{}")'.format(
-                LOCK_NAME))
+            self._release()
             self.ipam.db.autocommit = True
+        elif self.ipam.pool is not None:
+            if exception_type:
+                self.ipam.db.rollback()
+            else:
+                self.ipam.db.commit()
+        self.connection.__exit__(None, None, None)
 
 
 class PHPIPAM(AbstractIPAM):
 
+    # Probed on first access in lazy mode, and at init otherwise
+    section_id = _ProbedAttribute('section_id')
+    hostname_db_field = _ProbedAttribute('hostname_db_field')
+    used_ip_state = _ProbedAttribute('used_ip_state')
+    reserved_ip_state = _ProbedAttribute('reserved_ip_state')
+
     def __init__(self, params):
         dbtype = DEFAULT_IPAM_DB_TYPE
         subnet_options = DEFAULT_SUBNET_OPTIONS.copy()
+        self._probed = False
+        self._probe_lock = threading.Lock()
+        self.section_id = None
         self.hostname_db_field = 'hostname'
         self.used_ip_state = 2
+        self.reserved_ip_state = 3
         for (option, value) in DEFAULT_SUBNET_OPTIONS.items():
             param_name = 'subnet_{}'.format(option)
             if params.get(param_name):
@@ -62,34 +667,388 @@ class PHPIPAM(AbstractIPAM):
         section_name = 'Production'
         if 'section_name' in params:
             section_name = params['section_name']
+        self.section_name = section_name
         if 'dbtype' in params:
             dbtype = params['dbtype']
         self.dbtype = dbtype
-        if dbtype == 'sqlite':
-            self.db = sqlite3.connect(params['database_uri'])
-            self.cur = self.db.cursor()
-        elif dbtype == 'mysql':
-            self.db = mysql.connector.connect(
-                host=params['database_host'],
-                user=params['username'],
-                password=params['password'],
-                database=params['database_name']
-            )
-            # Enable autocommit for reads to prevent entering transaction
-            self.db.autocommit = True
-            self.cur = self.db.cursor(buffered=True)
+        # Connect and probe the database on first use instead of at init
+        self.lazy = bool(params.get('lazy'))
+        self.probe_cache = None
+        if params.get('probe_cache'):
+            self.probe_cache = ProbeCache(
+                params['probe_cache'],
+                float(params.get('probe_cache_ttl', PROBE_CACHE_TTL)))
+        # Lock the subnets being written to instead of the whole IPAM. All
+        # writes lock their subnets: clients of both modes can be mixed.
+        self.lock_per_subnet = bool(params.get('lock_per_subnet'))
+        self._multiple_named_locks = None
+        # Allocate addresses with conditional inserts instead of locks,
+        # when a unique (subnetId, ip_addr) index rules duplicates out
+        self.optimistic_allocation = bool(params.get('optimistic_allocation'))
+        self.optimistic_retries = int(params.get('optimistic_retries',
+                                                 OPTIMISTIC_RETRIES))
+        self._unique_ip_index = None
+        if params.get('records'):
+            # Compact records, building ip objects on first access
+            self._ip_interface_item = records.IPInterfaceRecord
+            self._subnet_ip_interface_item = records.SubnetIPInterfaceRecord
+            self._ip_address_item = records.IPAddressRecord
+            self._subnet_item = records.SubnetRecord
         else:
+            self._ip_interface_item = records.ip_interface_dict
+            self._subnet_ip_interface_item = records.subnet_ip_interface_dict
+            self._ip_address_item = records.ip_address_dict
+            self._subnet_item = records.subnet_dict
+        # Number of rows fetched at once by the iter_* lookups
+        self.fetch_size = int(params.get('fetch_size', FETCH_SIZE))
+        self.subnet_id_cache = None
+        if params.get('subnet_id_cache_size'):
+            self.subnet_id_cache = SubnetIdCache(
+                int(params['subnet_id_cache_size']),
+                float(params.get('subnet_id_cache_ttl', SUBNET_ID_CACHE_TTL)))
+        # Seconds after which the subnet trie is loaded again
+        self.subnet_trie_ttl = float(params.get('subnet_trie_ttl',
+                                                SUBNET_TRIE_TTL))
+        self._subnet_trie = None
+        self._subnet_trie_lock = threading.Lock()
+        if dbtype not in ('sqlite', 'mysql'):
             raise ValueError('Unsupported database driver')
-        self.set_section_id_by_name(section_name)
+        self.params = params
+        # MetricsSink receiving query and call measures
+        self.metrics = params.get('metrics')
+        # Duration in seconds from which queries are logged as slow
+        self.slow_query_threshold = None
+        if params.get('slow_query_threshold') is not None:
+            self.slow_query_threshold = float(params['slow_query_threshold'])
+        self.instrumented = (self.metrics is not None or
+                             self.slow_query_threshold is not None)
+        # Seconds after a write of this client during which reads stay on
+        # the primary database, until replicas have caught up
+        self.read_your_writes_window = float(params.get(
+            'read_your_writes_window', READ_YOUR_WRITES_WINDOW))
+        self.last_write = None
+
+        self._local = threading.local()
+        self._db = None
+        self._cur = None
+        self._open_lock = threading.Lock()
+        self.pool = None
+        if params.get('pool_size'):
+            # Pooled mode: each operation checks out its own connection
+            self.pool = ConnectionPool(
+                self._connect, int(params['pool_size']),
+                float(params.get('pool_timeout', POOL_TIMEOUT)))
+        elif not self.lazy:
+            self._open()
+        self.replica_pools = [
+            ConnectionPool(
+                partial(self._connect_replica, dict(params, **replica)),
+                int(params.get('pool_size') or 1),
+                float(params.get('pool_timeout', POOL_TIMEOUT)))
+            for replica in params.get('replicas') or ()
+        ]
+        self._replica_pool_cycle = cycle(self.replica_pools)
 
-        if self._get_version() < 1.32:
-            # Older PHPIPAM version use `dns_name` field instead of `hostname`
-            self.hostname_db_field = 'dns_name'
-            self.used_ip_state = 1
+        if not self.lazy:
+            self._probe()
+
+    def _probe(self):
+        """
+        Resolve the section id, unless it was set, and the fields depending
+        on the schema version, from the probe cache when it holds them
+        """
+        with self._probe_lock:
+            if self._probed:
+                return
+            key = self._probe_key()
+            probe = None
+            if self.probe_cache is not None:
+                probe = self.probe_cache.get(key)
+            if probe is None:
+                probe = {}
+                with self.connection():
+                    if self._section_id is None:
+                        self.set_section_id_by_name(self.section_name)
+                        probe['section_id'] = self._section_id
+                    probe['version'] = self._get_version()
+                if self.probe_cache is not None and 'section_id' in probe:
+                    self.probe_cache.set(key, probe)
+            elif self._section_id is None:
+                self._section_id = probe['section_id']
+            if probe['version'] < 1.32:
+                # Older PHPIPAM version use `dns_name` field instead of
+                # `hostname`
+                self._hostname_db_field = 'dns_name'
+                self._used_ip_state = 1
+                self._reserved_ip_state = 2
+            self._probed = True
+
+    def _probe_key(self):
+        params = self.params
+        if self.dbtype == 'sqlite':
+            dsn = 'sqlite:{}'.format(os.path.abspath(params['database_uri']))
+        else:
+            dsn = 'mysql://{}@{}/{}'.format(params.get('username'),
+                                            params.get('database_host'),
+                                            params.get('database_name'))
+        return '{}#{}'.format(dsn, self.section_name)
+
+    def _open(self):
+        """
+        Open the connection of a non-pooled instance, once
+        """
+        with self._open_lock:
+            if self._db is None:
+                db = self._connect()
+                self._cur = self._get_cursor(db)
+                self._db = db
+
+    def _connect(self):
+        params = self.params
+        if self.dbtype == 'sqlite':
+            return self._connect_sqlite(params, pooled=self.pool is not None)
+        return self._connect_mysql(params)
+
+    def _connect_replica(self, params):
+        if self.dbtype == 'sqlite':
+            return self._connect_sqlite(params, pooled=True)
+        return self._connect_mysql(params)
+
+    def _connect_sqlite(self, params, pooled):
+        kwargs = {}
+        if pooled:
+            # Pooled connections are handed over between threads, and must
+            # commit their writes for other connections to see them
+            kwargs = {'check_same_thread': False, 'isolation_level': None}
+        if params.get('sqlite_read_only'):
+            # Read-only connections, e.g. to a local mirror refreshed by
+            # another process
+            db = sqlite3.connect(
+                'file:{}?mode=ro'.format(pathname2url(
+                    params['database_uri'])), uri=True, **kwargs)
+        else:
+            db = sqlite3.connect(params['database_uri'], **kwargs)
+        if params.get('sqlite_mmap_size'):
+            db.execute('PRAGMA mmap_size = %d'
+                       % int(params['sqlite_mmap_size']))
+        if params.get('sqlite_cache_size'):
+            # Negative sizes are in KiB instead of pages
+            db.execute('PRAGMA cache_size = -%d'
+                       % (int(params['sqlite_cache_size']) // 1024))
+        return db
+
+    def _connect_mysql(self, params):
+        db = _mysql_connector().connect(
+            host=params['database_host'],
+            user=params['username'],
+            password=params['password'],
+            database=params['database_name']
+        )
+        # Enable autocommit for reads to prevent entering transaction
+        db.autocommit = True
+        return db
+
+    def _get_cursor(self, db):
+        if self.dbtype == 'mysql':
+            cur = db.cursor(buffered=True)
+        else:
+            cur = db.cursor()
+        if self.instrumented:
+            return InstrumentedCursor(cur, self)
+        return cur
+
+    @contextmanager
+    def _instrumented_call(self, method):
+        call = CallStats(method)
+        self._local.call = call
+        start = monotonic()
+        try:
+            yield
+        finally:
+            del self._local.call
+            if self.metrics is not None:
+                self.metrics.on_call(method, call.queries,
+                                     monotonic() - start, call.lock_wait)
+
+    def _add_lock_wait(self, duration):
+        call = getattr(self._local, 'call', None)
+        if call is not None:
+            call.lock_wait += duration
+
+    def _report_query(self, method, kind, rows, duration, query):
+        if self.metrics is not None:
+            self.metrics.on_query(method, kind, rows, duration)
+        if (self.slow_query_threshold is not None and
+                duration >= self.slow_query_threshold):
+            logger.warning('Slow %s query in %s (%.3fs, %d rows): %s',
+                           kind, method, duration, rows,
+                           ' '.join(query.split()))
+
+    @property
+    def db(self):
+        db = getattr(self._local, 'db', self._db)
+        if db is None and self.pool is None:
+            self._open()
+            return self._db
+        return db
+
+    @property
+    def cur(self):
+        cur = getattr(self._local, 'cur', self._cur)
+        if cur is None and self.pool is None:
+            self._open()
+            return self._cur
+        return cur
+
+    @property
+    def _driver_error(self):
+        """
+        Base exception class of the database driver
+        """
+        if self.dbtype == 'mysql':
+            return _mysql_connector().Error
+        return sqlite3.Error
+
+    @contextmanager
+    def connection(self):
+        """
+        Bind a connection from the pool to the calling thread until the end
+        of the block. Nested blocks reuse the bound connection. Without a
+        pool, the single connection of this instance is used.
+        """
+        if hasattr(self._local, 'db'):
+            yield
+        elif self.pool is None:
+            self._open()
+            # Bind it anyway, so that nested reads don't go to a replica
+            self._local.db = self._db
+            self._local.cur = self._cur
+            try:
+                yield
+            finally:
+                del self._local.cur
+                del self._local.db
+        else:
+            with self._bind_pooled_connection(self.pool):
+                yield
+
+    @contextmanager
+    def read_connection(self):
+        """
+        Same as connection, binding a replica connection instead when there
+        are replicas, no connection is bound to the calling thread yet and
+        this client did not write during the read-your-writes window.
+        """
+        if self._use_replica():
+            with self._bind_pooled_connection(
+                    next(self._replica_pool_cycle)):
+                yield
+        else:
+            with self.connection():
+                yield
+
+    def _use_replica(self):
+        return (bool(self.replica_pools) and
+                not hasattr(self._local, 'db') and
+                (self.last_write is None or
+                 monotonic() - self.last_write >=
+                 self.read_your_writes_window))
+
+    @contextmanager
+    def _bind_pooled_connection(self, pool):
+        db = pool.get()
+        self._local.db = db
+        self._local.cur = self._get_cursor(db)
+        try:
+            yield
+        finally:
+            self._local.cur.close()
+            del self._local.cur
+            del self._local.db
+            pool.put(db)
+
+    def _iter_rows(self, query, fetch_size=None, method=None):
+        """
+        Yield rows of query read from an unbuffered cursor, fetch_size rows
+        at a time. In pooled mode, the rows are read on a connection of
+        their own unless one is bound to the calling thread. Outside of a
+        method call, the query is reported under the method name.
+        """
+        fetch_size = fetch_size or self.fetch_size
+        pool = None
+        if self._use_replica():
+            pool = next(self._replica_pool_cycle)
+        elif self.pool is not None and not hasattr(self._local, 'db'):
+            pool = self.pool
+        # Whether the connection is used by this generator only
+        owned = pool is not None or not hasattr(self._local, 'db')
+        db = self.db if pool is None else pool.get()
+        discard = False
+        try:
+            if self.dbtype == 'mysql':
+                cur = db.cursor(buffered=False)
+            else:
+                cur = db.cursor()
+            if self.instrumented:
+                cur = InstrumentedCursor(cur, self, method)
+            exhausted = False
+            try:
+                cur.execute(query)
+                rows = cur.fetchmany(fetch_size)
+                while rows:
+                    for row in rows:
+                        yield row
+                    rows = cur.fetchmany(fetch_size)
+                exhausted = True
+            finally:
+                if self.dbtype == 'mysql' and not exhausted:
+                    if owned:
+                        # Closed early: closing the connection drops the
+                        # unread rows instead of transferring them
+                        discard = True
+                    else:
+                        # Unread rows must be consumed before the bound
+                        # connection runs other queries
+                        while cur.fetchmany(fetch_size):
+                            pass
+                if not discard:
+                    cur.close()
+        finally:
+            if discard and pool is not None:
+                pool.replace(db)
+            elif discard:
+                with self._open_lock:
+                    # Opened again on first use
+                    self._db = self._cur = None
+                db.close()
+            elif pool is not None:
+                pool.put(db)
 
     def set_section_id(self, section_id):
         self.section_id = section_id
 
+    def _lock_subnets(self, *subnets):
+        """
+        Return a MySQLLock on the given subnets, and on the whole IPAM
+        unless locking per subnet.
+        """
+        subnet_ids = ()
+        if self.lock_per_subnet or self.dbtype == 'mysql':
+            subnet_ids = [self.find_subnet_id(subnet) for subnet in subnets]
+        return MySQLLock(self, subnet_ids)
+
+    def _holds_multiple_named_locks(self):
+        """
+        Tell whether the MySQL server holds several named locks at once,
+        checked once
+        """
+        if self._multiple_named_locks is None:
+            self.cur.execute('SELECT VERSION()')
+            self._multiple_named_locks = _holds_multiple_named_locks(
+                self.cur.fetchone()[0])
+        return self._multiple_named_locks
+
+    @with_connection
     def set_section_id_by_name(self, section_name):
         self.cur.execute(
             "SELECT id FROM sections WHERE name = '%s'" % (section_name)
@@ -101,6 +1060,7 @@ class PHPIPAM(AbstractIPAM):
             )
         self.set_section_id(row[0])
 
+    @with_connection
     def _get_version(self):
         self.cur.execute('SELECT version FROM settings LIMIT 1')
         row = self.cur.fetchone()
@@ -111,9 +1071,11 @@ class PHPIPAM(AbstractIPAM):
     def get_section_id(self):
         return self.section_id
 
+    @with_read_connection
     def find_subnet_id(self, subnet):
         """
-        Return subnet id from database
+        Return subnet id from database, or from the subnet id cache when
+        it is enabled
         """
         if hasattr(subnet, 'network'):
             # This is an interface
@@ -122,6 +1084,88 @@ class PHPIPAM(AbstractIPAM):
             # This is a subnet
             network = subnet
 
+        if self.subnet_id_cache is None:
+            return self._find_subnet_id_in_db(subnet, network)
+
+        key = (network.network_address, network.prefixlen)
+        subnet_id = self.subnet_id_cache.get(key)
+        if subnet_id is None:
+            subnet_id = self._find_subnet_id_in_db(subnet, network)
+            self.subnet_id_cache.set(key, subnet_id)
+        return subnet_id
+
+    def flush_subnet_id_cache(self):
+        """
+        Forget every cached subnet id, e.g. after subnets were changed by
+        another client
+        """
+        if self.subnet_id_cache is not None:
+            self.subnet_id_cache.flush()
+
+    def _invalidate_subnet(self, subnet):
+        """
+        Forget what is cached about subnet after this client changed it
+        """
+        if self.subnet_id_cache is not None:
+            self.subnet_id_cache.invalidate(
+                (subnet.network_address, subnet.prefixlen))
+        self._subnet_trie = None
+
+    def get_subnet_containing(self, ip, ancestors=False):
+        """
+        Return the most specific subnet of the section containing ip, or
+        None. With ancestors, return the list of all subnets containing
+        ip instead, from the most specific one to the top-level one.
+
+        Subnets are looked up in a trie loaded from the database on first
+        use, and loaded again subnet_trie_ttl seconds later or after this
+        client changed subnets.
+        """
+        if hasattr(ip, 'ip'):
+            # This is an interface
+            ip = ip.ip
+        rows = self._get_subnet_trie().lookup(ip)
+        if ancestors:
+            return [self._subnet_item(*row) for row in reversed(rows)]
+        if not rows:
+            return None
+        return self._subnet_item(*rows[-1])
+
+    def refresh_subnet_trie(self):
+        """
+        Load the subnet trie of get_subnet_containing again, e.g. after
+        subnets were changed by another client
+        """
+        trie = self._load_subnet_trie()
+        self._subnet_trie = trie
+        return trie
+
+    def _get_subnet_trie(self):
+        trie = self._subnet_trie
+        if trie is None or trie.expiry < monotonic():
+            with self._subnet_trie_lock:
+                # Another thread may have loaded it in the meantime
+                trie = self._subnet_trie
+                if trie is None or trie.expiry < monotonic():
+                    trie = self.refresh_subnet_trie()
+        return trie
+
+    @with_read_connection
+    def _load_subnet_trie(self):
+        trie = SubnetTrie(self.subnet_trie_ttl)
+        self.cur.execute("SELECT subnet,mask,description,vlanId FROM subnets \
+                         WHERE sectionId = %d" % self.section_id)
+        for row in self.cur:
+            if not row[0]:
+                # Folders have no subnet
+                continue
+            network = ip_network("%s/%s" % (ip_address(int(row[0])),
+                                            row[1] or 0))
+            trie.insert(network, row)
+        return trie
+
+    @with_connection
+    def _find_subnet_id_in_db(self, subnet, network):
         self.cur.execute("SELECT id FROM subnets WHERE subnet='%d' \
                          AND mask='%d'"
                          % (network.network_address,
@@ -135,10 +1179,11 @@ class PHPIPAM(AbstractIPAM):
             "for subnet {}".format(subnet)
         )
 
+    @with_connection
     def add_ip(self, ipaddress, hostname, description, mac=None):
         """ Adds an IP address in IPAM. ipaddress must be an
         instance of ip_interface. Returns True """
-        with MySQLLock(self):
+        with self._lock_subnets(ipaddress):
             subnetid = self.find_subnet_id(ipaddress)
             self.cur.execute("SELECT ip_addr FROM ipaddresses \
                              WHERE ip_addr='%d' AND subnetId=%d LIMIT 1"
@@ -155,21 +1200,23 @@ class PHPIPAM(AbstractIPAM):
                                 '' if mac is None else mac))
         return True
 
+    @with_connection
     def add_next_ip(self, subnet, hostname, description, mac=None, allow_duplicates=True):
         """ Finds next free ip in subnet, and adds it in IPAM.
         If allow_duplicates is False, lookup for IP matching hostname and if any,
         return it instead of allocating a new one.
         Returns IP address as ip_interface """
         try:
-            with MySQLLock(self):
+            if self.optimistic_allocation and self._has_unique_ip_index():
+                ipaddress = self._add_next_ip_optimistic(
+                    subnet, hostname, description, mac, allow_duplicates)
+                if ipaddress is not None:
+                    return ipaddress
+            with self._lock_subnets(subnet):
                 if not allow_duplicates:
-                    ipaddress = None
-                    try:
-                        ipaddress = self.get_ip_by_desc_and_subnet(description, subnet.network_address)
-                    except ValueError:
-                        pass
+                    ipaddress = self._get_duplicate_ip(subnet, description)
                     if ipaddress:
-                        return ip_interface("%s/%d" % (ipaddress, subnet.prefixlen))
+                        return ipaddress
                 ipaddress = self.get_next_free_ip(subnet)
                 subnetid = self.find_subnet_id(ipaddress)
                 self.cur.execute("INSERT INTO ipaddresses \
@@ -183,25 +1230,304 @@ class PHPIPAM(AbstractIPAM):
             raise ValueError("Unable to add next IP in %s: %s" % (
                 subnet, str(e)))
 
+    def _get_duplicate_ip(self, subnet, description):
+        """
+        Return the address of subnet matching description as ip_interface,
+        or None
+        """
+        try:
+            ipaddress = self.get_ip_by_desc_and_subnet(description, subnet.network_address)
+        except ValueError:
+            return None
+        if ipaddress:
+            return ip_interface("%s/%d" % (ipaddress, subnet.prefixlen))
+        return None
+
+    def _has_unique_ip_index(self):
+        """
+        Tell whether a unique index on (subnetId, ip_addr) prevents
+        duplicate allocations. Checked once: without it, optimistic
+        allocations fall back to locking.
+        """
+        if self._unique_ip_index is None:
+            indexes = {}
+            if self.dbtype == 'sqlite':
+                self.cur.execute('PRAGMA index_list(ipaddresses)')
+                # (rank, name, unique, origin, partial)
+                names = [row[1] for row in self.cur.fetchall()
+                         if row[2] and not (len(row) > 4 and row[4])]
+                for name in names:
+                    self.cur.execute('PRAGMA index_info("%s")' % name)
+                    indexes[name] = [row[2] for row in self.cur.fetchall()]
+            else:
+                self.cur.execute('SHOW INDEX FROM ipaddresses '
+                                 'WHERE Non_unique = 0')
+                columns = [column[0] for column in self.cur.description]
+                for row in self.cur.fetchall():
+                    row = dict(zip(columns, row))
+                    indexes.setdefault(row['Key_name'], []).append(
+                        row['Column_name'])
+            self._unique_ip_index = any(
+                set(column.lower() for column in index) ==
+                set(['subnetid', 'ip_addr'])
+                for index in indexes.values())
+            if not self._unique_ip_index:
+                logger.warning('No unique (subnetId, ip_addr) index on '
+                               'ipaddresses: optimistic allocations are '
+                               'disabled, addresses are allocated under '
+                               'locks')
+        return self._unique_ip_index
+
+    def _add_next_ip_optimistic(self, subnet, hostname, description, mac,
+                                allow_duplicates):
+        """
+        Insert the first free address of subnet without locking, with an
+        INSERT conditioned on the address still being free. When another
+        client took it in the meantime, try the next free address. Return
+        None after optimistic_retries conflicts, for the caller to lock.
+        """
+        if not allow_duplicates:
+            ipaddress = self._get_duplicate_ip(subnet, description)
+            if ipaddress:
+                return ipaddress
+        subnetid = self.find_subnet_id(subnet)
+        first_host, last_host = self._get_host_range(subnet)
+        for _ in range(self.optimistic_retries + 1):
+            candidate_ip = self._find_first_free_ip(
+                subnet, subnetid, first_host, last_host)
+            if candidate_ip is None:
+                raise ValueError("Subnet %s/%s is full"
+                                 % (subnet.network_address,
+                                    subnet.prefixlen))
+            ipaddress = ip_interface("%s/%d" % (
+                self._get_address(subnet, candidate_ip), subnet.prefixlen))
+            if self._insert_ip_if_free(subnetid, ipaddress, hostname,
+                                       description, mac):
+                self.last_write = monotonic()
+                return ipaddress
+            first_host = candidate_ip + 1
+        return None
+
+    def _insert_ip_if_free(self, subnetid, ipaddress, hostname, description,
+                           mac):
+        """
+        Insert ipaddress unless it is already allocated in the subnet, and
+        tell whether it was. The unique (subnetId, ip_addr) index rejects
+        inserts of concurrent clients not seeing each other's rows yet.
+        """
+        try:
+            self.cur.execute("INSERT INTO ipaddresses \
+                             (subnetId, ip_addr, description, %s, mac) \
+                             SELECT %d, '%d', '%s', '%s', '%s' \
+                             FROM (SELECT 1) AS candidate \
+                             WHERE NOT EXISTS (SELECT 1 FROM ipaddresses \
+                                 WHERE ip_addr='%d' AND subnetId=%d)"
+                             % (self.hostname_db_field, subnetid,
+                                ipaddress.ip, description, hostname,
+                                '' if mac is None else mac,
+                                ipaddress.ip, subnetid))
+        except self._driver_error as e:
+            # Concurrent conditional inserts in the same gap of the index,
+            # or a duplicate rejected by a unique (subnetId, ip_addr) index
+            if isinstance(e, sqlite3.IntegrityError):
+                return False
+            if self.dbtype == 'mysql' and e.errno in (
+                    _mysql_connector().errorcode.ER_LOCK_DEADLOCK,
+                    _mysql_connector().errorcode.ER_DUP_ENTRY):
+                return False
+            raise
+        return self.cur.rowcount == 1
+
+    @with_connection
+    def add_next_ips(self, subnet, count, hostnames, descriptions,
+                     macs=None, state=None):
+        """ Finds count next free ips in subnet, and adds them in IPAM
+        at once. hostnames, descriptions and optional macs are lists
+        holding one entry per allocated ip. The ips get the default
+        state of the database unless state is given.
+        Returns IP addresses as a list of ip_interface """
+        if macs is None:
+            macs = [None] * count
+        if not len(hostnames) == len(descriptions) == len(macs) == count:
+            raise ValueError("Expected %d hostnames, descriptions and macs"
+                             % count)
+        if count == 0:
+            return []
+
+        try:
+            with self._lock_subnets(subnet):
+                subnetid = self.find_subnet_id(subnet)
+                first_host, last_host = self._get_host_range(subnet)
+                usedips = self.get_allocated_ips_by_subnet_id(subnetid)
+                freeips = self._iter_free_ips(usedips, first_host, last_host)
+                ipaddresses = [
+                    ip_interface("%s/%d" % (
+                        self._get_address(subnet, candidate_ip),
+                        subnet.prefixlen))
+                    for candidate_ip in islice(freeips, count)
+                ]
+                if len(ipaddresses) < count:
+                    raise ValueError("Subnet %s/%s is full"
+                                     % (subnet.network_address,
+                                        subnet.prefixlen))
+
+                state_column = ''
+                state_value = ''
+                if state is not None:
+                    state_column = ', state'
+                    state_value = ", '%d'" % state
+                values = ", ".join(
+                    "(%d, '%d', '%s', '%s', '%s'%s)"
+                    % (subnetid, ipaddress.ip, self._escape(description),
+                       self._escape(hostname), self._escape(mac),
+                       state_value)
+                    for ipaddress, hostname, description, mac
+                    in zip(ipaddresses, hostnames, descriptions, macs))
+                self.cur.execute("INSERT INTO ipaddresses \
+                                 (subnetId, ip_addr, description, %s, mac%s) \
+                                 VALUES %s"
+                                 % (self.hostname_db_field, state_column,
+                                    values))
+                return ipaddresses
+        except ValueError as e:
+            raise ValueError("Unable to add next IPs in %s: %s" % (
+                subnet, str(e)))
+
+    @with_read_connection
     def get_next_free_ip(self, subnet):
         """
         Finds next free ip in subnet. Returns IP address as ip_interface
         """
         # Find PHPIPAM subnet id
         subnetid = self.find_subnet_id(subnet)
-        # Get allocated ip addresses from database
-        usedips = self.get_allocated_ips_by_subnet_id(subnetid)
+        first_host, last_host = self._get_host_range(subnet)
+        candidate_ip = self._find_first_free_ip(subnet, subnetid, first_host,
+                                                last_host)
+        if candidate_ip is None:
+            raise ValueError("Subnet %s/%s is full"
+                             % (subnet.network_address,
+                                subnet.prefixlen))
+        # Return first available ip address in the subnet
+        return ip_interface("%s/%d" % (
+            self._get_address(subnet, candidate_ip), subnet.prefixlen))
+
+    def _find_first_free_ip(self, subnet, subnetid, first_host, last_host):
+        """
+        Return the first free address of subnet between first_host and
+        last_host as an integer, or None.
+        """
+        if first_host > last_host:
+            return None
+        if self.dbtype == 'mysql' or subnet.version == 4:
+            return self._find_first_free_ip_in_db(
+                subnetid, first_host, last_host)
+        # SQLite integers are 64 bits wide, so IPv6 addresses can't be
+        # compared in SQL: merge sorted allocations in Python instead
+        return self._find_first_free_ip_in_list(
+            subnetid, first_host, last_host)
+
+    @staticmethod
+    def _get_host_range(subnet):
+        """
+        Return first and last usable host addresses of a subnet as integers,
+        following the same rules as ip_network.hosts().
+        """
+        network = int(subnet.network_address)
+        broadcast = int(subnet.broadcast_address)
+        if subnet.num_addresses <= 2:
+            # Point-to-point (/31, /127) and host (/32, /128) subnets
+            return network, broadcast
+        if subnet.version == 4:
+            return network + 1, broadcast - 1
+        # IPv6 only reserves the Subnet-Router anycast address
+        return network + 1, broadcast
+
+    @staticmethod
+    def _get_address(subnet, value):
+        """
+        Return an integer as an address of the same IP version as subnet.
+        """
+        return subnet.network_address + (value - int(subnet.network_address))
+
+    def _find_first_free_ip_in_db(self, subnetid, first_host, last_host):
+        """
+        Let the database find the first hole in a subnet allocations.
+        Return it as an integer, or None if the subnet is full.
+        """
+        self.cur.execute("SELECT ip_addr FROM ipaddresses \
+                         WHERE ip_addr='%d' AND subnetId=%d LIMIT 1"
+                         % (first_host, subnetid))
+        if self.cur.fetchone() is None:
+            return first_host
+
+        # Scan allocated addresses in order from first_host, and stop at the
+        # first one not followed by another: the scan reads as many rows as
+        # there are addresses before the hole. ip_addr is a string column:
+        # cast it to compute the address following each allocated one.
+        if self.dbtype == 'mysql':
+            ip_addr = 'CAST(a.ip_addr AS DECIMAL(39, 0))'
+        else:
+            ip_addr = 'CAST(a.ip_addr AS INTEGER)'
+        if len(str(first_host)) == len(str(last_host)):
+            # Decimal strings of the same length sort as their integers:
+            # scan a range of the (subnetId, ip_addr) index
+            bounds = ("LENGTH(a.ip_addr) = %d "
+                      "AND a.ip_addr BETWEEN '%d' AND '%d'"
+                      % (len(str(first_host)), first_host, last_host))
+            order = 'a.ip_addr'
+        else:
+            bounds = '%s BETWEEN %d AND %d' % (ip_addr, first_host,
+                                               last_host)
+            order = 'LENGTH(a.ip_addr), a.ip_addr'
+        self.cur.execute('SELECT a.ip_addr FROM ipaddresses a '
+                         'WHERE a.subnetId={subnetid} AND {bounds} '
+                         'AND NOT EXISTS (SELECT 1 FROM ipaddresses b '
+                         'WHERE b.subnetId={subnetid} '
+                         'AND b.ip_addr=CAST({ip_addr} + 1 AS CHAR)) '
+                         'ORDER BY {order} LIMIT 1'
+                         ''.format(ip_addr=ip_addr, subnetid=subnetid,
+                                   bounds=bounds, order=order))
+        row = self.cur.fetchone()
+        if row is None or int(row[0]) >= last_host:
+            return None
+        return int(row[0]) + 1
 
-        for candidate_ip in subnet.hosts():
-            if candidate_ip not in usedips:
-                # Return first available ip address in the subnet
-                return ip_interface("%s/%d" % (candidate_ip,
-                                               subnet.prefixlen))
-        raise ValueError("Subnet %s/%s is full"
-                         % (subnet.network_address,
-                            subnet.prefixlen))
+    def _find_first_free_ip_in_list(self, subnetid, first_host, last_host):
+        """
+        Find the first hole in a subnet allocations with a linear merge of
+        sorted allocated addresses. Return it as an integer, or None if the
+        subnet is full.
+        """
+        usedips = self.get_allocated_ips_by_subnet_id(subnetid)
+        return next(self._iter_free_ips(usedips, first_host, last_host), None)
 
+    @staticmethod
+    def _iter_free_ips(usedips, first_host, last_host):
+        """
+        Yield free addresses between first_host and last_host as integers,
+        merging them with the allocated addresses usedips.
+        """
+        usedips = sorted(int(ip) for ip in usedips)
+        candidate_ip = first_host
+        for usedip in usedips:
+            if usedip > last_host:
+                break
+            while candidate_ip < usedip:
+                yield candidate_ip
+                candidate_ip += 1
+            if usedip == candidate_ip:
+                candidate_ip += 1
+        while candidate_ip <= last_host:
+            yield candidate_ip
+            candidate_ip += 1
+
+    @with_connection
     def get_allocated_ips_by_subnet_id(self, subnetid):
+        """
+        Return the addresses allocated in a subnet. On MySQL, the rows are
+        locked until the end of the enclosing write, so the call always
+        runs on the primary.
+        """
         request_suffix = ''
         if self.dbtype == 'mysql':
             request_suffix = ' FOR UPDATE'
@@ -211,6 +1537,7 @@ class PHPIPAM(AbstractIPAM):
         iplist = [ip_address(int(ip[0])) for ip in self.cur]
         return iplist
 
+    @with_connection
     def add_top_level_subnet(self, subnet, description):
         """
         Add top level (without any parent) subnet.
@@ -219,7 +1546,8 @@ class PHPIPAM(AbstractIPAM):
         :param description: subnet description
         :return: True
         """
-        with MySQLLock(self):
+        # Top-level subnets are children of the section, standing for id 0
+        with MySQLLock(self, [0]):
             # Check if subnet exist
             self.cur.execute("SELECT subnet FROM subnets \
                              WHERE subnet='{}'"
@@ -242,14 +1570,28 @@ class PHPIPAM(AbstractIPAM):
                     0,
                     self.subnet_options['vlan_id'],
                     self.subnet_options['permissions']))
+        self._invalidate_subnet(subnet)
 
         return True
 
-    def add_subnet(self, subnet, parent_subnet, description):
+    @with_connection
+    def add_subnet(self, subnet, parent_subnet, description, tree=None):
         """
         Add a subnet if can be inserted in parent subnet.
+
+        With a SubnetTree from get_subnet_tree, the parent subnet id is
+        looked up in the tree instead of the database, and the new subnet
+        is added to the tree. Overlaps are always checked in the database,
+        under the lock.
         """
-        parent_subnet_id = self.find_subnet_id(parent_subnet)
+        if tree is not None:
+            parent_node = tree.get(parent_subnet)
+            if parent_node is None:
+                raise ValueError('Subnet {} not found in the tree'
+                                 ''.format(parent_subnet))
+            parent_subnet_id = parent_node.id
+        else:
+            parent_subnet_id = self.find_subnet_id(parent_subnet)
 
         if not subnet.overlaps(parent_subnet):
             raise ValueError('Subnet {} is not a child of {}'.format(
@@ -263,47 +1605,55 @@ class PHPIPAM(AbstractIPAM):
                 parent_subnet,
             ))
 
-        children_subnets = self.get_children_subnet_list(parent_subnet)
-        for children_subnet in children_subnets:
-            if children_subnet['subnet'].overlaps(subnet):
-                raise ValueError('Candidate subnet overlaps with {}'.format(
-                    children_subnet['subnet']
-                ))
+        with self._lock_subnets(parent_subnet):
+            children_subnets = self._get_allocated_subnets(parent_subnet_id)
+            for children_subnet in children_subnets:
+                if children_subnet.overlaps(subnet):
+                    raise ValueError('Candidate subnet overlaps with {}'.format(
+                        children_subnet
+                    ))
 
-        parent_subnet_used_ips = self.get_allocated_ips_by_subnet_id(
-            parent_subnet_id)
-        if len(parent_subnet_used_ips) > 0:
-            raise ValueError('Parent subnet {} must not contain any '
-                             'allocated IP address!'.format(parent_subnet))
+            parent_subnet_used_ips = self.get_allocated_ips_by_subnet_id(
+                parent_subnet_id)
+            if len(parent_subnet_used_ips) > 0:
+                raise ValueError('Parent subnet {} must not contain any '
+                                 'allocated IP address!'.format(parent_subnet))
 
-        # Everything is in order, insert our subnet in IPAM
-        self.cur.execute(
-            'INSERT INTO subnets '
-            '(subnet, mask, sectionId, description, vrfId, '
-            'masterSubnetId, vlanId, permissions) '
-            'VALUES (\'{:d}\', \'{}\', \'{}\', \'{}\', '
-            '\'{}\', \'{}\', \'{}\', \'{}\')'.format(
-                int(subnet.network_address),
-                subnet.prefixlen,
-                self.section_id,
-                description,
-                self.subnet_options['vrf_id'],
-                parent_subnet_id,
-                self.subnet_options['vlan_id'],
-                self.subnet_options['permissions']))
+            # Everything is in order, insert our subnet in IPAM
+            self.cur.execute(
+                'INSERT INTO subnets '
+                '(subnet, mask, sectionId, description, vrfId, '
+                'masterSubnetId, vlanId, permissions) '
+                'VALUES (\'{:d}\', \'{}\', \'{}\', \'{}\', '
+                '\'{}\', \'{}\', \'{}\', \'{}\')'.format(
+                    int(subnet.network_address),
+                    subnet.prefixlen,
+                    self.section_id,
+                    description,
+                    self.subnet_options['vrf_id'],
+                    parent_subnet_id,
+                    self.subnet_options['vlan_id'],
+                    self.subnet_options['permissions']))
+            if tree is not None:
+                tree.add(self.cur.lastrowid, subnet, self._subnet_item(
+                    int(subnet.network_address), subnet.prefixlen,
+                    description, self.subnet_options['vlan_id']),
+                    parent_subnet_id)
+        self._invalidate_subnet(subnet)
         return subnet
 
+    @with_connection
     def add_next_subnet(self, parent_subnet, prefixlen, description):
         """
         Find a subnet prefixlen-wide in parent_subnet, insert it into IPAM,
         and return it.
         """
-        with MySQLLock(self):
-            if prefixlen <= parent_subnet.prefixlen:
-                raise ValueError('Parent subnet {} is too small to add new '
-                                 'subnet with prefixlen {}!'
-                                 ''.format(parent_subnet, prefixlen))
+        if prefixlen <= parent_subnet.prefixlen:
+            raise ValueError('Parent subnet {} is too small to add new '
+                             'subnet with prefixlen {}!'
+                             ''.format(parent_subnet, prefixlen))
 
+        with self._lock_subnets(parent_subnet):
             try:
                 parent_subnet_id = self.find_subnet_id(parent_subnet)
             except ValueError:
@@ -340,24 +1690,34 @@ class PHPIPAM(AbstractIPAM):
                     parent_subnet_id,
                     self.subnet_options['vlan_id'],
                     self.subnet_options['permissions']))
+            self._invalidate_subnet(subnet)
             return subnet
 
     def _get_next_free_subnet(self, subnet, subnet_id, prefixlen):
         """
         Find next free prefixlen-wide subnet in a given subnet.
         """
-        allocated_subnets = self._get_allocated_subnets(subnet_id)
-
-        for candidate_subnet in subnet.subnets(new_prefix=prefixlen):
-            # A candidate subnet is free if it doesn't overlap any other
-            # allocated subnet
-            for allocated_subnet in allocated_subnets:
-                if candidate_subnet.overlaps(allocated_subnet):
-                    # Since one subnet is overlapping, don't check the others
-                    break
-            else:
-                return candidate_subnet
-        return None
+        allocated_subnets = sorted(
+            (int(allocated_subnet.network_address),
+             int(allocated_subnet.broadcast_address))
+            for allocated_subnet in self._get_allocated_subnets(subnet_id))
+        size = 2 ** (subnet.max_prefixlen - prefixlen)
+
+        candidate = int(subnet.network_address)
+        for (first, last) in allocated_subnets:
+            if last < candidate:
+                continue
+            if first >= candidate + size:
+                # The gap before this allocated subnet fits the candidate
+                break
+            # Jump past the overlapping allocated subnet, keeping the
+            # candidate aligned on its prefix length
+            candidate = (last // size + 1) * size
+
+        if candidate + size - 1 > int(subnet.broadcast_address):
+            return None
+        return ip_network('{}/{}'.format(self._get_address(subnet, candidate),
+                                         prefixlen))
 
     def _get_allocated_subnets(self, subnet_id):
         """
@@ -374,11 +1734,12 @@ class PHPIPAM(AbstractIPAM):
         ]
         return allocated_subnets
 
+    @with_connection
     def edit_ip_description(self, ipaddress, description):
         """Edit an IP address description in IPAM. ipaddress must be an
         instance of ip_interface with correct prefix length.
         """
-        with MySQLLock(self):
+        with self._lock_subnets(ipaddress):
             subnetid = self.find_subnet_id(ipaddress)
             self.cur.execute("SELECT ip_addr FROM ipaddresses \
                              WHERE ip_addr='%d' AND subnetId=%d"
@@ -393,11 +1754,12 @@ class PHPIPAM(AbstractIPAM):
                              % (description, ipaddress.ip, subnetid))
         return True
 
+    @with_connection
     def edit_ip_hostname(self, ipaddress, hostname):
         """Edit an IP address hostname in IPAM. ipaddress must be an
         instance of ip_interface with correct prefix length.
         """
-        with MySQLLock(self):
+        with self._lock_subnets(ipaddress):
             subnetid = self.find_subnet_id(ipaddress)
             self.cur.execute("SELECT ip_addr FROM ipaddresses \
                              WHERE ip_addr='%d' AND subnetId=%d"
@@ -413,11 +1775,12 @@ class PHPIPAM(AbstractIPAM):
                                 ipaddress.ip, subnetid))
         return True
 
+    @with_connection
     def edit_ip_mac(self, ipaddress, mac):
         """Edit an IP address MAC in IPAM. ipaddress must be an
         instance of ip_interface with correct prefix length.
         """
-        with MySQLLock(self):
+        with self._lock_subnets(ipaddress):
             subnetid = self.find_subnet_id(ipaddress)
             self.cur.execute("SELECT ip_addr FROM ipaddresses \
                              WHERE ip_addr='%d' AND subnetId=%d"
@@ -432,6 +1795,7 @@ class PHPIPAM(AbstractIPAM):
                              % (mac, ipaddress.ip, subnetid))
         return True
 
+    @with_connection
     def edit_subnet_description(self, subnet, description):
         """Edit a subnet description in IPAM. subnet must be an
         instance of ip_network and the description must not be
@@ -440,19 +1804,21 @@ class PHPIPAM(AbstractIPAM):
         if not description:
             raise ValueError("The provided description is empty")
 
-        with MySQLLock(self):
+        with self._lock_subnets(subnet):
             subnetid = self.find_subnet_id(subnet)
             self.cur.execute(
                 "UPDATE subnets "
                 "SET description='{}'"
                 "WHERE id={}".format(description, subnetid)
             )
+        self._invalidate_subnet(subnet)
 
+    @with_connection
     def delete_ip(self, ipaddress):
         """Delete an IP address in IPAM. ipaddress must be an
         instance of ip_interface with correct prefix length.
         """
-        with MySQLLock(self):
+        with self._lock_subnets(ipaddress):
             subnetid = self.find_subnet_id(ipaddress)
             self.cur.execute("SELECT ip_addr FROM ipaddresses \
                              WHERE ip_addr='%d' AND subnetId=%d"
@@ -466,6 +1832,67 @@ class PHPIPAM(AbstractIPAM):
                              % (ipaddress.ip, subnetid))
         return True
 
+    @with_connection
+    def edit_ips(self, subnet, updates, state=None, current_state=None):
+        """Edit many IP addresses of a subnet at once. updates is a list
+        of (ip, hostname, description, mac) tuples, and state the new
+        state of all of them, if given. Only the IP addresses in
+        current_state are edited, if given.
+        Returns the number of edited IP addresses.
+        """
+        if not updates:
+            return 0
+
+        def case(values):
+            return 'CASE ip_addr {} END'.format(' '.join(
+                "WHEN '%d' THEN '%s'" % (ip, self._escape(value))
+                for (ip, value) in values))
+
+        ips = [int(getattr(update[0], 'ip', update[0])) for update in updates]
+        assignments = [
+            '%s = %s' % (self.hostname_db_field, case(
+                (ip, update[1]) for (ip, update) in zip(ips, updates))),
+            'description = %s' % case(
+                (ip, update[2]) for (ip, update) in zip(ips, updates)),
+            'mac = %s' % case(
+                (ip, update[3]) for (ip, update) in zip(ips, updates)),
+        ]
+        if state is not None:
+            assignments.append("state = '%d'" % state)
+        state_condition = ''
+        if current_state is not None:
+            state_condition = ' AND state = %d' % current_state
+        with self._lock_subnets(subnet):
+            subnetid = self.find_subnet_id(subnet)
+            self.cur.execute("UPDATE ipaddresses SET %s \
+                             WHERE subnetId=%d AND ip_addr IN (%s)%s"
+                             % (', '.join(assignments), subnetid,
+                                ', '.join("'%d'" % ip for ip in ips),
+                                state_condition))
+            return self.cur.rowcount
+
+    @with_connection
+    def delete_ips(self, subnet, ips, state=None):
+        """Delete many IP addresses of a subnet at once, only those in
+        the given state if any.
+        Returns the number of deleted IP addresses.
+        """
+        if not ips:
+            return 0
+        state_condition = ''
+        if state is not None:
+            state_condition = ' AND state = %d' % state
+        with self._lock_subnets(subnet):
+            subnetid = self.find_subnet_id(subnet)
+            self.cur.execute("DELETE FROM ipaddresses \
+                             WHERE subnetId=%d AND ip_addr IN (%s)%s"
+                             % (subnetid,
+                                ', '.join("'%d'" % int(getattr(ip, 'ip', ip))
+                                          for ip in ips),
+                                state_condition))
+            return self.cur.rowcount
+
+    @with_connection
     def delete_subnet(self, subnet, empty_subnet=False):
         """
         Delete a subnet in IPAM. subnet must be an
@@ -473,7 +1900,7 @@ class PHPIPAM(AbstractIPAM):
         If empty_subnet is True, we will remove all IP addresses
         in the subnet. Otherwise, we will raise an exception.
         """
-        with MySQLLock(self):
+        with self._lock_subnets(subnet):
             subnet_id = self.find_subnet_id(subnet)
             ip_list = self.get_allocated_ips_by_subnet_id(subnet_id)
             if ip_list:
@@ -496,8 +1923,328 @@ class PHPIPAM(AbstractIPAM):
             self.cur.execute("DELETE FROM subnets \
                              WHERE id=%d"
                              % subnet_id)
+        self._invalidate_subnet(subnet)
         return True
 
+    def _escape(self, value):
+        """
+        Escape a value for a SQL string literal
+        """
+        value = '' if value is None else '{}'.format(value)
+        if self.dbtype == 'mysql':
+            value = value.replace('\\', '\\\\')
+        return value.replace("'", "''")
+
+    def _get_section_subnets(self):
+        """
+        Return the subnets of the section as (network, id, master subnet
+        id) tuples
+        """
+        self.cur.execute('SELECT subnet, mask, id, masterSubnetId '
+                         'FROM subnets WHERE sectionId = %d'
+                         % self.section_id)
+        return [
+            (ip_network('{}/{}'.format(ip_address(int(row[0])),
+                                       int(row[1] or 0))),
+             int(row[2]), int(row[3] or 0))
+            for row in self.cur if row[0]
+        ]
+
+    @with_connection
+    def import_ips(self, rows, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        Add many IP addresses at once. rows is an iterable of dicts with an
+        ip key (ip_interface or its string), and hostname, description and
+        mac keys, e.g. read by ipam.client.bulkimport.read_rows.
+
+        Rows are checked against the subnets of the section loaded
+        beforehand, then inserted chunk_size at a time, with one
+        transaction and one multi-row INSERT per chunk. Invalid rows are
+        rejected instead of aborting the import.
+        Returns a dict with the number of imported rows, and the list of
+        (index, row, reason) of rejected rows.
+        """
+        subnet_ids = dict((network, subnet_id) for (network, subnet_id, _)
+                          in self._get_section_subnets())
+        result = {'imported': 0, 'rejected': []}
+        seen = set()
+        chunk = []
+        for (index, row) in enumerate(rows):
+            try:
+                ipaddress = ip_interface(row['ip'])
+            except (KeyError, ValueError) as e:
+                result['rejected'].append(
+                    (index, row, 'Invalid IP address: {}'.format(e)))
+                continue
+            subnet_id = subnet_ids.get(ipaddress.network)
+            if subnet_id is None:
+                result['rejected'].append(
+                    (index, row, 'Unknown subnet {}'.format(
+                        ipaddress.network)))
+                continue
+            if (ipaddress.ip, subnet_id) in seen:
+                result['rejected'].append(
+                    (index, row, 'IP address {} imported twice'.format(
+                        ipaddress.ip)))
+                continue
+            seen.add((ipaddress.ip, subnet_id))
+            chunk.append((index, row, ipaddress, subnet_id))
+            if len(chunk) >= chunk_size:
+                self._import_ip_chunk(chunk, result)
+                chunk = []
+        if chunk:
+            self._import_ip_chunk(chunk, result)
+        return result
+
+    def _import_ip_chunk(self, chunk, result):
+        subnet_ids = [subnet_id for (_, _, _, subnet_id) in chunk]
+        rejected = []
+        try:
+            with MySQLLock(self, subnet_ids):
+                self.cur.execute(
+                    "SELECT ip_addr, subnetId FROM ipaddresses "
+                    "WHERE ip_addr IN (%s)"
+                    % ', '.join("'%d'" % ipaddress.ip
+                                for (_, _, ipaddress, _) in chunk))
+                existing = set((int(row[0]), int(row[1])) for row in self.cur)
+                values = []
+                for (index, row, ipaddress, subnet_id) in chunk:
+                    if (int(ipaddress.ip), subnet_id) in existing:
+                        rejected.append(
+                            (index, row, 'IP address {} already registered'
+                             ''.format(ipaddress.ip)))
+                        continue
+                    values.append("(%d, '%d', '%s', '%s', '%s')" % (
+                        subnet_id, ipaddress.ip,
+                        self._escape(row.get('description')),
+                        self._escape(row.get('hostname')),
+                        self._escape(row.get('mac'))))
+                if values:
+                    self.cur.execute("INSERT INTO ipaddresses \
+                                     (subnetId, ip_addr, description, %s, \
+                                     mac) VALUES %s"
+                                     % (self.hostname_db_field,
+                                        ', '.join(values)))
+        except self._driver_error as e:
+            result['rejected'].extend((index, row, str(e))
+                                      for (index, row, _, _) in chunk)
+            return
+        result['rejected'].extend(rejected)
+        result['imported'] += len(chunk) - len(rejected)
+
+    @with_connection
+    def import_subnets(self, rows, chunk_size=IMPORT_CHUNK_SIZE):
+        """
+        Add many subnets at once. rows is an iterable of dicts with subnet
+        (ip_network or its string), description and parent keys, parent
+        being empty for top-level subnets.
+
+        Rows are checked like add_subnet and add_top_level_subnet do,
+        against the subnets of the section loaded beforehand and the
+        subnets imported before them, parents being imported before their
+        children. They are then inserted chunk_size at a time, with one
+        transaction and one multi-row INSERT per chunk, after checking
+        them again in the database under the lock.
+        Returns a dict with the number of imported rows, and the list of
+        (index, row, reason) of rejected rows.
+        """
+        result = {'imported': 0, 'rejected': []}
+        candidates = []
+        for (index, row) in enumerate(rows):
+            try:
+                subnet = ip_network(row['subnet'])
+                parent = None
+                if row.get('parent'):
+                    parent = ip_network(row['parent'])
+            except (KeyError, ValueError) as e:
+                result['rejected'].append(
+                    (index, row, 'Invalid subnet: {}'.format(e)))
+                continue
+            candidates.append((index, row, subnet, parent))
+        # Parents are bigger than their children
+        candidates.sort(key=lambda candidate: (
+            candidate[2].prefixlen, candidate[2].version,
+            candidate[2].network_address))
+
+        subnet_ids = {}
+        children = {}
+        for (network, subnet_id, master_id) in self._get_section_subnets():
+            subnet_ids[network] = subnet_id
+            children.setdefault(master_id, []).append(network)
+        top_level_addresses = set(network.network_address
+                                  for network in subnet_ids)
+        self.cur.execute('SELECT DISTINCT subnetId FROM ipaddresses')
+        used_subnet_ids = set(int(row[0]) for row in self.cur)
+
+        chunk = []
+        for (index, row, subnet, parent) in candidates:
+            if parent is not None and subnet_ids.get(parent, 0) is None:
+                # The parent is in the chunk: insert it to know its id
+                self._import_subnet_chunk(chunk, subnet_ids, children,
+                                          result)
+                chunk = []
+            reason = None
+            if subnet in subnet_ids:
+                reason = 'Subnet {} already registered'.format(subnet)
+            elif parent is None:
+                if subnet.network_address in top_level_addresses:
+                    reason = 'Subnet {} already registered'.format(subnet)
+                parent_id = 0
+            elif parent not in subnet_ids:
+                reason = 'Unknown parent subnet {}'.format(parent)
+            else:
+                parent_id = subnet_ids[parent]
+                if (not subnet.overlaps(parent) or
+                        subnet.prefixlen < parent.prefixlen):
+                    reason = 'Subnet {} is not a child of {}'.format(
+                        subnet, parent)
+                elif parent_id in used_subnet_ids:
+                    reason = ('Parent subnet {} must not contain any '
+                              'allocated IP address!'.format(parent))
+                else:
+                    for child in children.get(parent_id, ()):
+                        if child.overlaps(subnet):
+                            reason = ('Candidate subnet overlaps with {}'
+                                      ''.format(child))
+                            break
+            if reason is not None:
+                result['rejected'].append((index, row, reason))
+                continue
+
+            # Its id is known once inserted
+            subnet_ids[subnet] = None
+            children.setdefault(parent_id, []).append(subnet)
+            top_level_addresses.add(subnet.network_address)
+            chunk.append((index, row, subnet, parent_id))
+            if len(chunk) >= chunk_size:
+                self._import_subnet_chunk(chunk, subnet_ids, children,
+                                          result)
+                chunk = []
+        if chunk:
+            self._import_subnet_chunk(chunk, subnet_ids, children, result)
+        return result
+
+    def _check_subnet_chunk(self, chunk):
+        """
+        Return the reasons to reject rows of chunk by index, checking them
+        in the database against the subnets and addresses written since
+        they were loaded
+        """
+        addresses = ', '.join("'%d'" % subnet.network_address
+                              for (_, _, subnet, _) in chunk)
+        self.cur.execute("SELECT subnet, mask FROM subnets "
+                         "WHERE sectionId = %d AND subnet IN (%s)"
+                         % (self.section_id, addresses))
+        registered = set((int(row[0]), int(row[1] or 0)) for row in self.cur)
+        registered_addresses = set(address for (address, _) in registered)
+
+        parent_ids = sorted(set(parent_id for (_, _, _, parent_id) in chunk
+                                if parent_id))
+        known_ids = set()
+        used_ids = set()
+        siblings = {}
+        if parent_ids:
+            parent_list = ', '.join('%d' % parent_id
+                                    for parent_id in parent_ids)
+            self.cur.execute('SELECT id FROM subnets WHERE id IN (%s)'
+                             % parent_list)
+            known_ids = set(int(row[0]) for row in self.cur)
+            self.cur.execute('SELECT DISTINCT subnetId FROM ipaddresses '
+                             'WHERE subnetId IN (%s)' % parent_list)
+            used_ids = set(int(row[0]) for row in self.cur)
+            self.cur.execute('SELECT subnet, mask, masterSubnetId '
+                             'FROM subnets WHERE masterSubnetId IN (%s)'
+                             % parent_list)
+            for row in self.cur:
+                if not row[0]:
+                    # Folders have no subnet
+                    continue
+                siblings.setdefault(int(row[2]), []).append(ip_network(
+                    '{}/{}'.format(ip_address(int(row[0])), int(row[1]))))
+
+        reasons = {}
+        for (index, _, subnet, parent_id) in chunk:
+            if ((int(subnet.network_address), subnet.prefixlen) in registered
+                    or (not parent_id and int(subnet.network_address) in
+                        registered_addresses)):
+                reasons[index] = 'Subnet {} already registered'.format(
+                    subnet)
+            elif not parent_id:
+                continue
+            elif parent_id not in known_ids:
+                reasons[index] = 'Unknown parent subnet id {}'.format(
+                    parent_id)
+            elif parent_id in used_ids:
+                reasons[index] = ('Parent subnet id {} must not contain any '
+                                  'allocated IP address!'.format(parent_id))
+            else:
+                for sibling in siblings.get(parent_id, ()):
+                    if sibling.overlaps(subnet):
+                        reasons[index] = ('Candidate subnet overlaps with {}'
+                                          ''.format(sibling))
+                        break
+        return reasons
+
+    def _import_subnet_chunk(self, chunk, subnet_ids, children, result):
+        if not chunk:
+            return
+        lock_ids = [parent_id for (_, _, _, parent_id) in chunk]
+        rejected = []
+        reasons = {}
+        try:
+            with MySQLLock(self, lock_ids):
+                # Subnets and addresses may have been added concurrently
+                # since the checks of import_subnets
+                reasons = self._check_subnet_chunk(chunk)
+                for candidate in chunk:
+                    if candidate[0] in reasons:
+                        rejected.append(candidate)
+                chunk = [candidate for candidate in chunk
+                         if candidate[0] not in reasons]
+                if not chunk:
+                    return
+                self.cur.execute(
+                    'INSERT INTO subnets '
+                    '(subnet, mask, sectionId, description, vrfId, '
+                    'masterSubnetId, vlanId, permissions) VALUES {}'.format(
+                        ', '.join(
+                            '(\'{:d}\', \'{}\', \'{}\', \'{}\', '
+                            '\'{}\', \'{}\', \'{}\', \'{}\')'.format(
+                                int(subnet.network_address),
+                                subnet.prefixlen,
+                                self.section_id,
+                                self._escape(row.get('description')),
+                                self.subnet_options['vrf_id'],
+                                parent_id,
+                                self.subnet_options['vlan_id'],
+                                self.subnet_options['permissions'])
+                            for (_, row, subnet, parent_id) in chunk)))
+                self.cur.execute(
+                    "SELECT subnet, mask, id FROM subnets "
+                    "WHERE sectionId = %d AND subnet IN (%s)"
+                    % (self.section_id,
+                       ', '.join("'%d'" % subnet.network_address
+                                 for (_, _, subnet, _) in chunk)))
+                for row in self.cur:
+                    network = ip_network('{}/{}'.format(
+                        ip_address(int(row[0])), int(row[1])))
+                    if subnet_ids.get(network, 0) is None:
+                        subnet_ids[network] = int(row[2])
+        except self._driver_error as e:
+            reasons.update((index, str(e)) for (index, _, _, _) in chunk)
+            rejected.extend(chunk)
+            chunk = []
+        finally:
+            for (index, row, subnet, parent_id) in rejected:
+                # Children of the rejected subnets get rejected too
+                del subnet_ids[subnet]
+                children[parent_id].remove(subnet)
+                result['rejected'].append((index, row, reasons[index]))
+        for (_, _, subnet, _) in chunk:
+            self._invalidate_subnet(subnet)
+        result['imported'] += len(chunk)
+
+    @with_read_connection
     def get_ip(self, ip):
         self.cur.execute("SELECT ip.ip_addr,ip.description,ip.%s,\
                               s.mask,s.description,v.number,ip.mac\
@@ -511,17 +2258,12 @@ class PHPIPAM(AbstractIPAM):
                          % (self.hostname_db_field, ip, self.used_ip_state))
         row = self.cur.fetchone()
         if row is not None:
-            item = {}
-            net_ip_address = ip_address(int(row[0]))
-            item['ip'] = ip_interface(str(net_ip_address) + "/" + row[3])
-            item['description'] = row[1]
-            item['dnsname'] = row[2]
-            item['subnet_name'] = row[4]
-            item['vlan_id'] = row[5]
-            item['mac'] = row[6]
+            item = self._ip_interface_item(row[0], row[3], row[1], row[2],
+                                           row[4], row[5], row[6])
             return item
         return None
 
+    @with_read_connection
     def get_hostname_by_ip(self, ip):
         self.cur.execute("SELECT %s FROM ipaddresses \
                          WHERE ip_addr='%d'"
@@ -531,6 +2273,7 @@ class PHPIPAM(AbstractIPAM):
             return row[0]
         return None
 
+    @with_read_connection
     def get_description_by_ip(self, ip):
         self.cur.execute("SELECT description FROM ipaddresses \
                          WHERE ip_addr='%d'"
@@ -540,6 +2283,7 @@ class PHPIPAM(AbstractIPAM):
             return row[0]
         return None
 
+    @with_read_connection
     def get_mac_by_ip(self, ip):
         self.cur.execute("SELECT mac FROM ipaddresses \
                          WHERE ip_addr='%d'"
@@ -549,14 +2293,97 @@ class PHPIPAM(AbstractIPAM):
             return row[0]
         return None
 
+    @with_connection
+    def _get_rows_by_ips(self, ips, query):
+        """
+        Run query once per chunk of ips, substituting its {ips} field with
+        the chunk addresses. Return a dict mapping each address of ips to
+        the first row found for it, whose first column must be ip_addr.
+        """
+        ips = list(ips)
+        rows_by_ip = {}
+        for i in range(0, len(ips), IN_QUERY_CHUNK_SIZE):
+            chunk = ips[i:i + IN_QUERY_CHUNK_SIZE]
+            self.cur.execute(query.format(ips=', '.join(
+                "'%d'" % int(ip) for ip in chunk)))
+            for row in self.cur:
+                rows_by_ip.setdefault(int(row[0]), row)
+        return dict((ip, rows_by_ip.get(int(ip))) for ip in ips)
+
+    @with_read_connection
+    def get_ips(self, ips):
+        """
+        Batch version of get_ip. Return a dict mapping each address of ips
+        to its get_ip result, or None.
+        """
+        rows = self._get_rows_by_ips(
+            ips,
+            "SELECT ip.ip_addr,ip.description,ip.%s,\
+                 s.mask,s.description,v.number,ip.mac\
+             FROM ipaddresses ip\
+             LEFT JOIN subnets s ON\
+                 ip.subnetId = s.id\
+             LEFT JOIN vlans v ON\
+                 s.vlanId = v.vlanId\
+             WHERE ip.ip_addr IN ({ips})\
+                 AND ip.state = %d"
+            % (self.hostname_db_field, self.used_ip_state))
+        items = {}
+        for (ip, row) in rows.items():
+            if row is not None:
+                row = self._ip_interface_item(row[0], row[3], row[1], row[2],
+                                              row[4], row[5], row[6])
+            items[ip] = row
+        return items
+
+    def _get_field_by_ips(self, ips, field):
+        rows = self._get_rows_by_ips(
+            ips, "SELECT ip_addr, %s FROM ipaddresses \
+                 WHERE ip_addr IN ({ips})" % field)
+        return dict((ip, None if row is None else row[1])
+                    for (ip, row) in rows.items())
+
+    @with_read_connection
+    def get_hostnames_by_ips(self, ips):
+        """
+        Batch version of get_hostname_by_ip. Return a dict mapping each
+        address of ips to its hostname, or None.
+        """
+        return self._get_field_by_ips(ips, self.hostname_db_field)
+
+    @with_read_connection
+    def get_descriptions_by_ips(self, ips):
+        """
+        Batch version of get_description_by_ip. Return a dict mapping each
+        address of ips to its description, or None.
+        """
+        return self._get_field_by_ips(ips, 'description')
+
+    @with_read_connection
+    def get_macs_by_ips(self, ips):
+        """
+        Batch version of get_mac_by_ip. Return a dict mapping each address
+        of ips to its MAC, or None.
+        """
+        return self._get_field_by_ips(ips, 'mac')
+
     def get_ipnetwork_list_by_desc(self, description):
         """
         Wrapper for backward compatibility
         """
         return self.get_ip_interface_list_by_desc(description)
 
+    @with_read_connection
     def get_ip_interface_list_by_desc(self, description):
-        self.cur.execute("SELECT ip.ip_addr,ip.description,ip.%s,\
+        return list(self.iter_ip_interfaces_by_desc(description))
+
+    def iter_ip_interfaces_by_desc(self, description, fetch_size=None):
+        """
+        Streaming version of get_ip_interface_list_by_desc. Without a
+        connection pool, the client can't run other queries until the
+        generator is exhausted or closed.
+        """
+        rows = self._iter_rows("SELECT ip.ip_addr,ip.description,ip.%s,\
                               s.mask,s.description,v.number,ip.mac\
                           FROM ipaddresses ip\
                           LEFT JOIN subnets s ON\
@@ -565,22 +2392,16 @@ class PHPIPAM(AbstractIPAM):
                               s.vlanId = v.vlanId\
                           WHERE ip.description LIKE '%s'\
                               AND ip.state = %d"
-                         % (self.hostname_db_field,
-                            description,
-                            self.used_ip_state))
-        iplist = list()
-        for row in self.cur:
-            item = {}
-            net_ip_address = ip_address(int(row[0]))
-            item['ip'] = ip_interface(str(net_ip_address) + "/" + row[3])
-            item['description'] = row[1]
-            item['dnsname'] = row[2]
-            item['subnet_name'] = row[4]
-            item['vlan_id'] = row[5]
-            item['mac'] = row[6]
-            iplist.append(item)
-        return iplist
-
+                               % (self.hostname_db_field,
+                                  description,
+                                  self.used_ip_state), fetch_size,
+                               'iter_ip_interfaces_by_desc')
+        for row in rows:
+            item = self._ip_interface_item(row[0], row[3], row[1], row[2],
+                                           row[4], row[5], row[6])
+            yield item
+
+    @with_read_connection
     def get_subnet_with_ips(self, subnet):
         """"
         Returns a subnet with all its allocated ip addresses
@@ -602,12 +2423,8 @@ class PHPIPAM(AbstractIPAM):
                 ipam_subnet['subnet'] = subnet
                 ipam_subnet['description'] = row[4]
                 ipam_subnet['vlan_id'] = row[5]
-            item = {}
-            item['ip'] = ip_address(int(row[0]))
-            item['description'] = row[1]
-            item['dnsname'] = row[2]
-            item['state'] = row[3]
-            item['mac'] = row[6]
+            item = self._ip_address_item(row[0], row[1], row[2], row[3],
+                                         row[6])
             iplist.append(item)
         ipam_subnet['ips'] = iplist
         return ipam_subnet
@@ -618,6 +2435,7 @@ class PHPIPAM(AbstractIPAM):
         """
         return self.get_ip_interface_by_desc(description)
 
+    @with_read_connection
     def get_ip_interface_by_desc(self, description):
         iplist = self.get_ip_interface_list_by_desc(description)
         if iplist == []:
@@ -631,28 +2449,31 @@ class PHPIPAM(AbstractIPAM):
         """
         return self.get_ip_interface_list_by_subnet_name(subnet_name)
 
+    @with_read_connection
     def get_ip_interface_list_by_subnet_name(self, subnet_name):
-        self.cur.execute("SELECT ip.ip_addr,ip.description,ip.%s,\
+        return list(self.iter_ip_interfaces_by_subnet_name(subnet_name))
+
+    def iter_ip_interfaces_by_subnet_name(self, subnet_name, fetch_size=None):
+        """
+        Streaming version of get_ip_interface_list_by_subnet_name. Without a
+        connection pool, the client can't run other queries until the
+        generator is exhausted or closed.
+        """
+        rows = self._iter_rows("SELECT ip.ip_addr,ip.description,ip.%s,\
                               s.mask,s.description,ip.mac\
                           FROM ipaddresses ip\
-                          LEFT JOIN subnets s ON\
+                          JOIN subnets s ON\
                               ip.subnetId = s.id\
                           WHERE s.description LIKE '%s'\
                               AND ip.state = %d"
-                         % (self.hostname_db_field,
-                            subnet_name,
-                            self.used_ip_state))
-        iplist = list()
-        for row in self.cur:
-            item = {}
-            net_ip_address = ip_address(int(row[0]))
-            item['ip'] = ip_interface(str(net_ip_address) + "/" + row[3])
-            item['description'] = row[1]
-            item['dnsname'] = row[2]
-            item['subnet_name'] = row[4]
-            item['mac'] = row[5]
-            iplist.append(item)
-        return iplist
+                               % (self.hostname_db_field,
+                                  subnet_name,
+                                  self.used_ip_state), fetch_size,
+                               'iter_ip_interfaces_by_subnet_name')
+        for row in rows:
+            item = self._subnet_ip_interface_item(row[0], row[3], row[1],
+                                                  row[2], row[4], row[5])
+            yield item
 
     def get_ipnetwork_by_subnet_name(self, subnet_name):
         """
@@ -660,6 +2481,7 @@ class PHPIPAM(AbstractIPAM):
         """
         return self.get_ip_interface_by_subnet_name(subnet_name)
 
+    @with_read_connection
     def get_ip_interface_by_subnet_name(self, subnet_name):
         iplist = self.get_ip_interface_list_by_subnet_name(subnet_name)
         if iplist == []:
@@ -667,22 +2489,27 @@ class PHPIPAM(AbstractIPAM):
         else:
             return iplist[0]
 
+    @with_read_connection
     def get_ip_list_by_desc(self, description):
-        self.cur.execute("SELECT ip_addr,description,%s,state,mac \
-                         FROM ipaddresses \
-                         WHERE description LIKE '%s'"
-                         % (self.hostname_db_field, description))
-        iplist = list()
-        for row in self.cur:
-            item = {}
-            item['ip'] = ip_address(int(row[0]))
-            item['description'] = row[1]
-            item['dnsname'] = row[2]
-            item['state'] = int(row[3])
-            item['mac'] = row[4]
-            iplist.append(item)
-        return iplist
+        return list(self.iter_ips_by_desc(description))
 
+    def iter_ips_by_desc(self, description, fetch_size=None):
+        """
+        Streaming version of get_ip_list_by_desc. Without a connection pool, the
+        client can't run other queries until the generator is exhausted or
+        closed.
+        """
+        rows = self._iter_rows("SELECT ip_addr,description,%s,state,mac \
+                               FROM ipaddresses \
+                               WHERE description LIKE '%s'"
+                               % (self.hostname_db_field, description), fetch_size,
+                               'iter_ips_by_desc')
+        for row in rows:
+            item = self._ip_address_item(row[0], row[1], row[2],
+                                         int(row[3]), row[4])
+            yield item
+
+    @with_read_connection
     def get_ip_by_desc(self, description):
         iplist = self.get_ip_list_by_desc(description)
         if iplist == []:
@@ -690,6 +2517,7 @@ class PHPIPAM(AbstractIPAM):
         else:
             return iplist[0]
 
+    @with_read_connection
     def get_ip_by_desc_and_subnet(self, description, subnet):
         self.cur.execute("SELECT id \
                          FROM subnets \
@@ -717,22 +2545,27 @@ class PHPIPAM(AbstractIPAM):
                 description, subnet)
         )
 
+    @with_read_connection
     def get_ip_list_by_mac(self, mac):
-        self.cur.execute("SELECT ip_addr,description,%s,state,mac \
-                         FROM ipaddresses \
-                         WHERE mac LIKE '%s'"
-                         % (self.hostname_db_field, mac))
-        iplist = list()
-        for row in self.cur:
-            item = {}
-            item['ip'] = ip_address(int(row[0]))
-            item['description'] = row[1]
-            item['dnsname'] = row[2]
-            item['state'] = int(row[3])
-            item['mac'] = row[4]
-            iplist.append(item)
-        return iplist
+        return list(self.iter_ips_by_mac(mac))
 
+    def iter_ips_by_mac(self, mac, fetch_size=None):
+        """
+        Streaming version of get_ip_list_by_mac. Without a connection pool, the
+        client can't run other queries until the generator is exhausted or
+        closed.
+        """
+        rows = self._iter_rows("SELECT ip_addr,description,%s,state,mac \
+                               FROM ipaddresses \
+                               WHERE mac LIKE '%s'"
+                               % (self.hostname_db_field, mac), fetch_size,
+                               'iter_ips_by_mac')
+        for row in rows:
+            item = self._ip_address_item(row[0], row[1], row[2],
+                                         int(row[3]), row[4])
+            yield item
+
+    @with_read_connection
     def get_ip_by_mac(self, mac):
         iplist = self.get_ip_list_by_mac(mac)
         if iplist == []:
@@ -740,6 +2573,7 @@ class PHPIPAM(AbstractIPAM):
         else:
             return iplist[0]
 
+    @with_read_connection
     def get_children_subnet_list(self, parent_subnet):
         netlist = list()
         parent_subnet_id = self.find_subnet_id(parent_subnet)
@@ -747,46 +2581,125 @@ class PHPIPAM(AbstractIPAM):
                          WHERE masterSubnetId = '%i'"
                          % parent_subnet_id)
         for row in self.cur:
-            item = {}
-            subnet = str(ip_address(int(row[0])))
-            item['subnet'] = ip_network("%s/%s" % (subnet, row[1]))
-            item['description'] = row[2]
-            item['vlan_id'] = row[3]
+            item = self._subnet_item(row[0], row[1], row[2], row[3])
             netlist.append(item)
         return netlist
 
+    @with_read_connection
+    def get_section_utilization(self):
+        """
+        Return the utilization of every subnet of the section, from a
+        single aggregate query, sorted by subnet. Each item holds the
+        subnet, its description and vlan_id, and:
+        - size: number of addresses of the subnet
+        - allocated, reserved: number of addresses registered in it, and
+          how many of them are reserved
+        - children, covered: number of direct children subnets, and of
+          addresses they cover
+        - free: free host addresses of a subnet without children, or
+          addresses not covered by children
+        - utilization: used ratio of the host addresses of a subnet without
+          children, or of the addresses of a subnet with children
+        """
+        self.cur.execute("SELECT s.id,s.subnet,s.mask,s.description,\
+                              s.vlanId,s.masterSubnetId,COUNT(ip.id),\
+                              SUM(CASE WHEN ip.state = %d THEN 1 ELSE 0 END)\
+                          FROM subnets s\
+                          LEFT JOIN ipaddresses ip ON\
+                              ip.subnetId = s.id\
+                          WHERE s.sectionId = %d\
+                          GROUP BY s.id,s.subnet,s.mask,s.description,\
+                              s.vlanId,s.masterSubnetId"
+                         % (self.reserved_ip_state, self.section_id))
+        items = {}
+        parents = {}
+        for row in self.cur:
+            if not row[1]:
+                # Folders have no subnet
+                continue
+            subnet = ip_network("%s/%s" % (ip_address(int(row[1])),
+                                           row[2] or 0))
+            items[int(row[0])] = {
+                'subnet': subnet,
+                'description': row[3],
+                'vlan_id': row[4],
+                'size': subnet.num_addresses,
+                'allocated': int(row[6]),
+                'reserved': int(row[7] or 0),
+                'children': 0,
+                'covered': 0,
+            }
+            parents[int(row[0])] = int(row[5] or 0)
+        for (subnet_id, parent_id) in parents.items():
+            parent = items.get(parent_id)
+            if parent is not None:
+                parent['children'] += 1
+                parent['covered'] += items[subnet_id]['size']
+        for item in items.values():
+            if item['children']:
+                capacity = item['size']
+                item['free'] = capacity - item['covered']
+            else:
+                first_host, last_host = self._get_host_range(item['subnet'])
+                capacity = last_host - first_host + 1
+                item['free'] = max(capacity - item['allocated'], 0)
+            item['utilization'] = float(capacity - item['free']) / capacity
+        return sorted(items.values(), key=lambda item: (
+            item['subnet'].version, item['subnet'].network_address,
+            item['subnet'].prefixlen))
+
+    @with_read_connection
+    def get_subnet_tree(self):
+        """
+        Return the subnets of the section as a SubnetTree, loaded with a
+        single query. Nodes hold the subnet as returned by get_subnet.
+        """
+        self.cur.execute("SELECT id,subnet,mask,description,vlanId,\
+                              masterSubnetId FROM subnets \
+                         WHERE sectionId = %d" % self.section_id)
+        rows = []
+        for row in self.cur:
+            if row[1]:
+                subnet = self._subnet_item(row[1], row[2], row[3], row[4])
+                network = ip_network("%s/%s" % (ip_address(int(row[1])),
+                                                row[2] or 0))
+            else:
+                # Folders have no subnet
+                subnet = network = None
+            rows.append((int(row[0]), network, subnet, int(row[5] or 0)))
+        return SubnetTree.build(rows)
+
+    @with_read_connection
     def get_subnet(self, subnet):
         self.cur.execute("SELECT subnet,mask,description,vlanId FROM subnets \
                           where subnet = '{}' AND mask = '{}'".format(int(subnet.network_address),
                                                                       subnet.prefixlen))
         row = self.cur.fetchone()
         if row is not None:
-            item = {}
-            subnet = str(ip_address(int(row[0])))
-            netmask = row[1]
-            item['subnet'] = ip_network("{}/{}".format(subnet, netmask))
-            item['description'] = row[2]
-            item['vlan_id'] = row[3]
+            item = self._subnet_item(row[0], row[1], row[2], row[3])
             return item
         return None
 
+    @with_read_connection
     def get_subnet_list_by_desc(self, description):
-        self.cur.execute("SELECT subnet,mask,description,vlanId FROM subnets \
-                         WHERE description LIKE '%s'"
-                         % description)
-        netlist = list()
-        for row in self.cur:
-            item = {}
-            subnet = str(ip_address(int(row[0])))
-            netmask = row[1]
-            if netmask == '':
-                netmask = 0
-            item['subnet'] = ip_network("%s/%s" % (subnet, netmask))
-            item['description'] = row[2]
-            item['vlan_id'] = row[3]
-            netlist.append(item)
-        return netlist
+        return list(self.iter_subnets_by_desc(description))
 
+    def iter_subnets_by_desc(self, description, fetch_size=None):
+        """
+        Streaming version of get_subnet_list_by_desc. Without a connection
+        pool, the client can't run other queries until the generator is
+        exhausted or closed.
+        """
+        rows = self._iter_rows("SELECT subnet,mask,description,vlanId \
+                               FROM subnets \
+                               WHERE description LIKE '%s'"
+                               % description, fetch_size,
+                               'iter_subnets_by_desc')
+        for row in rows:
+            item = self._subnet_item(row[0], row[1], row[2], row[3])
+            yield item
+
+    @with_read_connection
     def get_subnet_by_desc(self, description):
         subnetlist = self.get_subnet_list_by_desc(description)
         if subnetlist == []:
@@ -794,20 +2707,18 @@ class PHPIPAM(AbstractIPAM):
         else:
             return subnetlist[0]
 
+    @with_read_connection
     def get_subnet_by_id(self, subnetid):
         self.cur.execute("SELECT subnet,mask,description,vlanId FROM subnets \
                          WHERE id=%d"
                          % subnetid)
         row = self.cur.fetchone()
         if row is not None:
-            item = {}
-            subnet = str(ip_address(int(row[0])))
-            item['subnet'] = ip_network("%s/%s" % (subnet, row[1]))
-            item['description'] = row[2]
-            item['vlan_id'] = row[3]
+            item = self._subnet_item(row[0], row[1], row[2], row[3])
             return item
         return None
 
+    @with_read_connection
     def get_num_ips_by_desc(self, description):
         self.cur.execute("SELECT COUNT(ip_addr) FROM ipaddresses \
                          WHERE description LIKE '%s'\
@@ -816,6 +2727,7 @@ class PHPIPAM(AbstractIPAM):
         row = self.cur.fetchone()
         return int(row[0])
 
+    @with_read_connection
     def get_num_subnets_by_desc(self, description):
         self.cur.execute("SELECT COUNT(subnet) FROM subnets \
                          WHERE description LIKE '%s'"
@@ -823,6 +2735,25 @@ class PHPIPAM(AbstractIPAM):
         row = self.cur.fetchone()
         return int(row[0])
 
+    def close(self):
+        """
+        Close the connections opened by this instance, which are opened
+        again when needed. Connections bound by callers are left open.
+        """
+        db = getattr(self, '_db', None)
+        if db is not None:
+            self._db = self._cur = None
+            try:
+                db.close()
+            except sqlite3.ProgrammingError:
+                # Non-pooled SQLite connections can only be closed by the
+                # thread that opened them, e.g. not when garbage collected
+                # in another one: they are released when collected instead
+                pass
+        if getattr(self, 'pool', None) is not None:
+            self.pool.close()
+        for pool in getattr(self, 'replica_pools', ()):
+            pool.close()
+
     def __del__(self):
-        if hasattr(self, 'db'):
-            self.db.close()
+        self.close()
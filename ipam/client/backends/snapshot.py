@@ -0,0 +1,487 @@
+"""
+Read-only IPAM answering lookups from a snapshot file.
+
+export_snapshot dumps the subnets and addresses of a PHPIPAM section into a
+file of fixed-width records sorted by address, followed by a table of
+their strings. SnapshotIPAM maps that file in memory and binary searches
+it, so that processes reading the same snapshot share its pages.
+"""
+from __future__ import unicode_literals
+import mmap
+import os
+import re
+import struct
+from ipaddress import ip_address, ip_interface
+from ipam.client import records
+from ipam.client.abstractipam import AbstractIPAM
+from ipam.client.backends.phpipam import PHPIPAM
+
+MAGIC = b'IPAMSNAP'
+FORMAT_VERSION = 1
+
+# magic, format version, section id, used ip state, subnet count, ip count,
+# and offsets of the subnet, subnet id, ip and string tables
+HEADER = struct.Struct('>8sIIIIIIIII')
+# ip version, address (high and low 64 bits), prefix length, id, master
+# subnet id, description, vlan id, vlan number
+SUBNET = struct.Struct('>BQQBIIIii')
+# ip version, address (high and low 64 bits), subnet id, description,
+# hostname, mac, state
+IP = struct.Struct('>BQQIIIIB')
+# subnet id, index of the subnet in the subnet table
+SUBNET_ID = struct.Struct('>II')
+ADDRESS_KEY = struct.Struct('>BQQ')
+PREFIXLEN_KEY = struct.Struct('>B')
+SUBNET_ID_KEY = struct.Struct('>I')
+STRING_LENGTH = struct.Struct('>I')
+
+# Stand for NULL string offsets and integers
+NULL_STRING = 0xffffffff
+NULL_INT = -1
+
+LOW_64_BITS = (1 << 64) - 1
+
+# os.replace is not available on Python 2
+replace = getattr(os, 'replace', os.rename)
+
+
+def _address_key(version, value):
+    return ADDRESS_KEY.pack(version, value >> 64, value & LOW_64_BITS)
+
+
+def _like(pattern):
+    """
+    Return a function telling whether a value matches a SQL LIKE pattern,
+    ignoring case like the default collations do.
+    """
+    regex = ''.join('.*' if char == '%' else '.' if char == '_'
+                    else re.escape(char) for char in pattern)
+    match = re.compile(regex + r'\Z', re.IGNORECASE | re.DOTALL).match
+    return lambda value: value is not None and match(value) is not None
+
+
+class _StringTable(object):
+    def __init__(self):
+        self.offsets = {}
+        self.chunks = []
+        self.size = 0
+
+    def add(self, value):
+        if value is None:
+            return NULL_STRING
+        offset = self.offsets.get(value)
+        if offset is None:
+            data = value.encode('utf-8')
+            offset = self.size
+            self.offsets[value] = offset
+            self.chunks.append(STRING_LENGTH.pack(len(data)))
+            self.chunks.append(data)
+            self.size += STRING_LENGTH.size + len(data)
+        return offset
+
+
+def _int_or_null(value):
+    if value is None or value == '':
+        return NULL_INT
+    return int(value)
+
+
+def export_snapshot(ipam, path):
+    """
+    Write the subnets and addresses of the section of a PHPIPAM instance
+    to a snapshot at path, leaving folders and their addresses out. The
+    file is replaced at once, so that readers keep using the previous
+    snapshot until they open the new one.
+    """
+    with ipam.connection():
+        ipam.cur.execute('SELECT s.id,s.subnet,s.mask,s.masterSubnetId,'
+                         's.description,s.vlanId,v.number '
+                         'FROM subnets s '
+                         'LEFT JOIN vlans v ON s.vlanId = v.vlanId '
+                         'WHERE s.sectionId = %d' % ipam.section_id)
+        subnet_rows = ipam.cur.fetchall()
+        ipam.cur.execute('SELECT ip.ip_addr,ip.subnetId,ip.description,'
+                         'ip.%s,ip.mac,ip.state '
+                         'FROM ipaddresses ip '
+                         'JOIN subnets s ON ip.subnetId = s.id '
+                         'WHERE s.sectionId = %d'
+                         % (ipam.hostname_db_field, ipam.section_id))
+        ip_rows = ipam.cur.fetchall()
+
+    strings = _StringTable()
+    subnets = []
+    folder_ids = set()
+    for row in subnet_rows:
+        if not row[1]:
+            # Folders have no subnet, and their addresses no prefix length
+            folder_ids.add(int(row[0]))
+            continue
+        address = ip_address(int(row[1]))
+        value = int(address)
+        subnets.append((address.version, value >> 64, value & LOW_64_BITS,
+                        int(row[2] or 0), int(row[0]), int(row[3] or 0),
+                        strings.add(row[4]), _int_or_null(row[5]),
+                        _int_or_null(row[6])))
+    subnets.sort()
+    subnet_ids = sorted((subnet[4], index)
+                        for (index, subnet) in enumerate(subnets))
+    ips = []
+    for row in ip_rows:
+        if int(row[1]) in folder_ids:
+            continue
+        address = ip_address(int(row[0]))
+        value = int(address)
+        ips.append((address.version, value >> 64, value & LOW_64_BITS,
+                    int(row[1]), strings.add(row[2]), strings.add(row[3]),
+                    strings.add(row[4]), int(row[5])))
+    ips.sort()
+
+    subnets_offset = HEADER.size
+    subnet_ids_offset = subnets_offset + len(subnets) * SUBNET.size
+    ips_offset = subnet_ids_offset + len(subnet_ids) * SUBNET_ID.size
+    strings_offset = ips_offset + len(ips) * IP.size
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, ipam.section_id,
+                            ipam.used_ip_state, len(subnets), len(ips),
+                            subnets_offset, subnet_ids_offset, ips_offset,
+                            strings_offset))
+        f.write(b''.join(SUBNET.pack(*subnet) for subnet in subnets))
+        f.write(b''.join(SUBNET_ID.pack(*subnet_id)
+                         for subnet_id in subnet_ids))
+        f.write(b''.join(IP.pack(*ip) for ip in ips))
+        f.write(b''.join(strings.chunks))
+    replace(tmp_path, path)
+
+
+class SnapshotIPAM(AbstractIPAM):
+    """
+    Read-only IPAM answering lookups from a snapshot written by
+    export_snapshot. Address and subnet lookups are binary searches,
+    description and MAC lookups scan the snapshot. Writes raise
+    NotImplementedError.
+    """
+
+    def __init__(self, params):
+        self.path = params['snapshot_path']
+        with open(self.path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.section_id, self.used_ip_state,
+         self._subnet_count, self._ip_count, self._subnets_offset,
+         self._subnet_ids_offset, self._ips_offset,
+         self._strings_offset) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('{} is not an IPAM snapshot of version {}'
+                             ''.format(self.path, FORMAT_VERSION))
+        if params.get('records'):
+            self._ip_interface_item = records.IPInterfaceRecord
+            self._subnet_ip_interface_item = records.SubnetIPInterfaceRecord
+            self._ip_address_item = records.IPAddressRecord
+            self._subnet_item = records.SubnetRecord
+        else:
+            self._ip_interface_item = records.ip_interface_dict
+            self._subnet_ip_interface_item = records.subnet_ip_interface_dict
+            self._ip_address_item = records.ip_address_dict
+            self._subnet_item = records.subnet_dict
+
+    def close(self):
+        self._mm.close()
+
+    def _read_only(self, *args, **kwargs):
+        raise NotImplementedError('IPAM snapshots are read-only')
+
+    add_ip = _read_only
+    add_next_ip = _read_only
+    add_next_ips = _read_only
+    add_top_level_subnet = _read_only
+    add_subnet = _read_only
+    add_next_subnet = _read_only
+    delete_subnet = _read_only
+
+    def _bisect(self, offset, size, count, key):
+        """
+        Return the index of the first record of a sorted table whose
+        leading bytes are not lower than key.
+        """
+        low = 0
+        high = count
+        while low < high:
+            middle = (low + high) // 2
+            start = offset + middle * size
+            if self._mm[start:start + len(key)] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _string(self, offset):
+        if offset == NULL_STRING:
+            return None
+        start = self._strings_offset + offset
+        (length,) = STRING_LENGTH.unpack_from(self._mm, start)
+        start += STRING_LENGTH.size
+        return self._mm[start:start + length].decode('utf-8')
+
+    def _subnet(self, index):
+        """
+        Return the subnet at index as (version, address, prefixlen, id,
+        master id, description offset, vlan id, vlan number)
+        """
+        (version, high, low, prefixlen, subnet_id, master_id, description,
+         vlan_id, vlan_number) = SUBNET.unpack_from(
+            self._mm, self._subnets_offset + index * SUBNET.size)
+        return (version, high << 64 | low, prefixlen, subnet_id, master_id,
+                description, None if vlan_id == NULL_INT else vlan_id,
+                None if vlan_number == NULL_INT else vlan_number)
+
+    def _ip(self, index):
+        """
+        Return the ip at index as (version, address, subnet id, description
+        offset, hostname offset, mac offset, state)
+        """
+        (version, high, low, subnet_id, description, hostname, mac,
+         state) = IP.unpack_from(self._mm, self._ips_offset + index * IP.size)
+        return (version, high << 64 | low, subnet_id, description, hostname,
+                mac, state)
+
+    def _iter_subnets(self):
+        for index in range(self._subnet_count):
+            yield self._subnet(index)
+
+    def _iter_ips(self, start=0):
+        for index in range(start, self._ip_count):
+            yield self._ip(index)
+
+    def _iter_ips_in_range(self, version, first, last):
+        start = self._bisect(self._ips_offset, IP.size, self._ip_count,
+                             _address_key(version, first))
+        for ip in self._iter_ips(start):
+            if ip[0] != version or ip[1] > last:
+                break
+            yield ip
+
+    def _iter_ips_by_address(self, ip):
+        return self._iter_ips_in_range(ip.version, int(ip), int(ip))
+
+    def _find_subnet(self, subnet):
+        key = (_address_key(subnet.version, int(subnet.network_address)) +
+               PREFIXLEN_KEY.pack(subnet.prefixlen))
+        index = self._bisect(self._subnets_offset, SUBNET.size,
+                             self._subnet_count, key)
+        if index < self._subnet_count:
+            found = self._subnet(index)
+            if (found[0], found[1], found[2]) == (
+                    subnet.version, int(subnet.network_address),
+                    subnet.prefixlen):
+                return found
+        return None
+
+    def _find_subnet_by_id(self, subnet_id):
+        index = self._bisect(self._subnet_ids_offset, SUBNET_ID.size,
+                             self._subnet_count,
+                             SUBNET_ID_KEY.pack(subnet_id))
+        if index < self._subnet_count:
+            (found_id, subnet_index) = SUBNET_ID.unpack_from(
+                self._mm, self._subnet_ids_offset + index * SUBNET_ID.size)
+            if found_id == subnet_id:
+                return self._subnet(subnet_index)
+        return None
+
+    def _make_subnet_item(self, subnet):
+        return self._subnet_item(subnet[1], subnet[2],
+                                 self._string(subnet[5]), subnet[6])
+
+    def _make_ip_interface_item(self, ip):
+        subnet = self._find_subnet_by_id(ip[2])
+        return self._ip_interface_item(
+            ip[1], subnet[2], self._string(ip[3]), self._string(ip[4]),
+            self._string(subnet[5]), subnet[7], self._string(ip[5]))
+
+    def _make_ip_address_item(self, ip):
+        return self._ip_address_item(ip[1], self._string(ip[3]),
+                                     self._string(ip[4]), ip[6],
+                                     self._string(ip[5]))
+
+    def find_subnet_id(self, subnet):
+        if hasattr(subnet, 'network'):
+            # This is an interface
+            subnet = subnet.network
+        found = self._find_subnet(subnet)
+        if found is None:
+            raise ValueError("Unable to get subnet id from snapshot "
+                             "for subnet {}".format(subnet))
+        return found[3]
+
+    def get_next_free_ip(self, subnet):
+        subnet_id = self.find_subnet_id(subnet)
+        first_host, last_host = PHPIPAM._get_host_range(subnet)
+        usedips = [
+            ip[1] for ip in self._iter_ips_in_range(
+                subnet.version, first_host, last_host)
+            if ip[2] == subnet_id
+        ]
+        candidate_ip = next(
+            PHPIPAM._iter_free_ips(usedips, first_host, last_host), None)
+        if candidate_ip is None:
+            raise ValueError("Subnet %s/%s is full"
+                             % (subnet.network_address, subnet.prefixlen))
+        return ip_interface("%s/%d" % (
+            PHPIPAM._get_address(subnet, candidate_ip), subnet.prefixlen))
+
+    def get_ip(self, ip):
+        for found in self._iter_ips_by_address(ip):
+            if found[6] == self.used_ip_state:
+                return self._make_ip_interface_item(found)
+        return None
+
+    def _get_ip_field(self, ip, field):
+        for found in self._iter_ips_by_address(ip):
+            return self._string(found[field])
+        return None
+
+    def get_hostname_by_ip(self, ip):
+        return self._get_ip_field(ip, 4)
+
+    def get_description_by_ip(self, ip):
+        return self._get_ip_field(ip, 3)
+
+    def get_mac_by_ip(self, ip):
+        return self._get_ip_field(ip, 5)
+
+    def get_ips(self, ips):
+        return dict((ip, self.get_ip(ip)) for ip in ips)
+
+    def get_hostnames_by_ips(self, ips):
+        return dict((ip, self.get_hostname_by_ip(ip)) for ip in ips)
+
+    def get_descriptions_by_ips(self, ips):
+        return dict((ip, self.get_description_by_ip(ip)) for ip in ips)
+
+    def get_macs_by_ips(self, ips):
+        return dict((ip, self.get_mac_by_ip(ip)) for ip in ips)
+
+    def get_ip_interface_list_by_desc(self, description):
+        match = _like(description)
+        return [self._make_ip_interface_item(ip) for ip in self._iter_ips()
+                if ip[6] == self.used_ip_state and
+                match(self._string(ip[3]))]
+
+    def get_ip_interface_by_desc(self, description):
+        iplist = self.get_ip_interface_list_by_desc(description)
+        return iplist[0] if iplist else None
+
+    def get_ip_interface_list_by_subnet_name(self, subnet_name):
+        match = _like(subnet_name)
+        subnets = dict((subnet[3], subnet) for subnet in self._iter_subnets()
+                       if match(self._string(subnet[5])))
+        iplist = []
+        for ip in self._iter_ips():
+            subnet = subnets.get(ip[2])
+            if subnet is not None and ip[6] == self.used_ip_state:
+                iplist.append(self._subnet_ip_interface_item(
+                    ip[1], subnet[2], self._string(ip[3]),
+                    self._string(ip[4]), self._string(subnet[5]),
+                    self._string(ip[5])))
+        return iplist
+
+    def get_ip_interface_by_subnet_name(self, subnet_name):
+        iplist = self.get_ip_interface_list_by_subnet_name(subnet_name)
+        return iplist[0] if iplist else None
+
+    def get_ip_list_by_desc(self, description):
+        match = _like(description)
+        return [self._make_ip_address_item(ip) for ip in self._iter_ips()
+                if match(self._string(ip[3]))]
+
+    def get_ip_by_desc(self, description):
+        iplist = self.get_ip_list_by_desc(description)
+        return iplist[0] if iplist else None
+
+    def get_ip_by_desc_and_subnet(self, description, subnet):
+        address = ip_address(subnet)
+        index = self._bisect(self._subnets_offset, SUBNET.size,
+                             self._subnet_count,
+                             _address_key(address.version, int(address)))
+        found = None
+        if index < self._subnet_count:
+            found = self._subnet(index)
+        if found is None or found[:2] != (address.version, int(address)):
+            raise ValueError(
+                "Unable to get subnet id from snapshot "
+                "for this subnet: {}".format(subnet)
+            )
+
+        match = _like(description)
+        for ip in self._iter_ips():
+            if ip[2] == found[3] and match(self._string(ip[3])):
+                return ip_address(ip[1])
+        raise ValueError(
+            "Unable to get {} in the subnet {} from snapshot".format(
+                description, subnet)
+        )
+
+    def get_ip_list_by_mac(self, mac):
+        match = _like(mac)
+        return [self._make_ip_address_item(ip) for ip in self._iter_ips()
+                if match(self._string(ip[5]))]
+
+    def get_ip_by_mac(self, mac):
+        iplist = self.get_ip_list_by_mac(mac)
+        return iplist[0] if iplist else None
+
+    def get_children_subnet_list(self, parent_subnet):
+        parent_subnet_id = self.find_subnet_id(parent_subnet)
+        return [self._make_subnet_item(subnet)
+                for subnet in self._iter_subnets()
+                if subnet[4] == parent_subnet_id]
+
+    def get_subnet(self, subnet):
+        found = self._find_subnet(subnet)
+        if found is None:
+            return None
+        return self._make_subnet_item(found)
+
+    def get_subnet_by_id(self, subnetid):
+        found = self._find_subnet_by_id(subnetid)
+        if found is None:
+            return None
+        return self._make_subnet_item(found)
+
+    def get_subnet_list_by_desc(self, description):
+        match = _like(description)
+        return [self._make_subnet_item(subnet)
+                for subnet in self._iter_subnets()
+                if match(self._string(subnet[5]))]
+
+    def get_subnet_by_desc(self, description):
+        subnetlist = self.get_subnet_list_by_desc(description)
+        return subnetlist[0] if subnetlist else None
+
+    def get_subnet_with_ips(self, subnet):
+        ipam_subnet = {}
+        found = self._find_subnet(subnet)
+        iplist = []
+        if found is not None:
+            for ip in self._iter_ips_in_range(
+                    subnet.version, int(subnet.network_address),
+                    int(subnet.broadcast_address)):
+                if ip[2] == found[3]:
+                    iplist.append(self._make_ip_address_item(ip))
+        if iplist:
+            ipam_subnet['subnet'] = subnet
+            ipam_subnet['description'] = self._string(found[5])
+            ipam_subnet['vlan_id'] = found[6]
+        ipam_subnet['ips'] = iplist
+        return ipam_subnet
+
+    def get_num_ips_by_desc(self, description):
+        match = _like(description)
+        return sum(1 for ip in self._iter_ips()
+                   if ip[6] == self.used_ip_state and
+                   match(self._string(ip[3])))
+
+    def get_num_subnets_by_desc(self, description):
+        match = _like(description)
+        return sum(1 for subnet in self._iter_subnets()
+                   if match(self._string(subnet[5])))
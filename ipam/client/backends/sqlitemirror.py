@@ -0,0 +1,291 @@
+"""
+Local SQLite mirror of a phpIPAM section.
+
+refresh_mirror copies the subnets and addresses of the section of a
+PHPIPAM instance, usually backed by MySQL, into a local SQLite database in
+WAL mode. Each refresh replaces the mirrored rows in one transaction:
+readers keep reading the previous rows until it commits, without ever
+being blocked. sync_mirror only applies the rows changed since the last
+refresh or sync, with a ChangeSync. Host-local clients then read the
+mirror with a PHPIPAM instance built from mirror_params, which opens
+read-only connections tuned for lookups, shared between processes by
+SQLite.
+
+Usage, syncing the mirror every minute:
+    IPAM_PASSWORD=secret python -m ipam.client.backends.sqlitemirror \
+        /var/lib/ipam/mirror.db --host db --username ipam \
+        --database phpipam --interval 60
+"""
+from __future__ import unicode_literals
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from itertools import islice
+from ipam.client.backends.changesync import (ChangeSync, SyncStore,
+                                             format_date)
+from ipam.client.backends.phpipam import PHPIPAM
+
+logger = logging.getLogger(__name__)
+
+MIRROR_MMAP_SIZE = 256 * 1024 * 1024
+MIRROR_CACHE_SIZE = 64 * 1024 * 1024
+MIRROR_INTERVAL = 60
+# Syncs of run_mirror between two checksum syncs, finding deleted rows
+MIRROR_CHECKSUM_EVERY = 10
+# Rows copied at once from the source database
+MIRROR_BATCH_SIZE = 10000
+
+# (table, mirrored columns and their types, source query condition) of
+# the tables PHPIPAM reads. {hostname} is the hostname field of the source
+# and {section} its section id.
+MIRROR_TABLES = (
+    ('settings', (('id', 'INTEGER PRIMARY KEY'),
+                  ('version', 'varchar(5)')), ''),
+    ('sections', (('id', 'int(11)'),
+                  ('name', 'varchar(128)'),
+                  ('description', 'text')), 'WHERE id = {section}'),
+    ('vlans', (('vlanId', 'INTEGER PRIMARY KEY'),
+               ('name', 'varchar(255)'),
+               ('number', 'int(4)'),
+               ('description', 'text')), ''),
+    ('subnets', (('id', 'INTEGER PRIMARY KEY'),
+                 ('subnet', 'varchar(255)'),
+                 ('mask', 'varchar(255)'),
+                 ('sectionId', 'int(11)'),
+                 ('description', 'text'),
+                 ('masterSubnetId', 'int(11)'),
+                 ('vlanId', 'int(11)'),
+                 ('isFolder', 'tinyint(1)'),
+                 ('editDate', 'timestamp')), 'WHERE sectionId = {section}'),
+    ('ipaddresses', (('id', 'INTEGER PRIMARY KEY'),
+                     ('subnetId', 'int(11)'),
+                     ('ip_addr', 'varchar(100)'),
+                     ('description', 'varchar(64)'),
+                     ('{hostname}', 'varchar(64)'),
+                     ('mac', 'varchar(20)'),
+                     ('state', 'varchar(1)'),
+                     ('editDate', 'timestamp')),
+     'WHERE subnetId IN (SELECT id FROM subnets WHERE sectionId = {section})'),
+)
+
+# Indexes of the lookups of PHPIPAM. LIKE is case insensitive on SQLite,
+# and only uses NOCASE indexes.
+MIRROR_INDEXES = (
+    ('subnets', 'subnet, mask'),
+    ('subnets', 'masterSubnetId'),
+    ('subnets', 'description COLLATE NOCASE'),
+    ('ipaddresses', 'ip_addr'),
+    ('ipaddresses', 'subnetId, ip_addr'),
+    ('ipaddresses', 'description COLLATE NOCASE'),
+    ('ipaddresses', 'mac COLLATE NOCASE'),
+    # High-water marks of sync_mirror
+    ('subnets', 'editDate'),
+    ('ipaddresses', 'editDate'),
+)
+
+
+def mirror_params(path, section_name='Production', **params):
+    """
+    Return the parameters of a PHPIPAM instance reading the mirror at path
+    """
+    mirror = {
+        'dbtype': 'sqlite',
+        'database_uri': path,
+        'section_name': section_name,
+        'sqlite_read_only': True,
+        'sqlite_mmap_size': MIRROR_MMAP_SIZE,
+        'sqlite_cache_size': MIRROR_CACHE_SIZE,
+    }
+    mirror.update(params)
+    return mirror
+
+
+def _create_schema(db, hostname_field):
+    # The journal mode is persistent: readers open the mirror in WAL mode
+    db.execute('PRAGMA journal_mode = WAL')
+    # A crash may lose the last refresh, but never corrupts the mirror
+    db.execute('PRAGMA synchronous = NORMAL')
+    for (table, columns, _) in MIRROR_TABLES:
+        db.execute('CREATE TABLE IF NOT EXISTS {} ({})'.format(
+            table, ', '.join('"{}" {}'.format(
+                name.format(hostname=hostname_field), column_type)
+                for (name, column_type) in columns)))
+    for (table, columns) in MIRROR_INDEXES:
+        name = '{}_{}'.format(table, '_'.join(
+            column.split()[0] for column in columns.split(', ')))
+        db.execute('CREATE INDEX IF NOT EXISTS "mirror_{}" ON {} ({})'
+                   ''.format(name, table, columns))
+
+
+def refresh_mirror(ipam, path, batch_size=MIRROR_BATCH_SIZE):
+    """
+    Replace the rows of the mirror at path by those of the section of
+    ipam, creating the mirror if needed.
+    Returns the number of rows copied per table.
+    """
+    db = sqlite3.connect(path, isolation_level=None)
+    try:
+        _create_schema(db, ipam.hostname_db_field)
+        counts = {}
+        with ipam.read_connection():
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                for (table, columns, condition) in MIRROR_TABLES:
+                    names = ', '.join(
+                        name.format(hostname=ipam.hostname_db_field)
+                        for (name, _) in columns)
+                    db.execute('DELETE FROM {}'.format(table))
+                    # Streamed from an unbuffered cursor on the bound
+                    # connection, instead of being read in memory at once
+                    rows = ipam._iter_rows('SELECT {} FROM {} {}'.format(
+                        names, table,
+                        condition.format(section=ipam.section_id)),
+                        batch_size, method='refresh_mirror')
+                    insert = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                        table, names, ', '.join('?' * len(columns)))
+                    counts[table] = 0
+                    while True:
+                        batch = list(islice(rows, batch_size))
+                        if not batch:
+                            break
+                        db.executemany(insert, (
+                            tuple(format_date(value) for value in row)
+                            for row in batch))
+                        counts[table] += len(batch)
+                db.execute('COMMIT')
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+        # Fold the refresh into the database file, unless readers are
+        # still using the WAL
+        db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return counts
+    finally:
+        db.close()
+
+
+class MirrorStore(SyncStore):
+    """
+    SyncStore applying changes to the mirror at path
+    """
+    def __init__(self, path, hostname_field):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        _create_schema(self.db, hostname_field)
+
+    def close(self):
+        self.db.close()
+
+    def begin(self):
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        self.db.execute('COMMIT')
+
+    def rollback(self):
+        self.db.execute('ROLLBACK')
+
+    def high_water_marks(self, table):
+        return tuple(self.db.execute(
+            'SELECT MAX(id), MAX(editDate) FROM {}'.format(table)).fetchone())
+
+    def checksums(self, table, range_size):
+        return dict((row[0], (row[1], row[2])) for row in self.db.execute(
+            'SELECT id / {}, COUNT(*), SUM(id) FROM {} GROUP BY 1'
+            ''.format(range_size, table)))
+
+    def ids(self, table, first_id, last_id):
+        return set(row[0] for row in self.db.execute(
+            'SELECT id FROM {} WHERE id >= ? AND id < ?'.format(table),
+            (first_id, last_id)))
+
+    def upsert(self, table, columns, rows):
+        self.db.executemany(
+            'INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                table, ', '.join(columns), ', '.join('?' * len(columns))),
+            rows)
+
+    def delete(self, table, ids):
+        self.db.executemany('DELETE FROM {} WHERE id = ?'.format(table),
+                            ((row_id,) for row_id in ids))
+
+    def replace(self, table, columns, rows):
+        self.db.execute('DELETE FROM {}'.format(table))
+        self.upsert(table, columns, rows)
+
+
+def sync_mirror(ipam, path, checksum=False):
+    """
+    Apply the changes of the section of ipam since the last refresh or
+    sync to the mirror at path, and its deletes when checksum is set.
+    Returns the number of upserted and deleted rows per table.
+    """
+    store = MirrorStore(path, ipam.hostname_db_field)
+    try:
+        return ChangeSync(ipam, store, MIRROR_TABLES).sync(checksum)
+    finally:
+        store.close()
+
+
+def run_mirror(ipam, path, interval=MIRROR_INTERVAL, stop=None,
+               checksum_every=MIRROR_CHECKSUM_EVERY):
+    """
+    Refresh the mirror at path, then sync it every interval seconds, until
+    the stop threading.Event is set after a refresh or sync. One sync out
+    of checksum_every looks for deleted rows. Failures are logged and
+    retried at the next interval.
+    """
+    if stop is None:
+        stop = threading.Event()
+    refreshed = False
+    syncs = 0
+    while True:
+        start = time.time()
+        try:
+            if not refreshed:
+                counts = refresh_mirror(ipam, path)
+                refreshed = True
+            else:
+                syncs += 1
+                counts = sync_mirror(ipam, path,
+                                     checksum=syncs % checksum_every == 0)
+        except Exception:
+            logger.exception('Failed to refresh IPAM mirror %s', path)
+        else:
+            logger.info('Refreshed IPAM mirror %s in %.1fs: %s', path,
+                        time.time() - start, counts)
+        if stop.wait(max(0, interval - (time.time() - start))):
+            return
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('path', help='SQLite mirror to refresh')
+    parser.add_argument('--host')
+    parser.add_argument('--username')
+    parser.add_argument('--database', help='MySQL database name')
+    parser.add_argument('--section', default='Production')
+    parser.add_argument('--interval', type=float, default=0,
+                        help='refresh every interval seconds instead of '
+                             'once')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    ipam = PHPIPAM({
+        'dbtype': 'mysql',
+        'database_host': args.host,
+        'username': args.username,
+        'password': os.environ.get('IPAM_PASSWORD', ''),
+        'database_name': args.database,
+        'section_name': args.section,
+    })
+    if args.interval:
+        run_mirror(ipam, args.path, args.interval)
+    else:
+        refresh_mirror(ipam, args.path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Readers of bulk import files, streaming their rows as dicts to
+PHPIPAM.import_ips and PHPIPAM.import_subnets.
+
+CSV files need a header line naming their columns, e.g.
+ip,hostname,description,mac or subnet,parent,description. JSON files hold
+an array of objects, and JSON Lines files (.jsonl) one object per line.
+"""
+from __future__ import unicode_literals
+import csv
+import io
+import json
+import os
+
+
+def read_csv(f):
+    for row in csv.DictReader(f):
+        yield row
+
+
+def read_json_lines(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def read_json(f):
+    for row in json.load(f):
+        yield row
+
+
+READERS = {
+    '.csv': read_csv,
+    '.json': read_json,
+    '.jsonl': read_json_lines,
+}
+
+
+def read_rows(path):
+    """
+    Yield the rows of a CSV, JSON or JSON Lines file, picking the reader
+    from the file extension.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise ValueError('Unsupported import file {}: expected one of {}'
+                         ''.format(path, ', '.join(sorted(READERS))))
+    with io.open(path, encoding='utf-8', newline='') as f:
+        for row in READERS[extension](f):
+            yield row
@@ -0,0 +1,438 @@
+"""
+Index advisor for the queries PHPIPAM runs.
+
+Calls each PHPIPAM method of a query shape on sample values read from
+its database, records the queries the backend actually runs, and runs
+EXPLAIN on them. Writes, named locks and transactions of the methods are
+skipped, so that nothing is changed. Shapes whose plans scan a whole
+table get recommended indexes on the scanned tables, unless an existing
+index already starts with the same columns. On SQLite, the recommended
+indexes can be created at once.
+
+Usage:
+    python -m ipam.client.indexadvisor --dbtype sqlite \
+        --database-uri phpipam.db --section Production [--apply]
+    IPAM_PASSWORD=secret python -m ipam.client.indexadvisor \
+        --dbtype mysql --host db --username ipam --database phpipam \
+        [--print-sql]
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import re
+import sys
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from ipam.client.backends.changesync import ChangeSync, SyncStore
+from ipam.client.backends.phpipam import PHPIPAM
+from ipam.client.backends.sqlitemirror import MIRROR_TABLES
+from ipaddress import ip_address, ip_interface, ip_network
+
+# Used when the section holds no address
+SAMPLE_IP = ip_interface('10.0.0.1/24')
+SAMPLE_PATTERN = 'ipam-advisor%'
+# High-water marks of a mirror synced up to now
+SAMPLE_SYNC_MARKS = (2 ** 31, '9999-12-31 00:00:00')
+
+
+class _SyncedStore(SyncStore):
+    """
+    Store of a mirror synced up to now, so that syncs fetch no rows
+    """
+    def high_water_marks(self, table):
+        return SAMPLE_SYNC_MARKS
+
+    def checksums(self, table, range_size):
+        return {}
+
+    def ids(self, table, first_id, last_id):
+        return set()
+
+    def upsert(self, table, columns, rows):
+        pass
+
+    def delete(self, table, ids):
+        pass
+
+    def replace(self, table, columns, rows):
+        pass
+
+
+def _sync_mirror(ipam, sample):
+    ChangeSync(ipam, _SyncedStore(), MIRROR_TABLES).sync()
+
+
+# (name, call of the backend on sample values, recommended indexes as
+# (table, columns)) for each query shape. LIKE patterns are prefixes:
+# patterns starting with a wildcard can't use any index.
+QUERY_SHAPES = (
+    ('find_subnet_id',
+     lambda ipam, sample: ipam.find_subnet_id(sample['subnet']),
+     [('subnets', ('subnet', 'mask'))]),
+    ('get_subnet_containing',
+     lambda ipam, sample: ipam.refresh_subnet_trie(),
+     [('subnets', ('sectionId',))]),
+    ('get_children_subnet_list',
+     lambda ipam, sample: ipam.get_children_subnet_list(sample['subnet']),
+     [('subnets', ('subnet', 'mask')), ('subnets', ('masterSubnetId',))]),
+    ('get_subnet_list_by_desc',
+     lambda ipam, sample: ipam.get_subnet_list_by_desc(SAMPLE_PATTERN),
+     [('subnets', ('description',))]),
+    ('get_ip',
+     lambda ipam, sample: ipam.get_ip(sample['ip'].ip),
+     [('ipaddresses', ('ip_addr',)), ('vlans', ('vlanId',))]),
+    ('get_ips',
+     lambda ipam, sample: ipam.get_ips([sample['ip'].ip]),
+     [('ipaddresses', ('ip_addr',)), ('vlans', ('vlanId',))]),
+    ('edit_ip_description',
+     lambda ipam, sample: ipam.edit_ip_description(sample['ip'],
+                                                   'ipam-advisor'),
+     [('subnets', ('subnet', 'mask')),
+      ('ipaddresses', ('subnetId', 'ip_addr'))]),
+    ('get_allocated_ips_by_subnet_id',
+     lambda ipam, sample: ipam.get_allocated_ips_by_subnet_id(
+         sample['subnet_id']),
+     [('ipaddresses', ('subnetId', 'ip_addr'))]),
+    ('get_subnet_with_ips',
+     lambda ipam, sample: ipam.get_subnet_with_ips(sample['subnet']),
+     [('subnets', ('subnet', 'mask')),
+      ('ipaddresses', ('subnetId', 'ip_addr'))]),
+    ('get_ip_list_by_desc',
+     lambda ipam, sample: ipam.get_ip_list_by_desc(SAMPLE_PATTERN),
+     [('ipaddresses', ('description',))]),
+    ('get_ip_by_desc_and_subnet',
+     lambda ipam, sample: ipam.get_ip_by_desc_and_subnet(
+         SAMPLE_PATTERN, sample['subnet'].network_address),
+     [('subnets', ('subnet', 'mask')), ('ipaddresses', ('description',))]),
+    ('get_ip_list_by_mac',
+     lambda ipam, sample: ipam.get_ip_list_by_mac(SAMPLE_PATTERN),
+     [('ipaddresses', ('mac',))]),
+    ('get_ip_interface_list_by_subnet_name',
+     lambda ipam, sample: ipam.get_ip_interface_list_by_subnet_name(
+         SAMPLE_PATTERN),
+     [('subnets', ('description',)),
+      ('ipaddresses', ('subnetId', 'ip_addr'))]),
+    ('sync_mirror', _sync_mirror,
+     [('ipaddresses', ('editDate',)), ('subnets', ('editDate',))]),
+)
+
+# LIKE is case insensitive on SQLite: only NOCASE indexes back it
+LIKE_COLUMNS = ('description', 'mac')
+
+_SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+_TABLE_REFERENCE = re.compile(
+    r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(?!(?:WHERE|LEFT|RIGHT|INNER|'
+    r'JOIN|ON|ORDER|GROUP|LIMIT|FOR)\b)(\w+))?', re.IGNORECASE)
+
+
+class _RecordingCursor(object):
+    """
+    Cursor running and recording the SELECT queries of PHPIPAM methods.
+    Other statements and named locks are skipped.
+    """
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+        self.skipped = False
+
+    def execute(self, query):
+        query = ' '.join(query.split())
+        self.skipped = (not query.upper().startswith('SELECT') or
+                        ' FROM ' not in query.upper())
+        if not self.skipped:
+            self.queries.append(query)
+            self.cursor.execute(query)
+
+    def fetchone(self):
+        if self.skipped:
+            # Named locks are always obtained
+            return (1,)
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return [] if self.skipped else self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return [] if self.skipped else self.cursor.fetchmany(size)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def flush(self):
+        # Called by instrumented methods: recorded queries aren't measured
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class _RecordingConnection(object):
+    """
+    Connection of _RecordingCursors, ignoring transactions
+    """
+    def __init__(self, db):
+        self.db = db
+        self.queries = []
+
+    def cursor(self, **kwargs):
+        return _RecordingCursor(self.db.cursor(**kwargs), self.queries)
+
+    def start_transaction(self, **kwargs):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+@contextmanager
+def _recording(ipam):
+    """
+    Bind a _RecordingConnection to the calling thread, and yield the list
+    of the queries it records
+    """
+    with ipam.connection():
+        (db, cur) = (ipam._local.db, ipam._local.cur)
+        last_write = ipam.last_write
+        recorder = _RecordingConnection(db)
+        ipam._local.db = recorder
+        if ipam.dbtype == 'mysql':
+            ipam._local.cur = recorder.cursor(buffered=True)
+        else:
+            ipam._local.cur = recorder.cursor()
+        try:
+            yield recorder.queries
+        finally:
+            (ipam._local.db, ipam._local.cur) = (db, cur)
+            ipam.last_write = last_write
+
+
+def _get_sample(ipam):
+    """
+    Return an allocated address of the section, its subnet and its subnet
+    id, for the methods to find rows as they usually do
+    """
+    ipam.cur.execute('SELECT ip.ip_addr, s.subnet, s.mask, s.id '
+                     'FROM ipaddresses ip JOIN subnets s '
+                     'ON ip.subnetId = s.id '
+                     'WHERE s.sectionId = %d AND ip.state = %d LIMIT 1'
+                     % (ipam.section_id, ipam.used_ip_state))
+    row = ipam.cur.fetchone()
+    if row is None:
+        return {'ip': SAMPLE_IP, 'subnet': SAMPLE_IP.network, 'subnet_id': 0}
+    subnet = ip_network('%s/%s' % (ip_address(int(row[1])), row[2]))
+    ip = ip_interface('%s/%d' % (
+        subnet.network_address + (int(row[0]) - int(subnet.network_address)),
+        subnet.prefixlen))
+    return {'ip': ip, 'subnet': subnet, 'subnet_id': int(row[3])}
+
+
+def _index_name(table, columns):
+    return 'ipam_client_{}_{}'.format(table, '_'.join(columns)).lower()
+
+
+def _index_columns(ipam, columns):
+    if ipam.dbtype == 'sqlite':
+        return tuple('{} COLLATE NOCASE'.format(column)
+                     if column in LIKE_COLUMNS else column
+                     for column in columns)
+    return tuple(columns)
+
+
+def _create_index(ipam, table, columns):
+    name = _index_name(table, columns)
+    columns = ', '.join(_index_columns(ipam, columns))
+    if ipam.dbtype == 'sqlite':
+        return 'CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            name, table, columns)
+    return 'CREATE INDEX {} ON {} ({})'.format(name, table, columns)
+
+
+def _tables(query):
+    """
+    Return the tables of query by name and alias
+    """
+    tables = {}
+    for match in _TABLE_REFERENCE.finditer(query):
+        tables[match.group(1)] = match.group(1)
+        if match.group(2):
+            tables[match.group(2)] = match.group(1)
+    return tables
+
+
+def _explain(ipam, query):
+    """
+    Return the plan lines of query and the tables it scans entirely
+    """
+    tables = _tables(query)
+    if ipam.dbtype == 'sqlite':
+        ipam.cur.execute('EXPLAIN QUERY PLAN ' + query)
+        plan = [row[-1] for row in ipam.cur.fetchall()]
+        scanned = [match.group(1) for match in map(_SQLITE_SCAN.match, plan)
+                   if match is not None]
+    else:
+        ipam.cur.execute('EXPLAIN ' + query)
+        columns = [column[0] for column in ipam.cur.description]
+        plan = []
+        scanned = []
+        for row in ipam.cur.fetchall():
+            row = dict(zip(columns, row))
+            plan.append('{table}: type={type} key={key} rows={rows}'.format(
+                **row))
+            # ALL reads the whole table, index the whole index
+            if row['type'] in ('ALL', 'index'):
+                scanned.append(row['table'])
+    # Aliases are reported instead of tables, derived tables are skipped
+    return plan, [tables[name] for name in scanned if name in tables]
+
+
+def _get_indexes(ipam, table):
+    """
+    Return the indexed columns of each index of table, as _index_columns
+    """
+    indexes = []
+    if ipam.dbtype == 'sqlite':
+        ipam.cur.execute('PRAGMA index_list({})'.format(table))
+        for name in [row[1] for row in ipam.cur.fetchall()]:
+            ipam.cur.execute('PRAGMA index_xinfo("{}")'.format(name))
+            # (rank, column id, name, descending, collation, key column)
+            indexes.append(tuple(
+                '{} COLLATE NOCASE'.format(row[2])
+                if row[4].upper() == 'NOCASE' else row[2]
+                for row in sorted(ipam.cur.fetchall()) if row[5]))
+    else:
+        ipam.cur.execute('SHOW INDEX FROM {}'.format(table))
+        columns = [column[0] for column in ipam.cur.description]
+        by_name = OrderedDict()
+        for row in ipam.cur.fetchall():
+            row = dict(zip(columns, row))
+            by_name.setdefault(row['Key_name'], []).append(
+                (row['Seq_in_index'], row['Column_name']))
+        indexes = [tuple(name for (_, name) in sorted(index))
+                   for index in by_name.values()]
+    return [tuple(column.lower() for column in index if column is not None)
+            for index in indexes]
+
+
+def _is_indexed(indexes, columns):
+    columns = tuple(column.lower() for column in columns)
+    return any(index[:len(columns)] == columns for index in indexes)
+
+
+def explain_queries(ipam):
+    """
+    Run EXPLAIN on the queries of each query shape of ipam. Returns one
+    dict per shape with its name, queries, plan lines, the tables it
+    scans and the CREATE INDEX statements of the missing recommended
+    indexes of those tables.
+    """
+    reports = []
+    with ipam.connection():
+        sample = _get_sample(ipam)
+        indexes = {}
+        for (name, call, recommended) in QUERY_SHAPES:
+            with _recording(ipam) as queries:
+                try:
+                    call(ipam, sample)
+                except ValueError:
+                    # Not found: the queries run until then are explained
+                    pass
+            plan = []
+            scans = []
+            for query in queries:
+                (query_plan, query_scans) = _explain(ipam, query)
+                plan.extend(query_plan)
+                scans.extend(table for table in query_scans
+                             if table not in scans)
+            statements = []
+            for (table, columns) in recommended:
+                if table not in scans:
+                    continue
+                if table not in indexes:
+                    indexes[table] = _get_indexes(ipam, table)
+                if not _is_indexed(indexes[table],
+                                   _index_columns(ipam, columns)):
+                    statements.append(_create_index(ipam, table, columns))
+            reports.append({
+                'name': name,
+                'queries': queries,
+                'plan': plan,
+                'scans': scans,
+                'indexes': statements,
+            })
+    return reports
+
+
+def recommended_indexes(reports):
+    """
+    Return the CREATE INDEX statements of reports, without duplicates
+    """
+    statements = []
+    for report in reports:
+        for statement in report['indexes']:
+            if statement not in statements:
+                statements.append(statement)
+    return statements
+
+
+def apply_indexes(ipam, statements):
+    """
+    Create the recommended indexes. Only supported on SQLite: on MySQL,
+    indexes of large tables should be created by the database
+    administrators.
+    """
+    if ipam.dbtype != 'sqlite':
+        raise ValueError('Indexes can only be applied to SQLite databases')
+    with ipam.connection():
+        for statement in statements:
+            ipam.cur.execute(statement)
+        ipam.db.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--dbtype', choices=('sqlite', 'mysql'),
+                        default='mysql')
+    parser.add_argument('--database-uri', help='SQLite database file')
+    parser.add_argument('--host')
+    parser.add_argument('--username')
+    parser.add_argument('--database', help='MySQL database name')
+    parser.add_argument('--section', default='Production')
+    parser.add_argument('--print-sql', action='store_true',
+                        help='print the recommended indexes')
+    parser.add_argument('--apply', action='store_true',
+                        help='create the recommended indexes (SQLite only)')
+    args = parser.parse_args()
+
+    ipam = PHPIPAM({
+        'dbtype': args.dbtype,
+        'database_uri': args.database_uri,
+        'database_host': args.host,
+        'username': args.username,
+        'password': os.environ.get('IPAM_PASSWORD', ''),
+        'database_name': args.database,
+        'section_name': args.section,
+    })
+    reports = explain_queries(ipam)
+    for report in reports:
+        print('{:<40} {}'.format(
+            report['name'], 'FULL SCAN of ' + ', '.join(report['scans'])
+            if report['scans'] else 'ok'))
+        for line in report['plan']:
+            print('    ' + line)
+    statements = recommended_indexes(reports)
+    if args.print_sql:
+        for statement in statements:
+            print(statement + ';')
+    if args.apply:
+        apply_indexes(ipam, statements)
+        print('Created {} indexes'.format(len(statements)))
+    return 1 if statements else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,166 @@
+"""
+Client-side pools of addresses leased from a PHPIPAM subnet.
+
+A LeasePool reserves blocks of free addresses in one transaction, marking
+them with the reserved state and a description holding their expiry time,
+then hands them out locally without any query. The hostnames,
+descriptions and macs of the handed out addresses are written back in
+batches, and the addresses left unused are deleted on close. Leases of
+a client that died are deleted by release_expired_leases once expired.
+
+    with LeasePool(ipam, ip_network('10.10.0.0/24')) as pool:
+        for name in names:
+            pool.acquire(name, 'container ' + name)
+"""
+from __future__ import unicode_literals
+import threading
+import time
+from collections import deque
+
+LEASE_DESCRIPTION_PREFIX = 'ipam-client lease until '
+LEASE_POOL_SIZE = 64
+LEASE_TTL = 300
+LEASE_BATCH_SIZE = 32
+
+
+def _lease_description(expiry):
+    return '%s%d' % (LEASE_DESCRIPTION_PREFIX, expiry)
+
+
+def _lease_expiry(description):
+    if not description or not description.startswith(
+            LEASE_DESCRIPTION_PREFIX):
+        return None
+    try:
+        return int(description[len(LEASE_DESCRIPTION_PREFIX):])
+    except ValueError:
+        return None
+
+
+def release_expired_leases(ipam, subnet, now=None):
+    """
+    Delete the leases of subnet that expired before now.
+    Returns the number of deleted leases.
+    """
+    if now is None:
+        now = time.time()
+    expired = []
+    for item in ipam.get_subnet_with_ips(subnet).get('ips', []):
+        if int(item['state']) != ipam.reserved_ip_state:
+            continue
+        expiry = _lease_expiry(item['description'])
+        if expiry is not None and expiry < now:
+            expired.append(item['ip'])
+    return ipam.delete_ips(subnet, expired, state=ipam.reserved_ip_state)
+
+
+class LeasePool(object):
+    """
+    Addresses of subnet leased by blocks of size, for ttl seconds.
+    Leases are extended when half of their ttl is over, and assignments
+    written every batch_size acquisitions.
+    """
+    def __init__(self, ipam, subnet, size=LEASE_POOL_SIZE, ttl=LEASE_TTL,
+                 batch_size=LEASE_BATCH_SIZE):
+        if size < 1 or batch_size < 1:
+            raise ValueError('Lease pool and batch sizes must be positive')
+        self.ipam = ipam
+        self.subnet = subnet
+        self.size = size
+        self.ttl = ttl
+        self.batch_size = batch_size
+        self.free = deque()
+        self.pending = []
+        self.expiry = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def acquire(self, hostname, description, mac=None):
+        """
+        Hand out a leased address, reserving a new block if needed.
+        Returns the address as an ip_interface.
+        """
+        with self.lock:
+            if not self.free or time.time() >= self.expiry - self.ttl / 2.0:
+                self._renew()
+            ip = self.free.popleft()
+            self.pending.append((ip, hostname, description, mac))
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+            return ip
+
+    def flush(self):
+        """
+        Write the assignments of the handed out addresses
+        """
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        """
+        Write the pending assignments and return the unused leases
+        """
+        with self.lock:
+            self._flush()
+            if self.free and time.time() < self.expiry:
+                self.ipam.delete_ips(self.subnet, list(self.free),
+                                     state=self.ipam.reserved_ip_state)
+            self.free.clear()
+
+    def _flush(self):
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        edited = self.ipam.edit_ips(
+            self.subnet, pending, state=self.ipam.used_ip_state,
+            current_state=self.ipam.reserved_ip_state)
+        if edited != len(pending):
+            raise RuntimeError('Only %d of %d leases of %s were assigned: '
+                               'the others expired'
+                               % (edited, len(pending), self.subnet))
+
+    def _renew(self):
+        self._flush()
+        now = time.time()
+        if self.free and now < self.expiry:
+            expiry = now + self.ttl
+            updates = [(ip, '', _lease_description(expiry), None)
+                       for ip in self.free]
+            extended = self.ipam.edit_ips(
+                self.subnet, updates, state=self.ipam.reserved_ip_state,
+                current_state=self.ipam.reserved_ip_state)
+            if extended == len(updates):
+                self.expiry = expiry
+                return
+        # Expired leases may have been taken: forget them
+        self.free.clear()
+        self._reserve()
+
+    def _reserve(self):
+        count = self.size
+        released = False
+        while True:
+            expiry = time.time() + self.ttl
+            try:
+                ips = self.ipam.add_next_ips(
+                    self.subnet, count, [''] * count,
+                    [_lease_description(expiry)] * count,
+                    state=self.ipam.reserved_ip_state)
+            except ValueError:
+                if not released:
+                    released = True
+                    if release_expired_leases(self.ipam, self.subnet):
+                        continue
+                if count == 1:
+                    raise
+                count = max(1, count // 2)
+                continue
+            self.free.extend(ips)
+            self.expiry = expiry
+            return
@@ -0,0 +1,196 @@
+"""
+Lookup results, either as plain dicts or as compact records.
+
+Records hold the raw database values in slots and only build their
+ip_address, ip_interface or ip_network objects on first access. They
+support the dict-style access of plain results (record['ip'], keys(),
+items(), comparison with dicts) for compatibility.
+"""
+from __future__ import unicode_literals
+from ipaddress import ip_address, ip_interface, ip_network
+
+
+def _make_ip_interface(ip_addr, mask):
+    return ip_interface(str(ip_address(int(ip_addr))) + "/" + str(mask))
+
+
+def _make_subnet(subnet_addr, mask):
+    if mask == '':
+        mask = 0
+    return ip_network("%s/%s" % (ip_address(int(subnet_addr)), mask))
+
+
+class Record(object):
+    __slots__ = ()
+    # Keys of the equivalent plain dict, in order
+    fields = ()
+
+    def __getitem__(self, key):
+        if key not in self.fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def get(self, key, default=None):
+        if key not in self.fields:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(self.fields)
+
+    def values(self):
+        return [getattr(self, key) for key in self.fields]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.fields]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, Record)):
+            return self.to_dict() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.to_dict())
+
+
+class IPInterfaceRecord(Record):
+    """
+    Allocated address with its subnet mask, subnet name and VLAN
+    """
+    __slots__ = ('_ip_addr', '_mask', '_ip', 'description', 'dnsname',
+                 'subnet_name', 'vlan_id', 'mac')
+    fields = ('ip', 'description', 'dnsname', 'subnet_name', 'vlan_id', 'mac')
+
+    def __init__(self, ip_addr, mask, description, dnsname, subnet_name,
+                 vlan_id, mac):
+        self._ip_addr = ip_addr
+        self._mask = mask
+        self._ip = None
+        self.description = description
+        self.dnsname = dnsname
+        self.subnet_name = subnet_name
+        self.vlan_id = vlan_id
+        self.mac = mac
+
+    @property
+    def ip(self):
+        if self._ip is None:
+            self._ip = _make_ip_interface(self._ip_addr, self._mask)
+        return self._ip
+
+
+class SubnetIPInterfaceRecord(IPInterfaceRecord):
+    """
+    Allocated address with its subnet mask and subnet name
+    """
+    __slots__ = ()
+    fields = ('ip', 'description', 'dnsname', 'subnet_name', 'mac')
+
+    def __init__(self, ip_addr, mask, description, dnsname, subnet_name, mac):
+        super(SubnetIPInterfaceRecord, self).__init__(
+            ip_addr, mask, description, dnsname, subnet_name, None, mac)
+
+
+class IPAddressRecord(Record):
+    """
+    Allocated address with its state
+    """
+    __slots__ = ('_ip_addr', '_ip', 'description', 'dnsname', 'state', 'mac')
+    fields = ('ip', 'description', 'dnsname', 'state', 'mac')
+
+    def __init__(self, ip_addr, description, dnsname, state, mac):
+        self._ip_addr = ip_addr
+        self._ip = None
+        self.description = description
+        self.dnsname = dnsname
+        self.state = state
+        self.mac = mac
+
+    @property
+    def ip(self):
+        if self._ip is None:
+            self._ip = ip_address(int(self._ip_addr))
+        return self._ip
+
+
+class SubnetRecord(Record):
+    """
+    Subnet with its description and VLAN
+    """
+    __slots__ = ('_subnet_addr', '_mask', '_subnet', 'description',
+                 'vlan_id')
+    fields = ('subnet', 'description', 'vlan_id')
+
+    def __init__(self, subnet_addr, mask, description, vlan_id):
+        self._subnet_addr = subnet_addr
+        self._mask = mask
+        self._subnet = None
+        self.description = description
+        self.vlan_id = vlan_id
+
+    @property
+    def subnet(self):
+        if self._subnet is None:
+            self._subnet = _make_subnet(self._subnet_addr, self._mask)
+        return self._subnet
+
+
+def ip_interface_dict(ip_addr, mask, description, dnsname, subnet_name,
+                      vlan_id, mac):
+    return {
+        'ip': _make_ip_interface(ip_addr, mask),
+        'description': description,
+        'dnsname': dnsname,
+        'subnet_name': subnet_name,
+        'vlan_id': vlan_id,
+        'mac': mac,
+    }
+
+
+def subnet_ip_interface_dict(ip_addr, mask, description, dnsname,
+                             subnet_name, mac):
+    return {
+        'ip': _make_ip_interface(ip_addr, mask),
+        'description': description,
+        'dnsname': dnsname,
+        'subnet_name': subnet_name,
+        'mac': mac,
+    }
+
+
+def ip_address_dict(ip_addr, description, dnsname, state, mac):
+    return {
+        'ip': ip_address(int(ip_addr)),
+        'description': description,
+        'dnsname': dnsname,
+        'state': state,
+        'mac': mac,
+    }
+
+
+def subnet_dict(subnet_addr, mask, description, vlan_id):
+    return {
+        'subnet': _make_subnet(subnet_addr, mask),
+        'description': description,
+        'vlan_id': vlan_id,
+    }
@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+import os
+import pytest
+import tempfile
+import sqlite3
+import sys
+from ipam.client.backends.phpipam import PHPIPAM
+
+# The asyncio client requires Python 3.7
+collect_ignore = []
+if sys.version_info < (3, 7):
+    collect_ignore.append('test_asyncphpipam.py')
+
+
+def create_db(db_file_name):
+    _dbfile = tempfile.NamedTemporaryFile(
+        prefix='test-phpipam-{}'.format(db_file_name),
+        suffix='.db', delete=False
+    )
+    _dbfilename = _dbfile.name
+    _dbfile.close()
+
+    conn = sqlite3.connect(_dbfilename)
+    cur = conn.cursor()
+
+    f = open(os.path.dirname(os.path.realpath(__file__)) +
+             '/data/db-{}.sql'.format(db_file_name))
+    sql = f.read()
+    cur.executescript(sql)
+
+    conn.commit()
+    conn.close()
+
+    return _dbfilename
+
+
+@pytest.fixture(params=('recent-version', 'old-version'))
+def testdb(request):
+    """Test SQLite instance."""
+    db_file = create_db(request.param)
+
+    def testdbteardown():
+        os.unlink(db_file)
+
+    request.addfinalizer(testdbteardown)
+    return db_file
+
+
+@pytest.fixture
+def testdb_no_settings(request):
+    """Test SQLite instance."""
+    db_file = create_db('no-settings')
+
+    def testdbteardown():
+        os.unlink(db_file)
+
+    request.addfinalizer(testdbteardown)
+    return db_file
+
+
+@pytest.fixture
+def testphpipam(testdb):
+    """Test PHPIPAM instance."""
+    params = {'section_name': 'Production', 'dbtype': 'sqlite',
+              'database_uri': testdb}
+
+    return PHPIPAM(params)
@@ -0,0 +1,81 @@
+from __future__ import unicode_literals
+import asyncio
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from ipam.client.backends.asyncphpipam import AsyncPHPIPAM
+from ipaddress import ip_address, ip_interface, ip_network
+
+
+@pytest.fixture
+def testasyncphpipam(request, testdb):
+    """Test AsyncPHPIPAM instance."""
+    params = {'section_name': 'Production', 'dbtype': 'sqlite',
+              'database_uri': testdb, 'pool_size': 4}
+    ipam = AsyncPHPIPAM(params)
+    request.addfinalizer(ipam.close)
+    return ipam
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+async def gather(coroutines):
+    return await asyncio.gather(*coroutines)
+
+
+def test_async_methods(testasyncphpipam):
+    for name in ('add_next_ip', 'get_ip', 'get_subnet_with_ips',
+                 'add_next_subnet', 'delete_ip', 'get_subnet_by_id'):
+        assert callable(getattr(testasyncphpipam, name))
+
+
+def test_async_lookups(testasyncphpipam):
+    ips = [ip_address('10.1.0.{}'.format(i)) for i in (1, 2, 3, 7)]
+    results = run(gather(testasyncphpipam.get_ip(ip) for ip in ips))
+    assert [result['ip'].ip for result in results] == ips
+
+    subnet = run(testasyncphpipam.get_subnet_with_ips(
+        ip_network('10.3.0.0/30')))
+    assert subnet['description'] == 'TST /30 SUBNET'
+    assert testasyncphpipam.ipam.pool.opened <= 4
+
+
+def test_async_add_next_ip(testasyncphpipam):
+    subnet = ip_network('10.1.0.0/28')
+    ips = run(gather(testasyncphpipam.add_next_ip(subnet,
+                                                  'async-{}'.format(i),
+                                                  'async')
+                     for i in range(5)))
+    assert sorted(ips) == [ip_interface('10.1.0.{}/28'.format(i))
+                           for i in (4, 5, 6, 11, 12)]
+    assert len(run(testasyncphpipam.get_ip_list_by_desc('async'))) == 5
+
+    with pytest.raises(ValueError, match='is full'):
+        run(testasyncphpipam.add_next_ip(ip_network('10.2.0.0/29'),
+                                         'err', 'err'))
+
+
+def test_async_close(testasyncphpipam):
+    run(gather(testasyncphpipam.get_ip(ip_address('10.1.0.1'))
+               for _ in range(4)))
+    pool = testasyncphpipam.ipam.pool
+    assert pool.opened > 0
+    testasyncphpipam.close()
+    assert pool._idle.empty()
+
+
+def test_async_close_without_pool(testdb):
+    executor = ThreadPoolExecutor(max_workers=1)
+    # Lazy, for the SQLite connection to be opened in the executor thread
+    ipam = AsyncPHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                         'database_uri': testdb, 'pool_size': 0,
+                         'lazy': True}, executor=executor)
+    assert ipam.ipam.pool is None
+    assert run(ipam.get_ip(ip_address('10.1.0.1')))
+    ipam.close()
+    executor.shutdown(wait=True)
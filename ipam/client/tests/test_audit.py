@@ -0,0 +1,82 @@
+from __future__ import unicode_literals
+import pytest
+from ipam.client import audit
+from ipam.client.audit import _address_tasks, audit_section
+from ipaddress import ip_address, ip_network
+
+
+def _add_subnet(ipam, subnet_id, subnet):
+    ipam.cur.execute("INSERT INTO subnets (id, subnet, mask, sectionId, "
+                     "description, masterSubnetId, isFolder) VALUES (%d, "
+                     "'%s', '%s', %d, 'audit', 0, %d)"
+                     % (subnet_id, int(subnet.network_address) if subnet
+                        else '', subnet.prefixlen if subnet else '',
+                        ipam.section_id, subnet is None))
+
+
+def _add_ip(ipam, ip_id, subnet_id, ip, mac=''):
+    ipam.cur.execute("INSERT INTO ipaddresses (id, subnetId, ip_addr, "
+                     "description, %s, mac, state) VALUES (%d, %d, '%d', "
+                     "'audit', 'audit', '%s', '%d')"
+                     % (ipam.hostname_db_field, ip_id, subnet_id, ip, mac,
+                        ipam.used_ip_state))
+
+
+def _ids(groups):
+    return sorted(sorted(item['id'] for item in group) for group in groups)
+
+
+@pytest.mark.parametrize('processes, task_size, chunk_size', [
+    (1, 1000, 1000), (2, 1, 1000), (1, 1000, 2)])
+def test_audit_section(testphpipam, monkeypatch, processes, task_size,
+                       chunk_size):
+    monkeypatch.setattr(audit, 'IN_QUERY_CHUNK_SIZE', chunk_size)
+    report = audit_section(testphpipam, processes, task_size)
+    assert report == {'duplicate_ips': [], 'duplicate_macs': [],
+                      'outside': [], 'orphans': [], 'overlaps': []}
+
+    # Overlapping top-level subnets, sharing an address
+    _add_subnet(testphpipam, 20, ip_network('10.1.0.8/29'))
+    _add_ip(testphpipam, 100, 20, ip_address('10.1.0.9'))
+    _add_ip(testphpipam, 101, 1, ip_address('10.1.0.1'))
+    _add_ip(testphpipam, 102, 3, ip_address('10.1.0.1'))
+    _add_ip(testphpipam, 103, 8, ip_address('10.10.0.1'),
+            '52-24-10-00-00-02')
+    _add_ip(testphpipam, 104, 11, ip_address('2001:db8:abcd::1'),
+            '52:24:10:00:00:03')
+    _add_ip(testphpipam, 105, 8, ip_address('10.10.0.2'), '52:24:10:00:00:03')
+    _add_subnet(testphpipam, 21, None)
+    _add_ip(testphpipam, 106, 21, ip_address('10.20.0.1'))
+    # Subnet deleted
+    _add_ip(testphpipam, 108, 99, ip_address('10.30.0.1'))
+    testphpipam.db.commit()
+
+    report = audit_section(testphpipam, processes, task_size)
+    assert _ids(report['duplicate_ips']) == [[1, 101], [6, 100]]
+    [duplicate] = [group for group in report['duplicate_ips']
+                   if group[0]['id'] in (6, 100)]
+    assert set(item['subnet'] for item in duplicate) == set([
+        ip_network('10.1.0.0/28'), ip_network('10.1.0.8/29')])
+    assert _ids(report['duplicate_macs']) == [[15, 103], [104, 105]]
+    assert sorted((item['id'], item['subnet'])
+                  for item in report['outside']) == [
+        (102, ip_network('10.3.0.0/30')), (106, None)]
+    assert report['overlaps'] == [(ip_network('10.1.0.0/28'),
+                                   ip_network('10.1.0.8/29'))]
+    assert [(item['id'], item['ip'], item['subnet_id'])
+            for item in report['orphans']] == [
+        (108, ip_address('10.30.0.1'), 99)]
+
+
+def test_address_tasks(testphpipam, monkeypatch):
+    tree = testphpipam.get_subnet_tree()
+    # IPv4 and IPv6 addresses can have the same integer values
+    [ipv4, ipv6] = _address_tasks(tree, 1000)
+    assert set(bounds[0] for bounds in ipv4.values()) == set([4])
+    assert set(bounds[0] for bounds in ipv6.values()) == set([6])
+
+    monkeypatch.setattr(audit, 'IN_QUERY_CHUNK_SIZE', 2)
+    tasks = _address_tasks(tree, 1000)
+    assert sorted(sum((list(ranges) for ranges in tasks), [])) == sorted(
+        list(ipv4) + list(ipv6))
+    assert len(tasks) > 2
@@ -0,0 +1,32 @@
+from __future__ import unicode_literals
+import io
+import pytest
+from ipam.client.bulkimport import read_rows
+
+
+def test_read_rows(tmp_path):
+    expected = [
+        {'ip': '10.1.0.8/28', 'hostname': 'host-1', 'description': 'first'},
+        {'ip': '10.1.0.9/28', 'hostname': 'host-2', 'description': 'second'},
+    ]
+    contents = {
+        'ips.csv': 'ip,hostname,description\n'
+                   '10.1.0.8/28,host-1,first\n'
+                   '10.1.0.9/28,host-2,second\n',
+        'ips.json': '[{"ip": "10.1.0.8/28", "hostname": "host-1", '
+                    '"description": "first"}, '
+                    '{"ip": "10.1.0.9/28", "hostname": "host-2", '
+                    '"description": "second"}]',
+        'ips.jsonl': '{"ip": "10.1.0.8/28", "hostname": "host-1", '
+                     '"description": "first"}\n\n'
+                     '{"ip": "10.1.0.9/28", "hostname": "host-2", '
+                     '"description": "second"}\n',
+    }
+    for (name, content) in contents.items():
+        path = str(tmp_path / name)
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        assert [dict(row) for row in read_rows(path)] == expected
+
+    with pytest.raises(ValueError, match='Unsupported import file'):
+        list(read_rows(str(tmp_path / 'ips.xml')))
@@ -0,0 +1,86 @@
+from __future__ import unicode_literals
+import pytest
+from ipam.client.backends.changesync import ChangeSync, SyncStore
+from ipam.client.backends.phpipam import PHPIPAM
+from ipam.client.backends.sqlitemirror import (MIRROR_TABLES, MirrorStore,
+                                               mirror_params, refresh_mirror,
+                                               sync_mirror)
+from ipaddress import ip_address, ip_interface, ip_network
+
+
+@pytest.fixture
+def testphpipam(testphpipam):
+    # The fixtures hold 'NULL' strings instead of NULL edit dates
+    testphpipam.cur.execute('UPDATE ipaddresses SET editDate = NULL')
+    testphpipam.cur.execute('UPDATE subnets SET editDate = NULL')
+    return testphpipam
+
+
+def _edit(ipam, ip, description, edit_date):
+    ipam.cur.execute("UPDATE ipaddresses SET description = '%s', "
+                     "editDate = '%s' WHERE ip_addr = '%d'"
+                     % (description, edit_date, ip))
+
+
+def test_sync_mirror(testphpipam, tmp_path):
+    path = str(tmp_path / 'mirror.db')
+    refresh_mirror(testphpipam, path)
+    mirror = PHPIPAM(mirror_params(path))
+    assert sync_mirror(testphpipam, path)['ipaddresses'] == {
+        'upserted': 0, 'deleted': 0}
+
+    _edit(testphpipam, ip_address('10.1.0.2'), 'edited',
+          '2026-10-18 12:00:00')
+    ip = testphpipam.add_next_ip(ip_network('10.1.0.0/28'), 'new', 'new')
+    testphpipam.delete_ip(ip_interface('10.1.0.3/28'))
+    counts = sync_mirror(testphpipam, path)
+    assert counts['ipaddresses'] == {'upserted': 2, 'deleted': 0}
+    assert counts['sections'] == {'upserted': 1, 'deleted': 0}
+    assert mirror.get_description_by_ip(ip_address('10.1.0.2')) == 'edited'
+    assert mirror.get_hostname_by_ip(ip.ip) == 'new'
+    # Deletes are only found by checksums
+    assert mirror.get_hostname_by_ip(ip_address('10.1.0.3')) == 'test-ip-3'
+
+    # Edits committed late, with an earlier edit date
+    _edit(testphpipam, ip_address('10.1.0.1'), 'late', '2026-10-18 11:59:30')
+    _edit(testphpipam, ip_address('10.1.0.7'), 'too late',
+          '2026-10-18 11:00:00')
+    counts = sync_mirror(testphpipam, path, checksum=True)
+    assert counts['ipaddresses'] == {'upserted': 2, 'deleted': 1}
+    assert mirror.get_description_by_ip(ip_address('10.1.0.1')) == 'late'
+    assert mirror.get_description_by_ip(
+        ip_address('10.1.0.7')) == 'test ip #4'
+    assert mirror.get_hostname_by_ip(ip_address('10.1.0.3')) is None
+
+
+def test_sync_checksum_ranges(testphpipam, tmp_path):
+    path = str(tmp_path / 'mirror.db')
+    refresh_mirror(testphpipam, path)
+    # Inserted with an id below the high-water mark
+    testphpipam.cur.execute('DELETE FROM ipaddresses WHERE id = 2')
+    testphpipam.cur.execute("INSERT INTO ipaddresses "
+                            "(id, subnetId, ip_addr, description, %s, mac, "
+                            "state) VALUES (100, 1, '%d', 'late', 'late', "
+                            "'', '%d')"
+                            % (testphpipam.hostname_db_field,
+                               ip_address('10.1.0.5'),
+                               testphpipam.used_ip_state))
+    store = MirrorStore(path, testphpipam.hostname_db_field)
+    store.db.execute('DELETE FROM ipaddresses WHERE id = 100')
+    sync = ChangeSync(testphpipam, store, MIRROR_TABLES, range_size=4)
+    assert sync.sync(checksum=True)['ipaddresses'] == {
+        'upserted': 1, 'deleted': 1}
+    assert store.ids('ipaddresses', 0, 4) == set([1, 3])
+    assert store.ids('ipaddresses', 100, 104) == set([100])
+    assert sync.sync(checksum=True)['ipaddresses'] == {
+        'upserted': 0, 'deleted': 0}
+    store.close()
+
+
+def test_incomplete_store():
+    class IncompleteStore(SyncStore):
+        def high_water_marks(self, table):
+            return (0, None)
+
+    with pytest.raises(TypeError):
+        IncompleteStore()
@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+import pytest
+from ipam.client.backends.phpipam import PHPIPAM
+from ipam.client.indexadvisor import (QUERY_SHAPES, apply_indexes,
+                                      explain_queries, recommended_indexes)
+
+
+def test_explain_queries(testphpipam):
+    reports = dict((report['name'], report)
+                   for report in explain_queries(testphpipam))
+    assert sorted(reports) == sorted(shape[0] for shape in QUERY_SHAPES)
+    # The queries the backend runs are explained
+    assert reports['edit_ip_description']['queries'][-1].startswith(
+        'SELECT ip_addr FROM ipaddresses WHERE ')
+    # Indexed by the fixture schema
+    assert reports['get_allocated_ips_by_subnet_id']['scans'] == []
+    assert reports['get_allocated_ips_by_subnet_id']['indexes'] == []
+    # vlanId isn't a primary key in the fixture schema
+    assert reports['get_ips']['scans'] == ['vlans']
+    assert reports['get_ips']['indexes'] == [
+        'CREATE INDEX IF NOT EXISTS ipam_client_vlans_vlanid '
+        'ON vlans (vlanId)']
+    # LIKE can't use the BINARY description index of the fixture schema
+    assert reports['get_ip_list_by_desc']['scans'] == ['ipaddresses']
+    assert reports['get_ip_list_by_desc']['indexes'] == [
+        'CREATE INDEX IF NOT EXISTS ipam_client_ipaddresses_description '
+        'ON ipaddresses (description COLLATE NOCASE)']
+    assert reports['get_children_subnet_list']['scans'] == ['subnets']
+    assert 'SCAN subnets' in reports['get_children_subnet_list']['plan']
+
+    statements = recommended_indexes(reports.values())
+    assert len(statements) == len(set(statements))
+    apply_indexes(testphpipam, statements)
+    reports = explain_queries(testphpipam)
+    assert [report['name'] for report in reports if report['scans']] == [
+        'sync_mirror']
+    assert recommended_indexes(reports) == []
+
+    # Lookups are unchanged by the new indexes
+    assert [ip['dnsname'] for ip in testphpipam.get_ip_list_by_desc(
+        'TEST IP #2')] == ['test-ip-2']
+
+
+def test_explain_queries_instrumented(testdb, testphpipam):
+    ipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                    'database_uri': testdb, 'slow_query_threshold': 60})
+    assert [report['queries'] for report in explain_queries(ipam)] == [
+        report['queries'] for report in explain_queries(testphpipam)]
+
+
+def test_existing_indexes_by_columns(testphpipam):
+    testphpipam.cur.execute('CREATE INDEX vlans_number_id '
+                            'ON vlans (vlanId, number)')
+    testphpipam.cur.execute('CREATE INDEX desc_nocase ON ipaddresses '
+                            '(description COLLATE NOCASE)')
+    testphpipam.db.commit()
+    reports = dict((report['name'], report)
+                   for report in explain_queries(testphpipam))
+    assert reports['get_ips']['scans'] == []
+    assert reports['get_ip_list_by_desc']['scans'] == []
+    assert reports['get_ip_list_by_desc']['indexes'] == []
+
+
+def test_apply_indexes_sqlite_only(testphpipam):
+    testphpipam.dbtype = 'mysql'
+    with pytest.raises(ValueError, match='SQLite'):
+        apply_indexes(testphpipam, [])
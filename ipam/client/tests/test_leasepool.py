@@ -0,0 +1,85 @@
+from __future__ import unicode_literals
+import pytest
+import time
+from ipam.client.leasepool import (LEASE_DESCRIPTION_PREFIX, LeasePool,
+                                   release_expired_leases)
+from ipaddress import ip_interface, ip_network
+
+
+def _states(ipam, subnet):
+    return dict((item['ip'], int(item['state']))
+                for item in ipam.get_subnet_with_ips(subnet).get('ips', []))
+
+
+def test_lease_pool(testphpipam):
+    subnet = ip_network('10.10.0.0/24')
+    with LeasePool(testphpipam, subnet, size=8, batch_size=3) as pool:
+        ips = [pool.acquire('host-%d' % i, 'lease %d' % i)
+               for i in range(10)]
+        assert ips == [ip_interface('10.10.0.%d/24' % i)
+                       for i in range(1, 11)]
+        states = _states(testphpipam, subnet)
+        assert len(states) == 16
+        # Assignments are written every 3 acquisitions, and before
+        # reserving the second block
+        assert [states[ip.ip] for ip in ips] == (
+            [testphpipam.used_ip_state] * 8 +
+            [testphpipam.reserved_ip_state] * 2)
+        assert testphpipam.get_hostname_by_ip(ips[7].ip) == 'host-7'
+        assert testphpipam.get_description_by_ip(ips[7].ip) == 'lease 7'
+        assert testphpipam.get_description_by_ip(
+            ips[9].ip).startswith(LEASE_DESCRIPTION_PREFIX)
+
+    # Closing writes the last assignment and returns unused leases
+    states = _states(testphpipam, subnet)
+    assert sorted(states) == [ip.ip for ip in ips]
+    assert set(states.values()) == set([testphpipam.used_ip_state])
+    assert testphpipam.get_hostname_by_ip(ips[9].ip) == 'host-9'
+
+
+def test_lease_pool_renew(testphpipam):
+    subnet = ip_network('10.10.0.0/24')
+    pool = LeasePool(testphpipam, subnet, size=4, ttl=60)
+    first = pool.acquire('host-1', 'lease 1')
+    # Past half of the ttl, leases are extended
+    pool.expiry = time.time() + 10
+    second = pool.acquire('host-2', 'lease 2')
+    assert pool.expiry > time.time() + 50
+    assert second.ip == first.ip + 1
+    # Expired leases are forgotten, a new block is reserved
+    pool.expiry = time.time() - 1
+    third = pool.acquire('host-3', 'lease 3')
+    assert third.ip == first.ip + 4
+    pool.close()
+    assert sorted(_states(testphpipam, subnet)) == [
+        first.ip, second.ip, first.ip + 2, first.ip + 3, third.ip]
+    assert release_expired_leases(testphpipam, subnet,
+                                  now=time.time() + 61) == 2
+    assert sorted(_states(testphpipam, subnet)) == [
+        first.ip, second.ip, third.ip]
+
+
+def test_lease_pool_full_subnet(testphpipam):
+    # 7 free addresses: the block is halved until it fits
+    subnet = ip_network('10.1.0.0/28')
+    pool = LeasePool(testphpipam, subnet, size=16)
+    pool.acquire('host-1', 'lease 1')
+    assert len(pool.free) == 3
+    pool.close()
+
+    with pytest.raises(ValueError):
+        LeasePool(testphpipam, ip_network('10.2.0.0/29')).acquire(
+            'host', 'lease')
+    with pytest.raises(ValueError):
+        LeasePool(testphpipam, subnet, size=0)
+
+
+def test_lease_pool_expired_assignment(testphpipam):
+    subnet = ip_network('10.10.0.0/24')
+    pool = LeasePool(testphpipam, subnet, size=2)
+    ip = pool.acquire('host-1', 'lease 1')
+    assert release_expired_leases(testphpipam, subnet,
+                                  now=time.time() + 3600) == 2
+    with pytest.raises(RuntimeError, match='expired'):
+        pool.flush()
+    assert testphpipam.get_ip(ip.ip) is None
@@ -1,64 +1,22 @@
 from __future__ import unicode_literals
 import mysql.connector
-import os
 import pytest
-import tempfile
+import shutil
 import sqlite3
-from ipam.client.backends.phpipam import PHPIPAM
+import subprocess
+import sys
+import threading
+from ipam.client.backends.phpipam import (LOCK_NAME, MetricsSink, MySQLLock,
+                                          PHPIPAM, SubnetIdCache, SubnetTrie,
+                                          _holds_multiple_named_locks)
 from ipaddress import ip_address, ip_interface, ip_network
 
 
-def create_db(db_file_name):
-    _dbfile = tempfile.NamedTemporaryFile(
-        prefix='test-phpipam-{}'.format(db_file_name),
-        suffix='.db', delete=False
-    )
-    _dbfilename = _dbfile.name
-    _dbfile.close()
-
-    conn = sqlite3.connect(_dbfilename)
-    cur = conn.cursor()
-
-    f = open(os.path.dirname(os.path.realpath(__file__)) +
-             '/data/db-{}.sql'.format(db_file_name))
-    sql = f.read()
-    cur.executescript(sql)
-
-    conn.commit()
-    conn.close()
-
-    return _dbfilename
-
-
-@pytest.fixture(params=('recent-version', 'old-version'))
-def testdb(request):
-    """Test SQLite instance."""
-    db_file = create_db(request.param)
-
-    def testdbteardown():
-        os.unlink(db_file)
-
-    request.addfinalizer(testdbteardown)
-    return db_file
-
-
 @pytest.fixture
-def testdb_no_settings(request):
-    """Test SQLite instance."""
-    db_file = create_db('no-settings')
-
-    def testdbteardown():
-        os.unlink(db_file)
-
-    request.addfinalizer(testdbteardown)
-    return db_file
-
-
-@pytest.fixture
-def testphpipam(testdb):
-    """Test PHPIPAM instance."""
+def testphpipam_pooled(testdb):
+    """Test PHPIPAM instance with a connection pool."""
     params = {'section_name': 'Production', 'dbtype': 'sqlite',
-              'database_uri': testdb}
+              'database_uri': testdb, 'pool_size': 2, 'pool_timeout': 0.1}
 
     return PHPIPAM(params)
 
@@ -326,6 +284,43 @@ def test_add_next_ip(testphpipam):
     assert "is full" in str(excinfo.value)
 
 
+def test_add_next_ips(testphpipam):
+    subnet = ip_network('10.1.0.0/28')
+    hostnames = ['add_next_ips-{}'.format(i) for i in range(4)]
+    descriptions = ['add_next_ips generated ip {}'.format(i)
+                    for i in range(4)]
+    macs = [None, '52:24:10:00:00:03', None, None]
+    ips = testphpipam.add_next_ips(subnet, 4, hostnames, descriptions, macs)
+    assert ips == [ip_interface('10.1.0.{}/28'.format(i))
+                   for i in (4, 5, 6, 11)]
+    for ip, hostname, description in zip(ips, hostnames, descriptions):
+        testip = testphpipam.get_ip_by_desc(description)
+        assert testip['ip'] == ip.ip
+        assert testip['dnsname'] == hostname
+    assert testphpipam.get_mac_by_ip(ips[1].ip) == '52:24:10:00:00:03'
+    assert testphpipam.add_next_ips(subnet, 0, [], []) == []
+
+    with pytest.raises(ValueError) as excinfo:
+        testphpipam.add_next_ips(subnet, 2, ['err'], ['err'])
+    assert "Expected 2 hostnames" in str(excinfo.value)
+
+    # Only 3 addresses are left: nothing must be allocated
+    with pytest.raises(ValueError) as excinfo:
+        testphpipam.add_next_ips(subnet, 4, ['err'] * 4, ['err'] * 4)
+    assert "is full" in str(excinfo.value)
+    assert testphpipam.get_ip_list_by_desc('err') == []
+
+    ips = testphpipam.add_next_ips(ip_network('2001::40/125'), 2,
+                                   ['v6-1', 'v6-2'], ['v6', 'v6'])
+    assert ips == [ip_interface('2001::41/125'), ip_interface('2001::42/125')]
+
+    # Quotes are escaped, as in edit_ips
+    [ip] = testphpipam.add_next_ips(ip_network('2001::40/125'), 1,
+                                    ["o'brien"], ["O'Brien"])
+    assert testphpipam.get_description_by_ip(ip.ip) == "O'Brien"
+    assert testphpipam.get_hostname_by_ip(ip.ip) == "o'brien"
+
+
 def test_add_top_level_subnet(testphpipam):
     subnet4 = ip_network('99.99.99.0/30')
     subnet6 = ip_network('2001:db9:42::/48')
@@ -492,6 +487,24 @@ def test_add_next_subnet(testphpipam):
     assert 'must not contain any allocated IP address' in str(excinfo.value)
 
 
+def test_add_next_subnet_mixed_sizes(testphpipam):
+    parent_subnet = ip_network('10.10.0.0/24')
+    testphpipam.add_subnet(ip_network('10.10.0.0/28'), parent_subnet, 'a')
+    testphpipam.add_subnet(ip_network('10.10.0.32/27'), parent_subnet, 'b')
+    testphpipam.add_subnet(ip_network('10.10.0.128/26'), parent_subnet, 'c')
+
+    expected = ('10.10.0.64/27', '10.10.0.16/28', '10.10.0.96/27',
+                '10.10.0.192/26')
+    for prefixlen, subnet in zip((27, 28, 27, 26), expected):
+        test_subnet = testphpipam.add_next_subnet(parent_subnet, prefixlen,
+                                                  'mixed')
+        assert test_subnet == ip_network(subnet)
+
+    with pytest.raises(ValueError) as excinfo:
+        testphpipam.add_next_subnet(parent_subnet, 30, 'err')
+    assert 'No more space to add a new subnet' in str(excinfo.value)
+
+
 def test_delete_ip(testphpipam):
     iplist = testphpipam.get_ip_list_by_desc('test ip #2')
     assert iplist == [{'ip': ip_address('10.1.0.2'),
@@ -510,6 +523,36 @@ def test_delete_ip(testphpipam):
         testphpipam.delete_ip(ip_interface('10.1.0.42/28'))
 
 
+def test_edit_and_delete_ips(testphpipam):
+    subnet = ip_network('10.10.0.0/24')
+    ips = testphpipam.add_next_ips(subnet, 3, [''] * 3, ['reserved'] * 3,
+                                   state=testphpipam.reserved_ip_state)
+    # Reserved addresses are not allocated ones
+    assert testphpipam.get_ip(ips[0].ip) is None
+    assert [ip['state'] for ip in testphpipam.get_ip_list_by_desc(
+        'reserved')] == [testphpipam.reserved_ip_state] * 3
+
+    assert testphpipam.edit_ips(
+        subnet, [(ips[0], 'host-1', 'first', '52:54:00:00:00:01'),
+                 (ips[1].ip, 'host-2', "second 'quoted'", None)],
+        state=testphpipam.used_ip_state,
+        current_state=testphpipam.reserved_ip_state) == 2
+    assert testphpipam.get_ip_list_by_desc('first') == [{
+        'ip': ips[0].ip, 'description': 'first', 'dnsname': 'host-1',
+        'state': testphpipam.used_ip_state, 'mac': '52:54:00:00:00:01'}]
+    assert testphpipam.get_description_by_ip(ips[1].ip) == "second 'quoted'"
+    assert testphpipam.edit_ips(
+        subnet, [(ips[0], 'host-1', 'again', None)],
+        current_state=testphpipam.reserved_ip_state) == 0
+    assert testphpipam.edit_ips(subnet, []) == 0
+
+    assert testphpipam.delete_ips(
+        subnet, ips, state=testphpipam.reserved_ip_state) == 1
+    assert testphpipam.get_ip_list_by_desc('reserved') == []
+    assert testphpipam.delete_ips(subnet, [ips[0], ips[1].ip]) == 2
+    assert testphpipam.get_ip(ips[0].ip) is None
+
+
 def test_delete_subnet(testphpipam):
     subnet = testphpipam.get_subnet_by_desc('TEST IPv6 /125 SUBNET')
     assert subnet['subnet'] == ip_network('2001::40/125')
@@ -559,6 +602,50 @@ def test_get_next_free_ip(testphpipam):
     assert "Unable to get subnet id from database" in str(excinfo.value)
 
 
+def test_get_next_free_ip_gaps(testphpipam):
+    for subnet, allocated, expected in (
+            ('10.10.0.0/24', ('10.10.0.1', '10.10.0.2', '10.10.0.9'),
+             '10.10.0.3'),
+            ('2001:db8:42::/48', ('2001:db8:42::1', '2001:db8:42::2',
+                                  '2001:db8:42::4'),
+             '2001:db8:42::3')):
+        subnet = ip_network(subnet)
+        for ip in allocated:
+            testphpipam.add_ip(ip_interface('{}/{}'.format(
+                ip, subnet.prefixlen)), 'gap', 'gap')
+        ip = testphpipam.get_next_free_ip(subnet)
+        assert ip.ip == ip_address(expected)
+        assert ip.network.prefixlen == subnet.prefixlen
+
+
+def test_find_first_free_ip_in_db(testphpipam):
+    # Addresses of 59.154.200.0/22 have 9 or 10 digits
+    first_host = int(ip_address('59.154.202.0')) - 2
+    for ip in range(first_host, first_host + 4):
+        testphpipam.cur.execute("INSERT INTO ipaddresses (subnetId, ip_addr, "
+                                "description, %s) VALUES (42, '%d', 'gap', "
+                                "'gap')"
+                                % (testphpipam.hostname_db_field, ip))
+    assert testphpipam._find_first_free_ip_in_db(
+        42, first_host, first_host + 8) == first_host + 4
+    assert testphpipam._find_first_free_ip_in_db(
+        42, first_host + 2, first_host + 8) == first_host + 4
+    assert testphpipam._find_first_free_ip_in_db(
+        42, first_host, first_host + 3) is None
+
+
+@pytest.mark.parametrize('subnet', ('10.0.0.0/24', '10.0.0.0/30',
+                                    '10.0.0.0/31', '10.0.0.0/32',
+                                    '2001::/120', '2001::/126',
+                                    '2001::/127', '2001::/128'))
+def test_get_host_range(subnet):
+    subnet = ip_network(subnet)
+    hosts = list(subnet.hosts()) or [subnet.network_address]
+    first_host, last_host = PHPIPAM._get_host_range(subnet)
+    assert ip_address(first_host) == hosts[0]
+    assert ip_address(last_host) == hosts[-1]
+
+
 def test_get_subnet_by_id(testphpipam):
     assert testphpipam.get_subnet_by_id(42) is None
     testsubnet = testphpipam.get_subnet_by_id(3)
@@ -1031,3 +1118,750 @@ def test_get_ip(testphpipam):
               'dnsname': 'test-ip-15', 'mac': '52:24:10:00:00:02',
               'subnet_name': 'TEST /31 SUBNET GROUP', 'vlan_id': 42}
     assert testphpipam.get_ip(ip_address('10.5.0.0')) == testip
+
+
+def test_connection_pool(testphpipam_pooled):
+    results = []
+
+    def lookup():
+        results.append(testphpipam_pooled.get_ip(ip_address('10.5.0.0')))
+        results.append(testphpipam_pooled.get_subnet(
+            ip_network('10.3.0.0/30')))
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 16
+    assert all(result is not None for result in results)
+    assert testphpipam_pooled.pool.opened <= 2
+
+    # Writes are visible from other pooled connections
+    with testphpipam_pooled.connection():
+        ip = testphpipam_pooled.add_next_ip(ip_network('10.1.0.0/28'),
+                                            'pooled', 'pooled')
+        thread = threading.Thread(target=lookup)
+        thread.start()
+        thread.join()
+    assert testphpipam_pooled.get_ip_by_desc('pooled')['ip'] == ip.ip
+
+    # Both connections are checked out: the third one times out
+    with pytest.raises(RuntimeError, match='Could not get a database'):
+        with testphpipam_pooled.connection():
+            checked_out = testphpipam_pooled.pool.get()
+            try:
+                testphpipam_pooled.pool.get()
+            finally:
+                testphpipam_pooled.pool.put(checked_out)
+
+
+def test_mysql_lock_names(testphpipam):
+    assert MySQLLock(testphpipam).lock_names == [LOCK_NAME]
+    # Subnet locks exclude clients locking per subnet
+    lock = MySQLLock(testphpipam, [12, 3, 12])
+    assert lock.lock_names == [LOCK_NAME, '{}_3'.format(LOCK_NAME),
+                               '{}_12'.format(LOCK_NAME)]
+    testphpipam.lock_per_subnet = True
+    assert MySQLLock(testphpipam, [12, 3, 12]).lock_names == [
+        '{}_3'.format(LOCK_NAME), '{}_12'.format(LOCK_NAME)]
+    assert MySQLLock(testphpipam).lock_names == [LOCK_NAME]
+
+
+@pytest.mark.parametrize('version, expected', [
+    ('5.7.4-m14', False), ('5.7.5', True), ('8.0.36-log', True),
+    ('5.5.5-10.0.1-MariaDB', False), ('5.5.5-10.0.2-MariaDB', True),
+    ('10.6.12-MariaDB-1:10.6.12', True),
+    ('unknown', False)])
+def test_holds_multiple_named_locks(version, expected):
+    assert _holds_multiple_named_locks(version) is expected
+
+
+def test_lock_per_subnet(testdb):
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'lock_per_subnet': True})
+    assert testipam._lock_subnets(ip_network('10.1.0.0/28'),
+                                  ip_network('10.3.0.0/30')).lock_names == [
+        '{}_1'.format(LOCK_NAME), '{}_3'.format(LOCK_NAME)]
+
+    ip = testipam.add_next_ip(ip_network('10.1.0.0/28'), 'locked', 'locked')
+    assert ip == ip_interface('10.1.0.4/28')
+    testipam.delete_ip(ip)
+    subnet = testipam.add_next_subnet(ip_network('10.10.0.0/24'), 26,
+                                      'locked')
+    assert subnet == ip_network('10.10.0.0/26')
+
+    with pytest.raises(ValueError, match='Unable to get subnet id'):
+        testipam.add_next_ip(ip_network('10.42.0.0/28'), 'err', 'err')
+    with pytest.raises(ValueError, match='too small to add new subnet'):
+        testipam.add_next_subnet(ip_network('10.42.0.0/28'), 28, 'err')
+
+
+def test_subnet_id_cache():
+    cache = SubnetIdCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # 'b' is the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    cache.flush()
+    assert cache.get('c') is None
+
+    cache = SubnetIdCache(2, ttl=-1)
+    cache.set('a', 1)
+    assert cache.get('a') is None
+
+
+def test_find_subnet_id_cached(testdb):
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'subnet_id_cache_size': 16})
+    subnet = ip_network('10.3.0.0/30')
+    assert testipam.find_subnet_id(subnet) == 3
+
+    # Subnet ids are served from the cache until it is flushed
+    testipam.cur.execute('UPDATE subnets SET id=42 WHERE id=3')
+    assert testipam.find_subnet_id(ip_interface('10.3.0.1/30')) == 3
+    testipam.flush_subnet_id_cache()
+    assert testipam.find_subnet_id(subnet) == 42
+
+    # Own subnet changes invalidate the cache
+    subnet = ip_network('10.10.0.0/28')
+    testipam.add_subnet(subnet, ip_network('10.10.0.0/24'), 'cached')
+    subnet_id = testipam.find_subnet_id(subnet)
+    testipam.delete_subnet(subnet)
+    with pytest.raises(ValueError, match='Unable to get subnet id'):
+        testipam.find_subnet_id(subnet)
+
+    # Cache a subnet id, then move the subnet away behind the client back
+    testipam.add_subnet(subnet, ip_network('10.10.0.0/24'), 'cached')
+    subnet_id = testipam.find_subnet_id(subnet)
+    testipam.cur.execute('UPDATE subnets SET id=99 WHERE id={}'.format(
+        subnet_id))
+    assert testipam.find_subnet_id(subnet) == subnet_id
+    testipam.cur.execute('UPDATE subnets SET masterSubnetId=0, mask=32 '
+                         'WHERE id=99')
+    assert testipam.add_next_subnet(ip_network('10.10.0.0/24'), 28,
+                                    'cached') == subnet
+    assert testipam.find_subnet_id(subnet) not in (subnet_id, 99)
+
+
+def test_iter_lookups(testphpipam):
+    iplist = testphpipam.iter_ips_by_desc('test ip #%', fetch_size=2)
+    assert not isinstance(iplist, list)
+    assert list(iplist) == testphpipam.get_ip_list_by_desc('test ip #%')
+
+    assert list(testphpipam.iter_ip_interfaces_by_desc('test ip #1%')) == \
+        testphpipam.get_ip_interface_list_by_desc('test ip #1%')
+    assert list(testphpipam.iter_ip_interfaces_by_subnet_name(
+        'TEST /31%', fetch_size=1)) == \
+        testphpipam.get_ip_interface_list_by_subnet_name('TEST /31%')
+    assert list(testphpipam.iter_ips_by_mac('52:24:%')) == \
+        testphpipam.get_ip_list_by_mac('52:24:%')
+    assert list(testphpipam.iter_subnets_by_desc('TEST%', fetch_size=3)) == \
+        testphpipam.get_subnet_list_by_desc('TEST%')
+
+    # Closing a generator early frees the connection for other queries
+    iplist = testphpipam.iter_ips_by_desc('%', fetch_size=1)
+    assert next(iplist)['ip'] == ip_address('10.1.0.1')
+    iplist.close()
+    assert testphpipam.get_ip(ip_address('10.5.0.0')) is not None
+
+
+def test_iter_lookups_pooled(testphpipam_pooled):
+    iplist = testphpipam_pooled.iter_ips_by_desc('%', fetch_size=1)
+    assert next(iplist)['ip'] == ip_address('10.1.0.1')
+    # Other lookups run on another pooled connection meanwhile
+    assert testphpipam_pooled.get_ip(ip_address('10.5.0.0')) is not None
+    assert len(list(iplist)) == 14
+    assert testphpipam_pooled.pool.opened == 2
+
+
+def test_iter_lookups_closed_early(testphpipam_pooled, monkeypatch):
+    connections = []
+
+    class UnbufferedConnection(object):
+        # Stands for a MySQL connection streaming from the server
+        def __init__(self, db):
+            self.db = db
+            self.closed = False
+            connections.append(self)
+
+        def cursor(self, buffered=True):
+            return self.db.cursor()
+
+        def close(self):
+            self.closed = True
+            self.db.close()
+
+    pool = testphpipam_pooled.pool
+    pool.close()
+    monkeypatch.setattr(pool, 'connect', lambda: UnbufferedConnection(
+        testphpipam_pooled._connect_sqlite(testphpipam_pooled.params, True)))
+    monkeypatch.setattr(testphpipam_pooled, 'dbtype', 'mysql')
+    iplist = testphpipam_pooled.iter_ips_by_desc('%', fetch_size=1)
+    assert next(iplist)['ip'] == ip_address('10.1.0.1')
+    iplist.close()
+    # The connection is replaced instead of reading the remaining rows
+    assert [db.closed for db in connections] == [True, False]
+    assert pool.opened == 1
+    db = pool.get()
+    assert db is connections[1]
+    pool.put(db)
+
+    assert len(list(testphpipam_pooled.iter_ips_by_desc('%'))) == 15
+    assert len(connections) == 2
+
+
+def test_records(testdb, testphpipam):
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'records': True})
+
+    record = testipam.get_ip(ip_address('10.5.0.0'))
+    assert not hasattr(record, '__dict__')
+    assert record._ip is None
+    assert record['ip'] == ip_interface('10.5.0.0/31')
+    assert record.ip is record['ip']
+    assert record == testphpipam.get_ip(ip_address('10.5.0.0'))
+    assert record.get('state') is None
+    with pytest.raises(KeyError):
+        record['state']
+
+    for method, arg in (('get_ip_interface_list_by_desc', 'test ip%'),
+                        ('get_ip_interface_list_by_subnet_name', 'TEST%'),
+                        ('get_ip_list_by_desc', 'test ip%'),
+                        ('get_ip_list_by_mac', '52:%'),
+                        ('get_subnet_list_by_desc', 'TEST%'),
+                        ('get_children_subnet_list',
+                         ip_network('2001:db8:abcd::/64')),
+                        ('get_subnet', ip_network('10.3.0.0/30')),
+                        ('get_subnet_by_id', 3)):
+        result = getattr(testipam, method)(arg)
+        assert result == getattr(testphpipam, method)(arg)
+        assert result
+
+    subnet = testipam.get_subnet_with_ips(ip_network('10.1.0.0/28'))
+    assert subnet == testphpipam.get_subnet_with_ips(
+        ip_network('10.1.0.0/28'))
+    assert sorted(subnet['ips'][0].keys()) == [
+        'description', 'dnsname', 'ip', 'mac', 'state']
+
+
+def test_batch_lookups_by_ips(testphpipam, monkeypatch):
+    monkeypatch.setattr('ipam.client.backends.phpipam.IN_QUERY_CHUNK_SIZE', 2)
+    ips = [ip_address('10.1.0.{}'.format(i)) for i in (1, 2, 3, 4, 7)]
+    ips.append(ip_address('10.5.0.0'))
+
+    items = testphpipam.get_ips(ips)
+    assert items == dict((ip, testphpipam.get_ip(ip)) for ip in ips)
+    assert items[ip_address('10.1.0.4')] is None
+
+    for (batch, single) in (('get_hostnames_by_ips', 'get_hostname_by_ip'),
+                            ('get_descriptions_by_ips',
+                             'get_description_by_ip'),
+                            ('get_macs_by_ips', 'get_mac_by_ip')):
+        values = getattr(testphpipam, batch)(iter(ips))
+        assert values == dict(
+            (ip, getattr(testphpipam, single)(ip)) for ip in ips)
+    assert testphpipam.get_hostnames_by_ips(ips)[ips[0]] == 'test-ip-1'
+    assert testphpipam.get_macs_by_ips(ips)[ips[-1]] == '52:24:10:00:00:02'
+    assert testphpipam.get_ips([]) == {}
+
+
+class RecordingSink(MetricsSink):
+    def __init__(self):
+        self.queries = []
+        self.calls = []
+
+    def on_query(self, method, kind, rows, duration):
+        self.queries.append((method, kind, rows))
+
+    def on_call(self, method, queries, duration, lock_wait):
+        self.calls.append((method, queries, lock_wait))
+
+
+def test_instrumentation(testdb):
+    sink = RecordingSink()
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'metrics': sink})
+    assert [call[0] for call in sink.calls] == ['set_section_id_by_name',
+                                                '_get_version']
+
+    sink.queries = []
+    sink.calls = []
+    testipam.get_hostname_by_ip(ip_address('10.1.0.1'))
+    assert sink.queries == [('get_hostname_by_ip', 'SELECT', 1)]
+    assert sink.calls == [('get_hostname_by_ip', 1, 0.0)]
+
+    sink.queries = []
+    sink.calls = []
+    ip = testipam.add_next_ip(ip_network('10.1.0.0/28'), 'bench', 'bench')
+    assert ('add_next_ip', 'INSERT', 1) in sink.queries
+    assert all(query[0] == 'add_next_ip' for query in sink.queries)
+    [(method, queries, lock_wait)] = sink.calls
+    assert method == 'add_next_ip'
+    assert queries == len(sink.queries)
+    assert lock_wait > 0
+
+    sink.queries = []
+    sink.calls = []
+    assert testipam.get_ip_list_by_desc('test ip%')
+    assert sink.calls == [('get_ip_list_by_desc', 1, 0.0)]
+    sink.queries = []
+    rows = list(testipam.iter_ips_by_desc('test ip%'))
+    assert sink.queries == [('iter_ips_by_desc', 'SELECT', len(rows))]
+
+    sink.queries = []
+    testipam.delete_ip(ip)
+    assert ('delete_ip', 'DELETE', 1) in sink.queries
+
+
+def test_slow_query_log(testdb, caplog):
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'slow_query_threshold': 0})
+    caplog.clear()
+    testipam.get_subnet(ip_network('10.1.0.0/24'))
+    [record] = caplog.records
+    assert record.levelname == 'WARNING'
+    assert record.getMessage().startswith('Slow SELECT query in get_subnet')
+    assert 'FROM subnets where subnet' in record.getMessage()
+
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'slow_query_threshold': 60})
+    caplog.clear()
+    testipam.get_subnet(ip_network('10.1.0.0/24'))
+    assert caplog.records == []
+
+
+def test_lazy(testdb, testphpipam):
+    sink = RecordingSink()
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'metrics': sink,
+                        'lazy': True})
+    assert testipam._db is None
+    assert sink.queries == []
+
+    assert testipam.get_hostname_by_ip(
+        ip_address('10.1.0.1')) == 'test-ip-1'
+    # The probe queries run in the first call
+    assert sink.calls == [('get_hostname_by_ip', 3, 0.0)]
+    assert testipam.section_id == testphpipam.section_id
+    assert testipam.hostname_db_field == testphpipam.hostname_db_field
+    assert testipam.used_ip_state == testphpipam.used_ip_state
+    assert testipam.reserved_ip_state == testphpipam.reserved_ip_state
+
+    testipam = PHPIPAM({'section_name': 'Missing', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'lazy': True})
+    with pytest.raises(ValueError):
+        testipam.get_section_id()
+    # Sections set before the probe are kept
+    testipam.set_section_id(testphpipam.section_id)
+    assert testipam.get_hostname_by_ip(
+        ip_address('10.1.0.1')) == 'test-ip-1'
+
+
+def test_probe_cache(testdb, testphpipam, tmp_path, monkeypatch):
+    params = {'section_name': 'Production', 'dbtype': 'sqlite',
+              'database_uri': testdb, 'lazy': True,
+              'probe_cache': str(tmp_path / 'probes.json')}
+    assert PHPIPAM(params).used_ip_state == testphpipam.used_ip_state
+
+    def fail(*args):
+        raise AssertionError('Probed again')
+
+    monkeypatch.setattr(PHPIPAM, 'set_section_id_by_name', fail)
+    monkeypatch.setattr(PHPIPAM, '_get_version', fail)
+    testipam = PHPIPAM(params)
+    assert testipam.get_hostname_by_ip(
+        ip_address('10.1.0.1')) == 'test-ip-1'
+    assert testipam.section_id == testphpipam.section_id
+    assert testipam.hostname_db_field == testphpipam.hostname_db_field
+    assert testipam.reserved_ip_state == testphpipam.reserved_ip_state
+    # Not lazy, and cached
+    PHPIPAM(dict(params, lazy=False))
+
+    with pytest.raises(AssertionError):
+        PHPIPAM(dict(params, probe_cache_ttl=0)).get_section_id()
+    with pytest.raises(AssertionError):
+        PHPIPAM(dict(params, section_name='Other')).get_section_id()
+
+
+def test_lazy_driver_import():
+    # The MySQL driver is only imported by MySQL clients
+    subprocess.check_call([
+        sys.executable, '-c',
+        'import sys; import ipam.client.backends.phpipam; '
+        'assert "mysql.connector" not in sys.modules'])
+
+
+def test_close_from_other_thread(testphpipam):
+    assert testphpipam.get_ip(ip_address('10.1.0.1'))
+    # As when collected in another thread
+    thread = threading.Thread(target=testphpipam.close)
+    thread.start()
+    thread.join()
+    assert testphpipam._db is None
+    assert testphpipam.get_ip(ip_address('10.1.0.1'))
+
+
+def test_read_replicas(testdb, tmp_path):
+    replica = str(tmp_path / 'replica.db')
+    shutil.copy(testdb, replica)
+    conn = sqlite3.connect(replica)
+    conn.execute("UPDATE ipaddresses SET description='replica' "
+                 "WHERE ip_addr='%d'" % ip_address('10.1.0.1'))
+    # Writes must not look their subnet up on the replica
+    conn.execute("DELETE FROM subnets WHERE subnet='%d' AND mask='28'"
+                 % ip_address('10.1.0.0'))
+    conn.execute('DELETE FROM ipaddresses WHERE subnetId=2')
+    conn.commit()
+    conn.close()
+
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb,
+                        'replicas': [{'database_uri': replica}]})
+    assert testipam.get_description_by_ip(
+        ip_address('10.1.0.1')) == 'replica'
+    assert [ip['description'] for ip in testipam.iter_ips_by_desc('repl%')
+            ] == ['replica']
+    with pytest.raises(ValueError):
+        testipam.find_subnet_id(ip_network('10.1.0.0/28'))
+    # Locking reads run on the primary
+    assert len(testipam.get_allocated_ips_by_subnet_id(2)) == 6
+
+    ip = testipam.add_next_ip(ip_network('10.1.0.0/28'), 'host', 'desc')
+    # Read your writes on the primary
+    assert testipam.get_description_by_ip(ip.ip) == 'desc'
+    assert testipam.get_description_by_ip(
+        ip_address('10.1.0.1')) == 'test ip #1'
+
+    testipam.read_your_writes_window = 0
+    assert testipam.get_description_by_ip(ip.ip) is None
+    assert testipam.get_description_by_ip(
+        ip_address('10.1.0.1')) == 'replica'
+
+
+def test_subnet_trie():
+    trie = SubnetTrie()
+    trie.insert(ip_network('10.0.0.0/8'), 'a')
+    trie.insert(ip_network('10.1.0.0/16'), 'b')
+    trie.insert(ip_network('10.1.2.3/32'), 'c')
+    trie.insert(ip_network('0.0.0.0/0'), 'default')
+    trie.insert(ip_network('2001:db8::/32'), 'v6')
+    assert trie.lookup(ip_address('10.1.2.3')) == ['default', 'a', 'b', 'c']
+    assert trie.lookup(ip_address('10.1.2.4')) == ['default', 'a', 'b']
+    assert trie.lookup(ip_address('11.0.0.1')) == ['default']
+    assert trie.lookup(ip_address('2001:db8::1')) == ['v6']
+    assert trie.lookup(ip_address('2001:db9::1')) == []
+
+
+def test_get_subnet_tree(testphpipam):
+    tree = testphpipam.get_subnet_tree()
+    assert len(tree) == 12
+    assert [node.id for node in tree.roots] == [1, 2, 3, 4, 5, 8, 6, 7, 9, 10]
+    assert [node.id for node in tree] == [1, 2, 3, 4, 5, 8, 6, 7, 9, 10, 11,
+                                          12]
+    parent = tree.get(ip_network('2001:db8:abcd::/64'))
+    assert parent is tree.get_by_id(10)
+    assert [node.subnet for node in parent.children] == (
+        testphpipam.get_children_subnet_list(parent.network))
+    assert parent.children[1].ancestors() == [parent]
+    assert tree.get(ip_network('10.1.0.0/28')).subnet == (
+        testphpipam.get_subnet(ip_network('10.1.0.0/28')))
+    assert ip_network('10.1.0.0/29') not in tree
+    assert tree.get_by_id(42) is None
+
+    child = ip_network('2001:db8:abcd::4/127')
+    assert testphpipam.add_subnet(child, parent.network, 'tree child',
+                                  tree=tree) == child
+    assert [node.network for node in parent.children] == [
+        ip_network('2001:db8:abcd::/127'), ip_network('2001:db8:abcd::2/127'),
+        child]
+    assert tree.get(child).parent is parent
+    assert tree.get(child).subnet == testphpipam.get_subnet(child)
+    assert testphpipam.get_subnet_tree().get(child).id == tree.get(child).id
+    with pytest.raises(ValueError, match='overlaps with'):
+        testphpipam.add_subnet(ip_network('2001:db8:abcd::/126'),
+                               parent.network, 'overlap', tree=tree)
+    with pytest.raises(ValueError, match='not found in the tree'):
+        testphpipam.add_subnet(ip_network('10.1.0.0/30'),
+                               ip_network('10.1.0.0/29'), 'unknown',
+                               tree=tree)
+
+    # Subnets added since the tree was loaded are seen under the lock
+    stale = testphpipam.get_subnet_tree()
+    testphpipam.add_subnet(ip_network('2001:db8:abcd::8/127'),
+                           parent.network, 'other client')
+    with pytest.raises(ValueError, match='overlaps with'):
+        testphpipam.add_subnet(ip_network('2001:db8:abcd::8/126'),
+                               parent.network, 'stale', tree=stale)
+
+
+def test_get_section_utilization(testphpipam):
+    testphpipam.add_next_ips(ip_network('10.1.0.0/28'), 2, [''] * 2,
+                             ['reserved'] * 2,
+                             state=testphpipam.reserved_ip_state)
+    report = testphpipam.get_section_utilization()
+    assert [item['subnet'] for item in report] == [
+        node.network for node in sorted(
+            testphpipam.get_subnet_tree(),
+            key=lambda node: (node.network.version,
+                              node.network.network_address,
+                              node.network.prefixlen))]
+    items = dict((item['subnet'], item) for item in report)
+    assert items[ip_network('10.1.0.0/28')] == {
+        'subnet': ip_network('10.1.0.0/28'), 'description': 'TEST /28 SUBNET',
+        'vlan_id': 10, 'size': 16, 'allocated': 9, 'reserved': 2,
+        'children': 0, 'covered': 0, 'free': 5, 'utilization': 9 / 14.0}
+    assert items[ip_network('10.2.0.0/29')]['free'] == 0
+    assert items[ip_network('10.2.0.0/29')]['utilization'] == 1
+    assert items[ip_network('10.10.0.0/24')]['utilization'] == 0
+    container = items[ip_network('2001:db8:abcd::/64')]
+    assert (container['children'], container['covered']) == (2, 4)
+    assert container['free'] == 2 ** 64 - 4
+    assert container['allocated'] == 0
+
+
+def test_get_subnet_containing(testphpipam):
+    assert testphpipam.get_subnet_containing(ip_address('10.1.0.5')) == \
+        testphpipam.get_subnet(ip_network('10.1.0.0/28'))
+    assert testphpipam.get_subnet_containing(
+        ip_interface('10.1.0.5/28'))['subnet'] == ip_network('10.1.0.0/28')
+    assert testphpipam.get_subnet_containing(ip_address('10.1.0.16')) is None
+    assert testphpipam.get_subnet_containing(
+        ip_address('10.1.0.16'), ancestors=True) == []
+
+    ip = ip_address('2001:db8:abcd::1')
+    assert [subnet['subnet'] for subnet in testphpipam.get_subnet_containing(
+        ip, ancestors=True)] == [ip_network('2001:db8:abcd::/127'),
+                                 ip_network('2001:db8:abcd::/64')]
+
+    # Subnet changes of this client are seen at once
+    ip = ip_address('2001:db8:42:ba00::1')
+    assert testphpipam.get_subnet_containing(
+        ip)['subnet'] == ip_network('2001:db8:42::/48')
+    testphpipam.add_subnet(ip_network('2001:db8:42:ba00::/56'),
+                           ip_network('2001:db8:42::/48'), 'new')
+    assert testphpipam.get_subnet_containing(
+        ip)['subnet'] == ip_network('2001:db8:42:ba00::/56')
+    testphpipam.edit_subnet_description(ip_network('2001:db8:42:ba00::/56'),
+                                        'edited')
+    assert testphpipam.get_subnet_containing(ip)['description'] == 'edited'
+    testphpipam.delete_subnet(ip_network('2001:db8:42:ba00::/56'))
+    assert testphpipam.get_subnet_containing(
+        ip)['subnet'] == ip_network('2001:db8:42::/48')
+
+    # Changes of other clients once the trie is refreshed
+    trie = testphpipam._get_subnet_trie()
+    testphpipam.cur.execute("UPDATE subnets SET description='other' "
+                            "WHERE description='TEST /28 SUBNET'")
+    assert testphpipam._get_subnet_trie() is trie
+    testphpipam.refresh_subnet_trie()
+    assert testphpipam.get_subnet_containing(
+        ip_address('10.1.0.1'))['description'] == 'other'
+
+
+def test_import_ips(testphpipam):
+    rows = [
+        {'ip': '10.1.0.4/28', 'hostname': 'imported-1',
+         'description': "imported 'quoted'", 'mac': '52:24:10:00:00:04'},
+        {'ip': ip_interface('10.1.0.5/28'), 'hostname': 'imported-2',
+         'description': 'imported'},
+        # Already registered
+        {'ip': '10.1.0.1/28', 'hostname': 'dup', 'description': 'dup'},
+        # Imported twice
+        {'ip': '10.1.0.4/28', 'hostname': 'dup', 'description': 'dup'},
+        {'ip': '10.1.0.4/24', 'hostname': 'unknown', 'description': 'x'},
+        {'ip': 'invalid', 'hostname': 'invalid', 'description': 'x'},
+        {'hostname': 'no ip'},
+        {'ip': '2001::45/125', 'hostname': 'imported-3',
+         'description': 'imported'},
+    ]
+    result = testphpipam.import_ips(iter(rows), chunk_size=2)
+    assert result['imported'] == 3
+    assert [(index, reason.split(':')[0]) for (index, row, reason)
+            in result['rejected']] == [
+        (3, 'IP address 10.1.0.4 imported twice'),
+        (4, 'Unknown subnet 10.1.0.0/24'),
+        (5, 'Invalid IP address'),
+        (6, 'Invalid IP address'),
+        (2, 'IP address 10.1.0.1 already registered'),
+    ]
+    assert result['rejected'][0][1] is rows[3]
+
+    assert testphpipam.get_ip(ip_address('10.1.0.4')) == {
+        'ip': ip_interface('10.1.0.4/28'),
+        'description': "imported 'quoted'",
+        'dnsname': 'imported-1',
+        'subnet_name': 'TEST /28 SUBNET',
+        'vlan_id': 42,
+        'mac': '52:24:10:00:00:04',
+    }
+    assert testphpipam.get_mac_by_ip(ip_address('10.1.0.5')) == ''
+    assert testphpipam.get_hostname_by_ip(
+        ip_address('2001::45')) == 'imported-3'
+    assert testphpipam.get_hostname_by_ip(ip_address('10.1.0.1')) == \
+        'test-ip-1'
+
+
+def test_import_subnets(testphpipam):
+    rows = [
+        # Children first: they are imported after their parents anyway
+        {'subnet': '10.8.1.0/26', 'parent': '10.8.1.0/24',
+         'description': 'child'},
+        {'subnet': '10.8.1.64/26', 'parent': '10.8.1.0/24',
+         'description': 'child 2'},
+        {'subnet': '10.8.1.0/24', 'parent': '10.8.0.0/16',
+         'description': 'container'},
+        {'subnet': '10.8.0.0/16', 'parent': '', 'description': 'top'},
+        # Overlaps with the first child
+        {'subnet': '10.8.1.0/27', 'parent': '10.8.1.0/24',
+         'description': 'overlap'},
+        {'subnet': '10.9.0.0/24', 'parent': '10.8.0.0/16',
+         'description': 'not a child'},
+        {'subnet': '10.1.0.0/30', 'parent': '10.1.0.0/28',
+         'description': 'parent with ips'},
+        {'subnet': '10.1.0.0/28', 'parent': None,
+         'description': 'already registered'},
+        {'subnet': '10.1.0.1/28', 'description': 'invalid'},
+    ]
+    result = testphpipam.import_subnets(rows, chunk_size=10)
+    assert result['imported'] == 4
+    assert sorted((index, reason) for (index, row, reason)
+                  in result['rejected'])[:-1] == [
+        (4, 'Candidate subnet overlaps with 10.8.1.0/26'),
+        (5, 'Subnet 10.9.0.0/24 is not a child of 10.8.0.0/16'),
+        (6, 'Parent subnet 10.1.0.0/28 must not contain any allocated IP '
+            'address!'),
+        (7, 'Subnet 10.1.0.0/28 already registered'),
+    ]
+    assert result['rejected'][0][0] == 8
+
+    assert [subnet['description'] for subnet in
+            testphpipam.get_subnet_containing(ip_address('10.8.1.65'),
+                                              ancestors=True)] == [
+        'child 2', 'container', 'top']
+    assert [subnet['subnet'] for subnet in
+            testphpipam.get_children_subnet_list(
+                ip_network('10.8.1.0/24'))] == [
+        ip_network('10.8.1.0/26'), ip_network('10.8.1.64/26')]
+
+
+def test_import_subnets_concurrent_writes(testphpipam, monkeypatch):
+    check_subnet_chunk = testphpipam._check_subnet_chunk
+
+    def concurrent_writes(chunk):
+        # Written by other clients after the subnets were loaded
+        testphpipam.cur.execute(
+            "INSERT INTO subnets (subnet, mask, sectionId, description, "
+            "masterSubnetId) VALUES ('%d', '26', %d, 'concurrent', 8)"
+            % (int(ip_address('10.10.0.0')), testphpipam.section_id))
+        testphpipam.cur.execute(
+            "INSERT INTO subnets (subnet, mask, sectionId, description, "
+            "masterSubnetId) VALUES ('%d', '24', %d, 'concurrent', 0)"
+            % (int(ip_address('10.11.0.0')), testphpipam.section_id))
+        testphpipam.cur.execute(
+            "INSERT INTO ipaddresses (subnetId, ip_addr, description, %s) "
+            "VALUES (4, '%d', 'concurrent', 'concurrent')"
+            % (testphpipam.hostname_db_field, int(ip_address('10.4.0.0'))))
+        return check_subnet_chunk(chunk)
+
+    monkeypatch.setattr(testphpipam, '_check_subnet_chunk',
+                        concurrent_writes)
+    result = testphpipam.import_subnets([
+        {'subnet': '10.10.0.0/27', 'parent': '10.10.0.0/24',
+         'description': 'overlap'},
+        {'subnet': '10.11.0.0/24', 'parent': '', 'description': 'top'},
+        {'subnet': '10.4.0.1/32', 'parent': '10.4.0.0/31',
+         'description': 'parent with ips'},
+        {'subnet': '10.10.0.128/26', 'parent': '10.10.0.0/24',
+         'description': 'free'},
+    ])
+    assert result['imported'] == 1
+    assert sorted((index, reason) for (index, row, reason)
+                  in result['rejected']) == [
+        (0, 'Candidate subnet overlaps with 10.10.0.0/26'),
+        (1, 'Subnet 10.11.0.0/24 already registered'),
+        (2, 'Parent subnet id 4 must not contain any allocated IP '
+            'address!')]
+    assert [subnet['description'] for subnet in
+            testphpipam.get_children_subnet_list(
+                ip_network('10.10.0.0/24'))] == ['concurrent', 'free']
+
+
+def _add_unique_ip_index(testdb):
+    db = sqlite3.connect(testdb)
+    db.execute('CREATE UNIQUE INDEX ipaddresses_subnet_ip '
+               'ON ipaddresses (subnetId, ip_addr)')
+    db.commit()
+    db.close()
+
+
+def test_optimistic_allocation(testdb, monkeypatch):
+    _add_unique_ip_index(testdb)
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'pool_size': 4,
+                        'optimistic_allocation': True})
+    subnet = ip_network('10.1.0.0/28')
+    ip = testipam.add_next_ip(subnet, 'optimistic', 'optimistic')
+    assert ip == ip_interface('10.1.0.4/28')
+    assert testipam.add_next_ip(subnet, 'dup', 'optimistic',
+                                allow_duplicates=False) == ip
+
+    # Another client takes the candidate address before the insert
+    find_first_free_ip = testipam._find_first_free_ip
+    taken = []
+
+    def find_taken_ip(subnet, subnetid, first_host, last_host):
+        if not taken:
+            taken.append(first_host)
+            return int(ip_address('10.1.0.1'))
+        return find_first_free_ip(subnet, subnetid, first_host, last_host)
+
+    monkeypatch.setattr(testipam, '_find_first_free_ip', find_taken_ip)
+    assert testipam.add_next_ip(subnet, 'retry', 'retry') == ip_interface(
+        '10.1.0.5/28')
+
+    # Without retries left, the allocation falls back to locking
+    taken = []
+    testipam.optimistic_retries = 0
+    assert testipam.add_next_ip(subnet, 'locked', 'locked') == ip_interface(
+        '10.1.0.6/28')
+    testipam.optimistic_retries = 10
+
+    results = []
+
+    def allocate():
+        for _ in range(2):
+            results.append(testipam.add_next_ip(
+                ip_network('10.10.0.0/24'), 'concurrent', 'concurrent').ip)
+
+    threads = [threading.Thread(target=allocate) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == len(set(results)) == 16
+    assert len(testipam.get_ip_list_by_desc('concurrent')) == 16
+
+    with pytest.raises(ValueError, match='is full'):
+        testipam.add_next_ip(ip_network('10.2.0.0/29'), 'full', 'full')
+
+
+def test_optimistic_allocation_without_unique_index(testdb, monkeypatch):
+    testipam = PHPIPAM({'section_name': 'Production', 'dbtype': 'sqlite',
+                        'database_uri': testdb, 'pool_size': 2,
+                        'optimistic_allocation': True})
+
+    def optimistic(*args):
+        raise AssertionError('Duplicates are possible without the index')
+
+    monkeypatch.setattr(testipam, '_add_next_ip_optimistic', optimistic)
+    subnet = ip_network('10.1.0.0/28')
+    assert testipam.add_next_ip(subnet, 'locked', 'locked') == ip_interface(
+        '10.1.0.4/28')
+    assert testipam._unique_ip_index is False
@@ -0,0 +1,111 @@
+from __future__ import unicode_literals
+import pytest
+from ipam.client.backends.snapshot import SnapshotIPAM, export_snapshot
+from ipaddress import ip_address, ip_interface, ip_network
+
+
+@pytest.fixture
+def testsnapshot(testphpipam, tmp_path):
+    # A folder holding an address, left out of the snapshot
+    testphpipam.cur.execute(
+        "INSERT INTO subnets (id, subnet, mask, sectionId, description, "
+        "masterSubnetId, isFolder) VALUES (20, '', '', %d, 'FOLDER', "
+        "0, 1)" % testphpipam.section_id)
+    testphpipam.cur.execute(
+        "INSERT INTO ipaddresses (id, subnetId, ip_addr, description, %s, "
+        "state) VALUES (100, 20, '%d', 'FOLDER IP', 'folder-ip', "
+        "'%d')" % (testphpipam.hostname_db_field,
+                   int(ip_address('10.20.0.1')), testphpipam.used_ip_state))
+    testphpipam.db.commit()
+    path = str(tmp_path / 'ipam.snapshot')
+    export_snapshot(testphpipam, path)
+    snapshot = SnapshotIPAM({'snapshot_path': path})
+    yield snapshot
+    snapshot.close()
+
+
+def test_snapshot_lookups(testphpipam, testsnapshot):
+    ips = [ip_address('10.1.0.1'), ip_address('10.1.0.4'),
+           ip_address('10.5.0.0'), ip_address('2001::41')]
+    for method in ('get_ip', 'get_hostname_by_ip', 'get_description_by_ip',
+                   'get_mac_by_ip'):
+        for ip in ips:
+            assert (getattr(testsnapshot, method)(ip) ==
+                    getattr(testphpipam, method)(ip))
+    for method in ('get_ips', 'get_hostnames_by_ips',
+                   'get_descriptions_by_ips', 'get_macs_by_ips'):
+        assert (getattr(testsnapshot, method)(ips) ==
+                getattr(testphpipam, method)(ips))
+
+    def key(item):
+        return sorted((k, str(v)) for (k, v) in item.items())
+
+    for (method, arg) in (('get_ip_interface_list_by_desc', 'test ip%'),
+                          ('get_ip_interface_list_by_desc', 'TEST IP #1'),
+                          ('get_ip_interface_list_by_subnet_name', 'TEST%'),
+                          ('get_ip_list_by_desc', 'test ip group _'),
+                          ('get_ip_list_by_mac', '52:%'),
+                          ('get_subnet_list_by_desc', 'TEST%'),
+                          ('get_children_subnet_list',
+                           ip_network('2001:db8:abcd::/64')),
+                          ('get_num_ips_by_desc', 'test ip%'),
+                          ('get_num_subnets_by_desc', '%/31%')):
+        expected = getattr(testphpipam, method)(arg)
+        result = getattr(testsnapshot, method)(arg)
+        if isinstance(expected, list):
+            assert sorted(result, key=key) == sorted(expected, key=key)
+        else:
+            assert result == expected
+        assert result
+
+    for subnet in (ip_network('10.3.0.0/30'), ip_network('10.3.0.0/29'),
+                   ip_network('2001::40/125')):
+        assert testsnapshot.get_subnet(subnet) == testphpipam.get_subnet(
+            subnet)
+    assert testsnapshot.get_subnet_by_id(3) == testphpipam.get_subnet_by_id(3)
+    assert testsnapshot.find_subnet_id(ip_interface('10.1.0.2/28')) == 1
+    with pytest.raises(ValueError):
+        testsnapshot.find_subnet_id(ip_network('10.1.0.0/29'))
+
+    subnet = testsnapshot.get_subnet_with_ips(ip_network('10.1.0.0/28'))
+    expected = testphpipam.get_subnet_with_ips(ip_network('10.1.0.0/28'))
+    assert [ip['ip'] for ip in subnet['ips']] == sorted(
+        ip['ip'] for ip in expected['ips'])
+    assert subnet['vlan_id'] == expected['vlan_id']
+    assert testsnapshot.get_subnet_with_ips(ip_network('10.8.0.0/24')) == {
+        'ips': []}
+
+    assert testsnapshot.get_ip_by_desc_and_subnet(
+        'test ip #2', '10.1.0.0') == ip_address('10.1.0.2')
+    with pytest.raises(ValueError):
+        testsnapshot.get_ip_by_desc_and_subnet('test ip #2', '10.2.0.0')
+
+
+def test_snapshot_next_free_ip(testphpipam, testsnapshot):
+    for subnet in (ip_network('10.1.0.0/28'), ip_network('10.5.0.0/31'),
+                   ip_network('2001::40/125')):
+        assert (testsnapshot.get_next_free_ip(subnet) ==
+                testphpipam.get_next_free_ip(subnet))
+    with pytest.raises(ValueError, match='is full'):
+        testsnapshot.get_next_free_ip(ip_network('10.2.0.0/29'))
+
+
+def test_snapshot_read_only(testsnapshot):
+    with pytest.raises(NotImplementedError):
+        testsnapshot.add_next_ip(ip_network('10.1.0.0/28'), 'host', 'desc')
+    with pytest.raises(NotImplementedError):
+        testsnapshot.delete_subnet(ip_network('10.1.0.0/28'))
+
+
+def test_snapshot_records(testphpipam, testsnapshot, tmp_path):
+    path = str(tmp_path / 'ipam.snapshot')
+    snapshot = SnapshotIPAM({'snapshot_path': path, 'records': True})
+    ip = snapshot.get_ip(ip_address('10.1.0.1'))
+    assert ip == testsnapshot.get_ip(ip_address('10.1.0.1'))
+    assert ip.ip == ip_interface('10.1.0.1/28')
+    snapshot.close()
+
+    with open(path, 'wb') as f:
+        f.write(b'not a snapshot' * 10)
+    with pytest.raises(ValueError, match='not an IPAM snapshot'):
+        SnapshotIPAM({'snapshot_path': path})
@@ -0,0 +1,66 @@
+from __future__ import unicode_literals
+import pytest
+import sqlite3
+import threading
+from ipam.client.backends.phpipam import PHPIPAM
+from ipam.client.backends.sqlitemirror import (mirror_params, refresh_mirror,
+                                               run_mirror)
+from ipaddress import ip_address, ip_interface, ip_network
+
+
+def test_mirror(testphpipam, tmp_path):
+    path = str(tmp_path / 'mirror.db')
+    counts = refresh_mirror(testphpipam, path)
+    assert counts['sections'] == 1
+    assert counts['ipaddresses'] == 15
+
+    mirror = PHPIPAM(mirror_params(path))
+    assert mirror.hostname_db_field == testphpipam.hostname_db_field
+    assert mirror.used_ip_state == testphpipam.used_ip_state
+    for ip in (ip_address('10.1.0.1'), ip_address('10.5.0.0')):
+        assert mirror.get_ip(ip) == testphpipam.get_ip(ip)
+    for subnet in (ip_network('10.1.0.0/28'), ip_network('2001::40/125')):
+        assert mirror.get_subnet_with_ips(
+            subnet) == testphpipam.get_subnet_with_ips(subnet)
+        assert mirror.get_next_free_ip(
+            subnet) == testphpipam.get_next_free_ip(subnet)
+
+    def key(item):
+        return item['ip']
+
+    # Index order instead of insertion order
+    assert sorted(mirror.get_ip_list_by_desc('TEST IP%'), key=key) == sorted(
+        testphpipam.get_ip_list_by_desc('TEST IP%'), key=key)
+    assert sorted(mirror.get_ip_interface_list_by_subnet_name('test%'),
+                  key=key) == sorted(
+        testphpipam.get_ip_interface_list_by_subnet_name('test%'), key=key)
+
+    # Read-only and tuned for reads
+    with pytest.raises(sqlite3.OperationalError):
+        mirror.add_next_ip(ip_network('10.1.0.0/28'), 'host', 'desc')
+    assert mirror.cur.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    assert mirror.cur.execute('PRAGMA mmap_size').fetchone()[0] > 0
+
+    # Refreshes are seen by open readers
+    ip = testphpipam.add_next_ip(ip_network('10.1.0.0/28'), 'host', 'desc')
+    testphpipam.delete_ip(ip_interface('10.1.0.1/28'))
+    refresh_mirror(testphpipam, path)
+    assert mirror.get_hostname_by_ip(ip.ip) == 'host'
+    assert mirror.get_ip(ip_address('10.1.0.1')) is None
+
+
+def test_mirror_batches(testphpipam, tmp_path):
+    path = str(tmp_path / 'mirror.db')
+    counts = refresh_mirror(testphpipam, path, batch_size=4)
+    assert counts == refresh_mirror(testphpipam, path)
+    assert counts['ipaddresses'] == 15
+
+
+def test_run_mirror(testphpipam, tmp_path):
+    path = str(tmp_path / 'mirror.db')
+    stop = threading.Event()
+    stop.set()
+    # Stopped after the first refresh
+    run_mirror(testphpipam, path, interval=3600, stop=stop)
+    assert PHPIPAM(mirror_params(path)).get_hostname_by_ip(
+        ip_address('10.1.0.1')) == 'test-ip-1'